@@ -0,0 +1,4 @@
+try:
+    import hdf5plugin # Registers the blosc/zstd filter of data_parsing.chunked_storage for all HDF5 readers
+except ImportError:
+    pass
@@ -4,11 +4,13 @@ import pprint as pp
 
 from pyKES.database.database_experiments import ExperimentalDataset
 
+from simultaneous_detection.data_parsing.lazy_dataset import LazyExperimentalDataset
+from simultaneous_detection.data_parsing.results_table import read_results_table
+from simultaneous_detection.data_parsing.processing_parameters import PROCESSING_PARAMETERS
+from simultaneous_detection.fitting.global_fit import global_fits_by_group
 
-def main():
 
-    dataset = ExperimentalDataset.load_from_hdf5('data/251203_processed_O2_H2_data.h5')
-    dataset_gas = ExperimentalDataset.load_from_hdf5('data/251203_processed_O2_H2_data_gas_phase_fixed.h5')
+def main():
 
     fig, ax = plt.subplots(2, 2, figsize=(10, 8))
 
@@ -18,32 +20,36 @@ def main():
     error_fixed_fit = []
     error_fixed_fit_gas = []
 
-    for counter, experiment_name in enumerate(dataset.experiments):
+    # Only scalar fit results are needed, so the datasets are opened lazily
+    with LazyExperimentalDataset('data/251203_processed_O2_H2_data.h5') as dataset, \
+         LazyExperimentalDataset('data/251203_processed_O2_H2_data_gas_phase_fixed.h5') as dataset_gas:
+
+        for counter, experiment_name in enumerate(dataset.experiments):
 
-        experiment = dataset.experiments[experiment_name]
-        experiment_gas = dataset_gas.experiments[experiment_name]
+            experiment = dataset.experiments[experiment_name]
+            experiment_gas = dataset_gas.experiments[experiment_name]
 
-        if experiment.metadata['group'] != 'Gas phase':
+            if experiment.metadata['group'] != 'Gas phase':
 
-            rate_constants = experiment.processed_data['Fit_all_rate_constants']
-            error = experiment.processed_data['Fit_fixed_fitting_error']
-            error_fixed_fit.append(error)
+                rate_constants = experiment.processed_data['Fit_all_rate_constants']
+                error = experiment.processed_data['Fit_fixed_fitting_error']
+                error_fixed_fit.append(error)
 
-            error_gas = experiment_gas.processed_data['Fit_fixed_fitting_error']
-            error_fixed_fit_gas.append(error_gas)
+                error_gas = experiment_gas.processed_data['Fit_fixed_fitting_error']
+                error_fixed_fit_gas.append(error_gas)
 
-            print('-----------------------------------')
-            print(experiment_name, error, error_gas)
-            pp.pprint(rate_constants)
-            pp.pprint(experiment_gas.processed_data['Fit_fixed_all_rate_constants'])
+                print('-----------------------------------')
+                print(experiment_name, error, error_gas)
+                pp.pprint(rate_constants)
+                pp.pprint(experiment_gas.processed_data['Fit_fixed_all_rate_constants'])
 
-            k1_values.append(rate_constants['k1'])
-            k2_values.append(rate_constants['k2'])
-            k3_values.append(rate_constants['k3'])
+                k1_values.append(rate_constants['k1'])
+                k2_values.append(rate_constants['k2'])
+                k3_values.append(rate_constants['k3'])
 
-            ax[0,0].plot(counter, rate_constants['k1'], '.', color = 'blue')
-            ax[0,1].plot(counter, rate_constants['k2'], '.', color = 'orange')
-            ax[1,0].plot(counter, rate_constants['k3'], '.', color = 'green')
+                ax[0,0].plot(counter, rate_constants['k1'], '.', color = 'blue')
+                ax[0,1].plot(counter, rate_constants['k2'], '.', color = 'orange')
+                ax[1,0].plot(counter, rate_constants['k3'], '.', color = 'green')
 
     print(np.mean(k1_values))
     print(np.mean(k2_values))
@@ -56,6 +62,44 @@ def main():
         
 
 
+def rate_constants_by_group(table_file = 'data/251204_processed_O2_H2_data_gas_D2O_regrouped_results.parquet',
+                            fit_prefix = 'Fit'):
+    '''
+    Mean and standard deviation of the fitted rate constants and fitting errors per group,
+    from the results table written by generate_dataset.
+    '''
+
+    table = read_results_table(table_file)
+    columns = [column for column in table.columns if column.startswith(f'{fit_prefix}_all_rate_constants/')]
+    columns.append(f'{fit_prefix}_fitting_error')
+
+    summary = table.dropna(subset = columns).groupby('group')[columns].agg(['mean', 'std'])
+    print(summary)
+
+    return summary
+
+def global_rate_constants_by_group(filename = 'data/251204_processed_O2_H2_data_gas_D2O_regrouped.h5',
+                                   shared = ('k2', 'k3')):
+    '''
+    Rate constants per group from one hierarchical global fit of all active experiments of
+    each group (shared rate constants common to the group, k1 per experiment), starting from
+    the individual fits, instead of averaging the individual fits.
+    '''
+
+    dataset = ExperimentalDataset.load_from_hdf5(filename)
+
+    fits = global_fits_by_group(dataset,
+                                PROCESSING_PARAMETERS['fitting_parameters'],
+                                shared,
+                                general_prefix = 'Fit',
+                                print_results = True)
+
+    for group, fit in fits.items():
+        print('-----------------------------------')
+        print(group, fit['error'])
+        pp.pprint({name: (value, fit['standard_errors']['shared'][name]) for name, value in fit['shared'].items()})
+
+    return fits
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
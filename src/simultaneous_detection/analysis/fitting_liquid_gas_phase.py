@@ -8,6 +8,10 @@ from pyKES.fitting_ODE import (Fitting_Model,
                                square_loss_time_series_normalized, 
                                objective_function)
 
+from simultaneous_detection.fitting.kinetic_solver import optimize
+from simultaneous_detection.fitting.sensitivity_refinement import refine_fit
+from simultaneous_detection.fitting.parameter_sweep import parameter_sweep
+
 
 def main():
 
@@ -61,7 +65,7 @@ def main():
 
     model.loss_function = square_loss_time_series_normalized
 
-    model.optimize()
+    optimize(model, workers = -1, disp = True, print_results = True)
 
     model.visualize_optimization_results()
 
@@ -112,23 +116,23 @@ def testing_ratio():
 
     ratios = np.linspace(0.5, 5.0, 20)
 
-    fun_values = []
-    
-    for value in ratios:
-        model.other_multipliers = {
-            'factor1': value # Based on Henry's constant ratio
-        }
-
-        model.optimize()
-
-        fun_values.append(model.result.fun)
+    profile = parameter_sweep(model, 
+                              'factor1', # Henry's constant ratio
+                              ratios,
+                              checkpoint_file = 'data/testing_ratio_factor1_profile.json')
 
-    plt.plot(ratios, fun_values, 'o-')
+    plt.plot(profile['values'], profile['errors'], 'o-')
     plt.show()
 
     #model.visualize_optimization_results()
 
-def liquid_phase_sensor_diffusion_model():
+def liquid_phase_sensor_diffusion_model(refine_factor1 = False):
+    '''
+    Fitting the sensor diffusion model to the liquid and gas phase data and saving the fits.
+    The rate constants are refined locally after the global optimization (kept only if the
+    fitting error does not increase); with refine_factor1 = True the Henry's constant
+    ratio factor1 is refined as well instead of kept fixed.
+    '''
 
     dataset = ExperimentalDataset.load_from_hdf5('data/251204_processed_O2_H2_data.h5')
 
@@ -190,7 +194,17 @@ def liquid_phase_sensor_diffusion_model():
 
     model.loss_function = square_loss_time_series_normalized
 
-    model.optimize()
+    optimize(model, workers = -1, disp = True, print_results = True)
+
+    # Refining the rate constants (and factor1 if requested), with standard errors
+    global_result = model.result
+    other_multipliers = dict(model.other_multipliers)
+
+    refinement = refine_fit(model, multipliers = ['factor1'] if refine_factor1 else (), print_results = True)
+
+    if refinement['error'] > global_result.fun:
+        model.result = global_result
+        model.other_multipliers = other_multipliers
 
     model.visualize_optimization_results()
 
@@ -1,7 +1,9 @@
 import numpy as np
 import matplotlib.pyplot as plt
 
-from pyKES.reaction_ODE import parse_reactions, solve_ode_system, plot_solution
+from pyKES.reaction_ODE import plot_solution
+
+from simultaneous_detection.fitting.compiled_network import compile_network
 
 def main():
 
@@ -26,10 +28,10 @@ def main():
 
     times = np.linspace(0, 12000, 10000)
 
-    parsed_reactions, species = parse_reactions(reactions)
+    network = compile_network(reactions)
+    species = network.species
 
-    solution = solve_ode_system(parsed_reactions, species, rate_constants, 
-                                initial_conditions, times, other_multipliers)
+    solution = network.solve(rate_constants, initial_conditions, times, other_multipliers)
     
 
     # print(species)
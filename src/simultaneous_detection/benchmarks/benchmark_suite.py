@@ -0,0 +1,367 @@
+import os
+import sys
+import json
+import socket
+import timeit
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime
+from importlib import metadata
+
+import numpy as np
+import pandas as pd
+
+from pyKES.database.database_experiments import Experiment
+from pyKES.utilities.harmonize_time_series import harmonize_time_series
+
+from simultaneous_detection.data_parsing.raw_data_reading_functions import reading_H2_file, reading_O2_file, O2_CHANNEL_MAPPING
+from simultaneous_detection.data_parsing.data_processing import convert_gases_to_umol_L, processing_data, fitting_wrapper
+from simultaneous_detection.data_parsing.processing_parameters import PROCESSING_PARAMETERS
+from simultaneous_detection.data_parsing.parsing_O2_H2_data import (FITTING_CONFIGURATIONS,
+                                                                   metadata_retrival_function,
+                                                                   raw_data_files,
+                                                                   signal_processing_specifications)
+from simultaneous_detection.data_parsing.synthetic_data import simulate_raw_data, write_uniamp_file, write_firesting_file
+from simultaneous_detection.analysis.arrhenius_analysis import arrhenius_analysis
+
+BENCHMARK_DIRECTORY = 'data/benchmarks'
+
+BENCHMARK_EXPERIMENT = 'NB-316'
+
+REGRESSION_THRESHOLD = 0.10
+
+PACKAGES = ['numpy', 'scipy', 'pandas', 'pyKES', 'h5py', 'pyarrow']
+
+def machine_info():
+    '''
+    Machine, Python, package versions and git commit of a benchmark run.
+    '''
+
+    packages = {}
+
+    for package in PACKAGES:
+        try:
+            packages[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            packages[package] = None
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, text = True,
+                                cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {'timestamp': datetime.now().isoformat(timespec = 'seconds'),
+            'hostname': socket.gethostname(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'packages': packages,
+            'git_commit': commit}
+
+def time_function(function, repeat = 5, min_time = 0.2):
+    '''
+    Timing function() with timeit: the number of calls per measurement is chosen so that a
+    measurement takes at least min_time seconds (at least one call), and repeat measurements
+    are made. Returns statistics of the time per call in seconds.
+    '''
+
+    timer = timeit.Timer(function)
+    number = 1
+
+    while True:
+        duration = timer.timeit(number)
+        if duration >= min_time or number >= 1e6:
+            break
+        number = max(number * 2, int(number * min_time / max(duration, 1e-9)))
+
+    times = [duration / number] + [value / number for value in timer.repeat(repeat = repeat - 1, number = number)]
+
+    return {'min': min(times),
+            'median': statistics.median(times),
+            'mean': statistics.mean(times),
+            'stdev': statistics.stdev(times) if len(times) > 1 else 0.0,
+            'number': number,
+            'repeat': repeat}
+
+def synthetic_metadata(mode = 'liquid', irradiation_start = 600.0, irradiation_end = 2400.0):
+    '''
+    Metadata of a synthetic experiment as returned by metadata_retrival_function.
+    '''
+
+    return {'experiment_name': f'Synthetic_{mode}',
+            'Experiment': f'Synthetic_{mode}',
+            'File name H2': f'Synthetic_{mode}.csv',
+            'File name O2': f'Synthetic_{mode}.txt',
+            'group': 'Gas phase' if mode == 'gas' else 'Synthetic',
+            'Unisense Irradiation start [s]': irradiation_start,
+            'Unisense Irradiation end [s]': irradiation_end,
+            'Pyroscience Irradiation start [s]': irradiation_start,
+            'Pyroscience Irradiation end [s]': irradiation_end,
+            'Liquid phase volume [mL]': 25.0,
+            'Gas phase volume [mL]': 58.0}
+
+def processing_arguments(raw_data_dict, metadata_dict):
+    '''
+    Keyword arguments of processing_data for the H2 and O2 traces of an experiment,
+    as {prefix: kwargs}.
+    '''
+
+    arguments = {}
+
+    for parameters_key, prefix, time_key, data_key, sensor in signal_processing_specifications(metadata_dict):
+        arguments[prefix] = dict(time = raw_data_dict[time_key],
+                                 data = raw_data_dict[data_key],
+                                 start = metadata_dict[f'{sensor} Irradiation start [s]'],
+                                 end = metadata_dict[f'{sensor} Irradiation end [s]'],
+                                 prefix = prefix,
+                                 liquid_phase_volume = metadata_dict['Liquid phase volume [mL]'],
+                                 gas_phase_volume = metadata_dict['Gas phase volume [mL]'],
+                                 **PROCESSING_PARAMETERS[parameters_key])
+
+    return arguments
+
+def synthetic_experiment(raw_data_dict, metadata_dict):
+    '''
+    Experiment with the processed and aligned data of a liquid phase experiment, as built by
+    processing_function before fitting. Returns the experiment and the common time.
+    '''
+
+    processed_data_dict = {}
+
+    for arguments in processing_arguments(raw_data_dict, metadata_dict).values():
+        processed_data_dict |= processing_data(**arguments)
+
+    common_time, H2_data_aligned, O2_data_aligned = harmonize_time_series(processed_data_dict['H2_time_reaction'],
+                                                                          processed_data_dict['H2_data_reaction'],
+                                                                          processed_data_dict['O2_time_reaction'],
+                                                                          processed_data_dict['O2_data_reaction'])
+
+    processed_data_dict['common_time_reaction'] = common_time
+    processed_data_dict['flexible_diff_time'] = common_time[1:]
+    processed_data_dict['H2_data_aligned'] = H2_data_aligned
+    processed_data_dict['O2_data_aligned'] = O2_data_aligned
+
+    experiment = Experiment(experiment_name = metadata_dict['experiment_name'],
+                            raw_data_file = metadata_dict['File name H2'],
+                            color = 'black',
+                            group = metadata_dict['group'],
+                            metadata = metadata_dict,
+                            raw_data = raw_data_dict,
+                            processed_data = processed_data_dict)
+
+    return experiment, common_time
+
+def benchmark_cases(directory, overview_file, experiment_name, include_fits = True, size = 20000):
+    '''
+    The benchmarked functions as (name, function, repeat). Synthetic sensor files are written to
+    directory; the bundled raw data of experiment_name is used if the overview file and the raw
+    data files exist. size is the number of samples of the synthetic traces.
+    '''
+
+    cases = []
+
+    # Parsing
+    for mode in ('liquid', 'gas'):
+        raw_data_dict = simulate_raw_data(duration = float(size), mode = mode)
+        H2_key = 'H2_Pa' if mode == 'gas' else 'H2_umol_L'
+        file_H2 = os.path.join(directory, f'synthetic_{mode}.csv')
+        write_uniamp_file(file_H2, raw_data_dict['H2_time_s'], raw_data_dict[H2_key],
+                          raw_data_dict['H2_temperature'], np.full(size, 1000.0), mode = mode)
+        cases.append((f'parsing/reading_H2_file/synthetic_{mode}', lambda file_H2 = file_H2, mode = mode: reading_H2_file(file_H2, mode = mode), 5))
+
+    raw_data_dict = simulate_raw_data(duration = float(size))
+
+    for channel in O2_CHANNEL_MAPPING:
+        file_O2 = os.path.join(directory, f'synthetic_channel_{channel}.txt')
+        write_firesting_file(file_O2, raw_data_dict['O2_time_s'], raw_data_dict['O2_data'],
+                             raw_data_dict['O2_temperature'], channel)
+        cases.append((f'parsing/reading_O2_file/synthetic_channel_{channel}', lambda file_O2 = file_O2, channel = channel: reading_O2_file(file_O2, channel), 5))
+
+    bundled = None
+
+    if os.path.exists(overview_file):
+        metadata_dict = metadata_retrival_function(experiment_name, pd.read_excel(overview_file))
+        file_H2, file_O2 = raw_data_files(metadata_dict)
+
+        if os.path.exists(file_H2) and os.path.exists(file_O2):
+            bundled = metadata_dict
+            H2_mode = 'gas' if 'Gas phase' in metadata_dict['group'] else 'liquid'
+            O2_channel = 4 if H2_mode == 'gas' else 2
+            cases.append((f'parsing/reading_H2_file/{experiment_name}', lambda: reading_H2_file(file_H2, mode = H2_mode), 5))
+            cases.append((f'parsing/reading_O2_file/{experiment_name}', lambda: reading_O2_file(file_O2, O2_channel), 5))
+
+    if bundled is None:
+        print(f'Bundled raw data of {experiment_name} not found, only synthetic data is benchmarked.')
+
+    # Conversion
+    readings = np.random.default_rng(0).uniform(0, 2000, 1_000_000)
+    cases.append(('conversion/convert_gases_to_umol_L/H2_1e6', lambda: convert_gases_to_umol_L(readings, 10.0, 20.0, H2 = True), 5))
+    cases.append(('conversion/convert_gases_to_umol_L/O2_1e6', lambda: convert_gases_to_umol_L(readings, 10.0, 20.0), 5))
+
+    # Signal processing and alignment
+    datasets = {mode: (simulate_raw_data(duration = float(size), irradiation_start = 0.1 * size, irradiation_end = 0.8 * size,
+                                         mode = mode),
+                       synthetic_metadata(mode, 0.1 * size, 0.8 * size))
+                for mode in ('liquid', 'gas')}
+
+    for mode, (raw_data_dict, metadata_dict) in datasets.items():
+        for prefix, arguments in processing_arguments(raw_data_dict, metadata_dict).items():
+            cases.append((f'processing/processing_data/synthetic_{prefix}', lambda arguments = arguments: processing_data(**arguments), 5))
+
+    processed = {prefix: processing_data(**arguments)
+                 for prefix, arguments in processing_arguments(*datasets['liquid']).items()}
+    alignment_arguments = (processed['H2']['H2_time_reaction'], processed['H2']['H2_data_reaction'],
+                           processed['O2']['O2_time_reaction'], processed['O2']['O2_data_reaction'])
+    cases.append(('alignment/harmonize_time_series/synthetic', lambda: harmonize_time_series(*alignment_arguments), 5))
+
+    # Fitting, on a shorter experiment as in the bundled data (the fits scale with the common time)
+    if include_fits:
+        experiment, common_time = synthetic_experiment(simulate_raw_data(), synthetic_metadata())
+
+        for fitting_configuration in FITTING_CONFIGURATIONS:
+            cases.append((f"fitting/fitting_wrapper/{fitting_configuration['general_prefix']}",
+                          lambda fitting_configuration = fitting_configuration: fitting_wrapper(
+                              experiment,
+                              fitting_configuration['fitting_parameters'],
+                              fitting_configuration['parameters_mapping'],
+                              {},
+                              common_time,
+                              general_prefix = fitting_configuration['general_prefix'],
+                              fit_cache_directory = None),
+                          3))
+
+    # Analysis
+    temperatures = np.array([10.0, 20.0, 30.0, 40.0, 50.0])
+    rates = 1e3 * np.exp(-50e3 / (8.314 * (temperatures + 273.15)))
+    cases.append(('analysis/arrhenius_analysis', lambda: arrhenius_analysis(temperatures, rates, 0.05 * rates), 5))
+
+    return cases
+
+def run_benchmarks(output_directory = BENCHMARK_DIRECTORY,
+                   overview_file = 'data/251204_O2_H2_Experiment_Overview.xlsx',
+                   experiment_name = BENCHMARK_EXPERIMENT,
+                   include_fits = True,
+                   size = 20000,
+                   select = None,
+                   min_time = 0.2):
+    '''
+    Running the benchmark suite and saving the results with the machine info as JSON in
+    output_directory. select is a substring of the benchmark names to run (e.g. 'parsing/').
+    Returns the path of the results file.
+
+    Usage:
+        results_file = run_benchmarks()
+        compare_benchmarks('data/benchmarks/baseline.json', results_file)
+    '''
+
+    results = {'machine': machine_info(),
+               'settings': {'size': size, 'include_fits': include_fits, 'min_time': min_time,
+                            'experiment_name': experiment_name},
+               'benchmarks': {}}
+
+    with tempfile.TemporaryDirectory() as directory:
+        cases = benchmark_cases(directory, overview_file, experiment_name, include_fits = include_fits, size = size)
+
+        for name, function, repeat in cases:
+            if select is not None and select not in name:
+                continue
+
+            results['benchmarks'][name] = time_function(function, repeat = repeat, min_time = min_time)
+            print(f"{name:<60} {results['benchmarks'][name]['min'] * 1e3:12.3f} ms")
+
+    os.makedirs(output_directory, exist_ok = True)
+    results_file = os.path.join(output_directory, f'{datetime.now():%y%m%d_%H%M%S}_benchmarks.json')
+
+    with open(results_file, 'w') as file:
+        json.dump(results, file, indent = 2)
+
+    print(f'Benchmark results saved to {results_file}')
+
+    return results_file
+
+def compare_benchmarks(baseline_file, current_file, threshold = REGRESSION_THRESHOLD):
+    '''
+    Comparing the minimum times of two benchmark runs. A benchmark regressed if it is slower by
+    more than threshold (relative). Prints a table and returns the names of the regressed benchmarks.
+    '''
+
+    with open(baseline_file) as file:
+        baseline = json.load(file)
+    with open(current_file) as file:
+        current = json.load(file)
+
+    for key in ('hostname', 'processor', 'python', 'packages'):
+        if baseline['machine'].get(key) != current['machine'].get(key):
+            print(f"Warning: the runs differ in {key} ({baseline['machine'].get(key)} vs. {current['machine'].get(key)})")
+
+    regressions = []
+    names = list(baseline['benchmarks']) + [name for name in current['benchmarks'] if name not in baseline['benchmarks']]
+
+    print(f"{'Benchmark':<60} {'Baseline [ms]':>14} {'Current [ms]':>14} {'Change':>9}")
+
+    for name in names:
+        if name not in current['benchmarks']:
+            print(f"{name:<60} {baseline['benchmarks'][name]['min'] * 1e3:14.3f} {'removed':>14}")
+            continue
+        if name not in baseline['benchmarks']:
+            print(f"{name:<60} {'new':>14} {current['benchmarks'][name]['min'] * 1e3:14.3f}")
+            continue
+
+        before, after = baseline['benchmarks'][name]['min'], current['benchmarks'][name]['min']
+        change = after / before - 1
+        flag = ''
+
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        elif change < -threshold:
+            flag = '  faster'
+
+        print(f'{name:<60} {before * 1e3:14.3f} {after * 1e3:14.3f} {change:+9.1%}{flag}')
+
+    print(f'{len(regressions)} regression(s) above {threshold:.0%}')
+
+    return regressions
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Benchmarks of the parsing, processing and fitting pipeline.')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+    run_parser = subparsers.add_parser('run', help = 'run the benchmark suite')
+    run_parser.add_argument('--output-directory', default = BENCHMARK_DIRECTORY)
+    run_parser.add_argument('--overview-file', default = 'data/251204_O2_H2_Experiment_Overview.xlsx')
+    run_parser.add_argument('--experiment', default = BENCHMARK_EXPERIMENT)
+    run_parser.add_argument('--size', type = int, default = 20000, help = 'samples of the synthetic traces')
+    run_parser.add_argument('--select', default = None, help = 'only benchmarks whose name contains this')
+    run_parser.add_argument('--min-time', type = float, default = 0.2, help = 'minimum seconds per measurement')
+    run_parser.add_argument('--no-fits', action = 'store_true', help = 'skip the fitting benchmarks')
+
+    compare_parser = subparsers.add_parser('compare', help = 'compare two benchmark runs')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type = float, default = REGRESSION_THRESHOLD)
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run_benchmarks(output_directory = args.output_directory,
+                       overview_file = args.overview_file,
+                       experiment_name = args.experiment,
+                       include_fits = not args.no_fits,
+                       size = args.size,
+                       select = args.select,
+                       min_time = args.min_time)
+    else:
+        regressions = compare_benchmarks(args.baseline, args.current, threshold = args.threshold)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
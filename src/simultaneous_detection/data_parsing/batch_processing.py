@@ -0,0 +1,251 @@
+import os
+import time
+import inspect
+import traceback
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from pyKES.database.database_experiments import Experiment
+from pyKES.database.data_processing import stamp_experiment_version, finalize_processing_run
+
+from simultaneous_detection.data_parsing import raw_data_reading_functions
+from simultaneous_detection.data_parsing.instrumentation import INSTRUMENTATION_RECORDS, collect_records
+from simultaneous_detection.fitting import fit_cache
+
+@contextmanager
+def stage_timer(timings, stage):
+    '''
+    Recording the wall time of a processing stage in timings[stage] (seconds).
+    Does nothing if timings is None.
+    '''
+
+    if timings is None:
+        yield
+        return
+
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+def process_single_experiment(experiment_name,
+                              overview_df,
+                              metadata_retrival_function,
+                              raw_data_reading_function,
+                              processing_function):
+    '''
+    Reading, processing and fitting one experiment, run inside a worker process.
+    Never raises: failures are returned with their traceback, so that one failing experiment
+    does not abort the batch. Besides the Experiment, the result holds the stage timings,
+    the raw data and fit cache hits and misses and the instrumentation records (see
+    instrumentation.instrument) of this experiment.
+    '''
+
+    timings = {}
+    records_start = len(INSTRUMENTATION_RECORDS)
+    cache_statistics_before = dict(raw_data_reading_functions.RAW_DATA_CACHE_STATISTICS)
+    fit_cache_statistics_before = dict(fit_cache.FIT_CACHE_STATISTICS)
+    start = time.perf_counter()
+
+    result = {'experiment': experiment_name,
+              'success': False,
+              'timings': timings}
+
+    try:
+        metadata_dict = metadata_retrival_function(experiment_name, overview_df)
+
+        with stage_timer(timings, 'read'):
+            raw_data_dict = raw_data_reading_function(experiment_name, metadata_dict)
+
+        # processing_function records its own sub-stages (signal processing, fits) if it accepts timings
+        if 'timings' in inspect.signature(processing_function).parameters:
+            processed_data_dict = processing_function(raw_data_dict, metadata_dict, timings = timings)
+        else:
+            with stage_timer(timings, 'processing'):
+                processed_data_dict = processing_function(raw_data_dict, metadata_dict)
+
+        experiment = Experiment(
+            experiment_name = metadata_dict['experiment_name'],
+            raw_data_file = experiment_name,
+            color = metadata_dict.get('color', 'black'),
+            group = metadata_dict.get('group', 'default'),
+            metadata = metadata_dict,
+            raw_data = raw_data_dict,
+            processed_data = processed_data_dict
+        )
+        stamp_experiment_version(experiment)
+
+        result['success'] = True
+        result['data'] = experiment
+
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+        result['traceback'] = traceback.format_exc()
+
+    timings['total'] = time.perf_counter() - start
+    result['raw_data_cache'] = {key: raw_data_reading_functions.RAW_DATA_CACHE_STATISTICS[key] - value
+                                for key, value in cache_statistics_before.items()}
+    result['fit_cache'] = {key: fit_cache.FIT_CACHE_STATISTICS[key] - value
+                           for key, value in fit_cache_statistics_before.items()}
+    result['instrumentation'] = collect_records(records_start)
+
+    return result
+
+def print_progress(completed, total, result, start_time):
+    '''
+    Printing one line of progress after an experiment finished.
+    '''
+
+    status = 'done' if result['success'] else 'FAILED'
+    elapsed = time.perf_counter() - start_time
+
+    print(f"[{completed}/{total}] {result['experiment']} {status} in {result['timings']['total']:.1f} s "
+          f"(elapsed {elapsed:.1f} s)", flush = True)
+
+def run_batch(dataset,
+              metadata_retrival_function,
+              raw_data_reading_function,
+              processing_function,
+              experiment_names = None,
+              workers = None,
+              progress = True):
+    '''
+    Processing the experiments of dataset.overview_df in a process pool and adding the
+    successful ones to the dataset.
+
+    Parameters
+    ----------
+    dataset : ExperimentalDataset
+        Dataset whose overview_df lists the experiments; mutated in place.
+    metadata_retrival_function, raw_data_reading_function, processing_function : callable
+        Same functions as for pyKES read_in_experiments_multiprocessing. If processing_function
+        accepts a timings keyword, it is passed a dict to record its sub-stages in (see stage_timer).
+    experiment_names : list of str, optional
+        Experiments to process, defaults to all experiments in the overview sheet.
+    workers : int, optional
+        Number of worker processes, defaults to the number of CPUs. With workers = 1 the
+        experiments are processed in the current process.
+    progress : bool, optional
+        Print a line per finished experiment.
+
+    Returns
+    -------
+    results : list of dict
+        One result per experiment, in overview order, see process_single_experiment.
+    '''
+
+    if experiment_names is None:
+        experiment_names = dataset.overview_df['Experiment'].tolist()
+
+    workers = workers or os.cpu_count()
+    total = len(experiment_names)
+    start_time = time.perf_counter()
+
+    function_arguments = (dataset.overview_df,
+                          metadata_retrival_function,
+                          raw_data_reading_function,
+                          processing_function)
+
+    results_by_name = {}
+
+    if workers == 1:
+        for completed, experiment_name in enumerate(experiment_names, start = 1):
+            result = process_single_experiment(experiment_name, *function_arguments)
+            results_by_name[experiment_name] = result
+
+            if progress:
+                print_progress(completed, total, result, start_time)
+
+    else:
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            futures = [executor.submit(process_single_experiment, experiment_name, *function_arguments)
+                       for experiment_name in experiment_names]
+
+            for completed, future in enumerate(as_completed(futures), start = 1):
+                result = future.result()
+                results_by_name[result['experiment']] = result
+
+                if progress:
+                    print_progress(completed, total, result, start_time)
+
+    results = [results_by_name[experiment_name] for experiment_name in experiment_names]
+
+    for result in results:
+        if result['success']:
+            dataset.add_experiment(result['data'])
+
+    finalize_processing_run(dataset, results)
+
+    return results
+
+def timing_table(results):
+    '''
+    Per-experiment timings (seconds) as a DataFrame, one row per experiment and one
+    column per stage, sorted by total time. Failed experiments keep their error message.
+    Without results (e.g. an incremental rebuild that only removed experiments) the
+    table is empty.
+    '''
+
+    if not results:
+        return pd.DataFrame(columns = ['Experiment', 'success', 'read', 'total', 'error'])
+
+    rows = []
+
+    for result in results:
+        row = {'Experiment': result['experiment'],
+               'success': result['success'],
+               **result['timings']}
+        row['error'] = result.get('error', '')
+        rows.append(row)
+
+    table = pd.DataFrame(rows)
+
+    return table.sort_values('total', ascending = False, ignore_index = True)
+
+def failure_report(results):
+    '''
+    Printing the errors of all failed experiments with their tracebacks.
+    Returns the failed results.
+    '''
+
+    failures = [result for result in results if not result['success']]
+
+    if not failures:
+        print(f'All {len(results)} experiments processed successfully.')
+        return failures
+
+    print(f'{len(failures)} of {len(results)} experiments failed:')
+
+    for result in failures:
+        print('-----------------------------------')
+        print(f"{result['experiment']}: {result['error']}")
+        print(result['traceback'])
+
+    return failures
+
+def raw_data_cache_statistics(results):
+    '''
+    Summing the raw data cache hits and misses reported by the workers.
+    '''
+
+    return {key: sum(result['raw_data_cache'][key] for result in results)
+            for key in ('hits', 'misses')}
+
+def fit_cache_statistics(results):
+    '''
+    Summing the fit cache hits and misses reported by the workers.
+    '''
+
+    return {key: sum(result['fit_cache'][key] for result in results)
+            for key in ('hits', 'misses')}
+
+def instrumentation_records(results):
+    '''
+    Joining the instrumentation records reported by the workers.
+    '''
+
+    return [record for result in results for record in result['instrumentation']]
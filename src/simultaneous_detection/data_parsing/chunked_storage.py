@@ -0,0 +1,272 @@
+import os
+import json
+import pickle
+import hashlib
+
+import h5py
+import numpy as np
+
+from pyKES.database.database_experiments import (Experiment,
+                                                 ExperimentalDataset,
+                                                 load_nested_dict_from_hdf5,
+                                                 write_df_to_hdf,
+                                                 SCHEMA_VERSION)
+
+from simultaneous_detection.fitting.fit_cache import canonical_value
+from simultaneous_detection.data_parsing.incremental_rebuild import FINGERPRINT_ATTRIBUTE
+
+try:
+    import hdf5plugin
+    HDF5PLUGIN_AVAILABLE = True
+except ImportError:
+    HDF5PLUGIN_AVAILABLE = False
+
+CONTENT_HASH_ATTRIBUTE = 'content_hash'
+LAYOUT_ATTRIBUTE = 'storage_layout'
+CHUNK_SIZE = 16384 # elements along the first axis, 128 kB of float64
+COMPRESSION_MIN_SIZE = 256 # smaller arrays are stored contiguous and uncompressed
+
+def compression_options(array, compression = 'gzip'):
+    '''
+    create_dataset keyword arguments for an array: chunked along the first axis and compressed
+    with a byte shuffle, using gzip (readable by every HDF5 installation) or, opt-in,
+    blosc/zstd (faster and smaller, but writers and readers need hdf5plugin).
+    Scalars, small and non-numeric arrays, and compression = None are stored as before.
+    '''
+
+    if compression is None or array.ndim == 0 or array.size < COMPRESSION_MIN_SIZE or array.dtype.kind not in 'biufc':
+        return {}
+
+    chunks = (min(array.shape[0], CHUNK_SIZE),) + array.shape[1:]
+
+    if compression == 'zstd':
+        if not HDF5PLUGIN_AVAILABLE:
+            raise ImportError("compression = 'zstd' requires hdf5plugin (pip install hdf5plugin), use 'gzip' without it")
+        return {'chunks': chunks, **hdf5plugin.Blosc(cname = 'zstd', clevel = 5, shuffle = hdf5plugin.Blosc.SHUFFLE)}
+
+    if compression != 'gzip':
+        raise ValueError(f"Unknown compression: {compression} (use 'gzip', 'zstd' or None)")
+
+    return {'chunks': chunks, 'compression': 'gzip', 'compression_opts': 4, 'shuffle': True}
+
+def save_nested_dict_compressed(group, data_dict, compression = 'gzip', prefix = ''):
+    '''
+    pyKES save_nested_dict_to_hdf5 with arrays written through compression_options.
+    The encoding of all other values is unchanged, so the groups are read by
+    load_nested_dict_from_hdf5 and LazyExperimentalDataset as before.
+    '''
+
+    for key, value in data_dict.items():
+        safe_key = str(key).replace('/', '__SLASH__')
+        full_key = f'{prefix}/{safe_key}' if prefix else safe_key
+
+        if isinstance(value, np.ndarray):
+            group.create_dataset(full_key, data = value, **compression_options(value, compression))
+
+        elif isinstance(value, dict):
+            save_nested_dict_compressed(group, value, compression, full_key)
+
+        elif isinstance(value, (str, int, float, bool, np.bool_)):
+            if isinstance(value, str):
+                group.create_dataset(full_key, data = value.encode('utf-8'))
+            elif isinstance(value, (bool, np.bool_)):
+                group.create_dataset(full_key, data = int(value))
+                group[full_key].attrs['type'] = 'bool'
+            else:
+                group.create_dataset(full_key, data = value)
+
+        elif isinstance(value, (list, tuple)):
+            try:
+                array = np.array(value)
+                group.create_dataset(full_key, data = array, **compression_options(array, compression))
+            except Exception:
+                group.create_dataset(full_key, data = json.dumps(value).encode('utf-8'))
+                group[full_key].attrs['type'] = 'json'
+
+        else:
+            try:
+                group.create_dataset(full_key, data = json.dumps(value).encode('utf-8'))
+                group[full_key].attrs['type'] = 'json'
+            except Exception:
+                group.create_dataset(full_key, data = np.frombuffer(pickle.dumps(value), dtype = np.uint8))
+                group[full_key].attrs['type'] = 'pickle'
+
+def experiment_content_hash(experiment):
+    '''
+    Hash of everything stored in the group of an experiment (see fit_cache.canonical_value),
+    to skip rewriting groups whose content did not change.
+    '''
+
+    content = {'experiment_name': experiment.experiment_name,
+               'raw_data_file': experiment.raw_data_file,
+               'color': experiment.color,
+               'group': experiment.group,
+               'raw_data': experiment.raw_data,
+               'metadata': experiment.metadata,
+               'processed_data': experiment.processed_data}
+
+    serialized = json.dumps(canonical_value(content), sort_keys = True, default = str)
+
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+def write_experiment_group(h5_file, experiment, compression = 'gzip', fingerprint = None, content_hash = None):
+    '''
+    Writing one experiment group in the layout of ExperimentalDataset.save_to_hdf5 with
+    compressed arrays, replacing an existing group of the same name.
+    '''
+
+    exp_name = experiment.experiment_name
+
+    if exp_name in h5_file:
+        del h5_file[exp_name]
+
+    exp_grp = h5_file.create_group(exp_name)
+    exp_grp.attrs['experiment_name'] = experiment.experiment_name
+    exp_grp.attrs['raw_data_file'] = experiment.raw_data_file
+    exp_grp.attrs['color'] = experiment.color
+    exp_grp.attrs['group'] = experiment.group
+    exp_grp.attrs[CONTENT_HASH_ATTRIBUTE] = content_hash or experiment_content_hash(experiment)
+
+    if experiment.version:
+        exp_grp.attrs['version'] = json.dumps(experiment.version)
+
+    if fingerprint is not None:
+        exp_grp.attrs[FINGERPRINT_ATTRIBUTE] = fingerprint
+
+    for data_group_name in ('raw_data', 'metadata', 'processed_data'):
+        data_dict = getattr(experiment, data_group_name)
+
+        if data_dict:
+            save_nested_dict_compressed(exp_grp.create_group(data_group_name), data_dict, compression)
+
+def open_dataset_file(filename):
+    '''
+    Opening a dataset file for writing. New files are created with a persistent free-space
+    manager, so that the space of rewritten or deleted groups is reused in later sessions
+    instead of growing the file.
+    '''
+
+    if os.path.exists(filename):
+        return h5py.File(filename, 'a')
+
+    return h5py.File(filename, 'w', libver = 'latest', fs_strategy = 'fsm', fs_persist = True, fs_threshold = 1)
+
+def save_dataset_chunked(dataset,
+                         filename,
+                         fingerprints = None,
+                         removed_experiments = None,
+                         compression = 'gzip'):
+    '''
+    Saving an ExperimentalDataset with one compressed group per experiment (see
+    write_experiment_group), writing only the groups whose content changed: experiments
+    whose stored content hash equals the current one only get their version (and
+    fingerprint) attributes updated, so a save costs in proportion to the changes. With
+    removed_experiments = None all groups not in dataset.experiments are deleted (the
+    result of a full save_to_hdf5; an existing file of save_to_hdf5 is replaced), otherwise
+    only the listed ones (incremental rebuilds, where dataset holds only the changed
+    experiments). The overview sheet and dataset-level dictionaries are always rewritten.
+    Rewritten groups use compression, so saving with another compression than before
+    leaves a file with mixed filters.
+    Returns {'written': [...], 'unchanged': [...], 'removed': [...]}.
+    '''
+
+    fingerprints = fingerprints or {}
+    summary = {'written': [], 'unchanged': [], 'removed': []}
+
+    # A full save replaces files written by save_to_hdf5, whose free space would not be reused
+    if removed_experiments is None and os.path.exists(filename):
+        with h5py.File(filename, 'r') as f:
+            chunked = f.attrs.get(LAYOUT_ATTRIBUTE) == 'chunked'
+        if not chunked:
+            os.remove(filename)
+
+    with open_dataset_file(filename) as f:
+
+        if removed_experiments is None:
+            removed_experiments = [exp_name for exp_name in f.keys()
+                                   if exp_name != 'overview_df' and exp_name not in dataset.experiments]
+
+        for exp_name in removed_experiments:
+            if exp_name in f:
+                del f[exp_name]
+                summary['removed'].append(exp_name)
+
+        for exp_name, experiment in dataset.experiments.items():
+            content_hash = experiment_content_hash(experiment)
+
+            if exp_name in f and f[exp_name].attrs.get(CONTENT_HASH_ATTRIBUTE) == content_hash:
+                # The version carries the time of processing, so it is updated but not hashed
+                if experiment.version:
+                    f[exp_name].attrs['version'] = json.dumps(experiment.version)
+                if exp_name in fingerprints:
+                    f[exp_name].attrs[FINGERPRINT_ATTRIBUTE] = fingerprints[exp_name]
+                summary['unchanged'].append(exp_name)
+                continue
+
+            write_experiment_group(f, experiment, compression, fingerprints.get(exp_name), content_hash)
+            summary['written'].append(exp_name)
+
+        if not dataset.overview_df.empty:
+            write_df_to_hdf(f, dataset.overview_df, key = 'overview_df')
+
+        f.attrs['schema_version'] = SCHEMA_VERSION
+        f.attrs['version'] = json.dumps(dataset.stamp_version())
+        f.attrs[LAYOUT_ATTRIBUTE] = 'chunked'
+
+        if dataset.plotting_instruction:
+            f.attrs['plotting_instruction'] = json.dumps(dataset.plotting_instruction)
+        if dataset.group_mapping:
+            f.attrs['group_mapping'] = json.dumps(dataset.group_mapping)
+        if dataset.processing_parameters:
+            f.attrs['processing_parameters'] = json.dumps(dataset.processing_parameters)
+
+    print(f"Saved {filename}: {len(summary['written'])} experiments written, "
+          f"{len(summary['unchanged'])} unchanged, {len(summary['removed'])} removed")
+
+    return summary
+
+def read_experiment(filename, experiment_name):
+    '''
+    Reading a single experiment of a dataset file as pyKES Experiment, without touching the
+    other groups (for lazy access to many experiments see lazy_dataset.LazyExperimentalDataset).
+    '''
+
+    with h5py.File(filename, 'r') as f:
+        if experiment_name not in f:
+            raise KeyError(f'No experiment {experiment_name} in {filename}')
+
+        exp_group = f[experiment_name]
+
+        experiment = Experiment(
+            experiment_name = exp_group.attrs['experiment_name'],
+            raw_data_file = exp_group.attrs['raw_data_file'],
+            color = exp_group.attrs['color'],
+            group = exp_group.attrs.get('group', 'default'),
+            **{data_group_name: load_nested_dict_from_hdf5(exp_group[data_group_name]) if data_group_name in exp_group else {}
+               for data_group_name in ('raw_data', 'metadata', 'processed_data')}
+        )
+
+        if 'version' in exp_group.attrs:
+            experiment.version = json.loads(exp_group.attrs['version'])
+
+    return experiment
+
+def convert_to_chunked(input_file, output_file, compression = 'gzip'):
+    '''
+    Rewriting a dataset file of ExperimentalDataset.save_to_hdf5 (e.g. the snapshots in
+    data/Old_Data) in the chunked, compressed layout. Also compacts files whose groups were
+    rewritten many times. Returns the sizes of both files in bytes.
+    '''
+
+    dataset = ExperimentalDataset.load_from_hdf5(input_file)
+
+    with h5py.File(input_file, 'r') as f:
+        fingerprints = {exp_name: f[exp_name].attrs[FINGERPRINT_ATTRIBUTE]
+                        for exp_name in f.keys() if FINGERPRINT_ATTRIBUTE in f[exp_name].attrs}
+
+    if os.path.exists(output_file):
+        os.remove(output_file)
+
+    save_dataset_chunked(dataset, output_file, fingerprints, compression = compression)
+
+    return os.path.getsize(input_file), os.path.getsize(output_file)
@@ -1,3 +1,6 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 from scipy.signal import savgol_filter
 
@@ -5,7 +8,22 @@ from pyKES.utilities.find_nearest import find_nearest
 from pyKES.utilities.time_series_resampling import resample_time_series
 from pyKES.utilities.offset_correction import offset_correction
 
-from pyKES.fitting_ODE import Fitting_Model, square_loss_time_series_normalized, objective_function
+from pyKES.fitting_ODE import Fitting_Model, square_loss_time_series_normalized
+
+from simultaneous_detection.fitting.kinetic_solver import optimize, kinetic_objective_function
+from simultaneous_detection.fitting.sensitivity_refinement import refine_fit, standard_errors_at
+from simultaneous_detection.fitting.fit_cache import (FIT_CACHE_DIRECTORY,
+                                                      FIT_CACHE_STATISTICS,
+                                                      fit_cache_key,
+                                                      cached_fit,
+                                                      store_fit)
+
+from simultaneous_detection.data_parsing.warm_start import warm_started_optimize
+from simultaneous_detection.data_parsing.instrumentation import (INSTRUMENTATION_RECORDS,
+                                                                 instrumented,
+                                                                 record_objective_evaluations,
+                                                                 collect_records,
+                                                                 merge_records)
 
 def convert_gases_to_umol_L(data,
                             liquid_phase_volume,
@@ -29,6 +47,7 @@ def convert_gases_to_umol_L(data,
 
     return gas_umol_L
 
+@instrumented(detail = 'prefix')
 def processing_data(time,
                     data,
                     offset,
@@ -91,6 +110,7 @@ def processing_data(time,
 
     return processed_data
 
+@instrumented(detail = 'general_prefix')
 def fitting_wrapper(experiment,
                     fitting_parameters,
                     parameters_mapping,
@@ -98,8 +118,20 @@ def fitting_wrapper(experiment,
                     common_time,
                     print_results = False,
                     disp = False,
-                    general_prefix = ''):
+                    general_prefix = '',
+                    warm_start = None,
+                    refine = True,
+                    fit_cache_directory = FIT_CACHE_DIRECTORY):
     '''
+    With warm_start ({'rate_constants': dict, 'fitting_error': float or None}, see
+    warm_start.warm_start_for_experiment) the fit starts from previously optimized rate
+    constants, see warm_start.warm_started_optimize.
+    With refine = True the optimized rate constants are refined locally with analytic
+    sensitivities (see sensitivity_refinement.refine_fit), kept if the fitting error does
+    not increase, and the standard errors of the kept rate constants are stored.
+    Fits are stored in the fit cache (see fit_cache.fit_cache_key), so that a fit of the same
+    data with the same fitting parameters is read instead of repeated. With
+    fit_cache_directory = None the cache is bypassed.
     '''
     
     model = Fitting_Model(**fitting_parameters)
@@ -107,12 +139,51 @@ def fitting_wrapper(experiment,
     model.experiments = [experiment]
     model.loss_function = square_loss_time_series_normalized
 
-    model.optimize(workers = 1, print_results = print_results, disp = disp)
+    cache_key = fit_cache_key(model, refine = refine, warm_start = warm_start is not None) if fit_cache_directory is not None else None
+    fit = cached_fit(cache_key, fit_cache_directory) if cache_key is not None else None
+
+    if fit is None:
+        if warm_start is None:
+            optimize(model, print_results = print_results, disp = disp, vectorized = True)
+        else:
+            warm_started_optimize(model, warm_start, print_results = print_results, disp = disp)
+
+        standard_errors = {}
+        global_result = model.result
+        record_objective_evaluations(global_result.nfev)
+
+        if refine:
+            refinement = refine_fit(model, print_results = print_results)
+            record_objective_evaluations(refinement['result'].nfev)
+
+            if refinement['error'] > global_result.fun:
+                # Standard errors of the kept fit, not of the rejected refinement
+                model.result = global_result
+                standard_errors = standard_errors_at(model, global_result.x)['standard_errors']
+            else:
+                standard_errors = refinement['standard_errors']
 
-    error, fitting_results = objective_function(model.result.x, model, return_full = True)
+        error, fitting_results = kinetic_objective_function(model.result.x, model, return_full = True)
+
+        fit = {'x': model.result.x,
+               'error': error,
+               'trajectories': fitting_results[experiment.experiment_name],
+               'standard_errors': standard_errors}
+
+        if cache_key is not None:
+            store_fit(cache_key, fit, fit_cache_directory)
+
+    else:
+        record_objective_evaluations(0)
+
+        if print_results:
+            print(f"{general_prefix}: fit read from cache (error {fit['error']:.6g})")
+
+    if refine:
+        processed_data_dict[f'{general_prefix}_rate_constant_standard_errors'] = fit['standard_errors']
 
     for species, prefix in parameters_mapping['species_mapping'].items():
-        fit_data = fitting_results[experiment.experiment_name][species]
+        fit_data = fit['trajectories'][species]
         fit_rate_data = np.diff(fit_data) / np.diff(common_time)
 
         processed_data_dict[f'{prefix}_fit'] = fit_data
@@ -120,12 +191,88 @@ def fitting_wrapper(experiment,
         processed_data_dict[f'{prefix}_fit_max_rate'] = np.max(fit_rate_data)
 
     for prefix, rate_constant_index in parameters_mapping['rate_constant_mapping'].items():
-        processed_data_dict[f'{prefix}_rate_constant'] = model.result.x[rate_constant_index]
+        processed_data_dict[f'{prefix}_rate_constant'] = fit['x'][rate_constant_index]
 
-    rate_constants = dict(zip(model.rate_constants_to_optimize.keys(), model.result.x))
+    rate_constants = dict(zip(model.rate_constants_to_optimize.keys(), fit['x']))
     processed_data_dict[f'{general_prefix}_all_rate_constants'] = rate_constants
-    processed_data_dict[f'{general_prefix}_fitting_error'] = error
+    processed_data_dict[f'{general_prefix}_fitting_error'] = fit['error']
+
+    return processed_data_dict
+
+def fitting_task(experiment,
+                 fitting_configuration,
+                 common_time,
+                 warm_start = None):
+    '''
+    Running fitting_wrapper for one fitting configuration (see run_fitting_configurations)
+    on an empty dict, so that only the results of this fit are returned, together with
+    the wall time of the fit, its fit cache hits and misses and its instrumentation records.
+    '''
+
+    start = time.perf_counter()
+    records_start = len(INSTRUMENTATION_RECORDS)
+    cache_statistics_before = dict(FIT_CACHE_STATISTICS)
+
+    fit_results = fitting_wrapper(
+        experiment,
+        fitting_configuration['fitting_parameters'],
+        fitting_configuration['parameters_mapping'],
+        {},
+        common_time,
+        print_results = fitting_configuration.get('print_results', False),
+        general_prefix = fitting_configuration['general_prefix'],
+        warm_start = warm_start
+    )
+
+    cache_statistics = {key: FIT_CACHE_STATISTICS[key] - value for key, value in cache_statistics_before.items()}
+
+    return fit_results, time.perf_counter() - start, cache_statistics, collect_records(records_start)
+
+def run_fitting_configurations(experiment,
+                               fitting_configurations,
+                               processed_data_dict,
+                               common_time,
+                               parallel = False,
+                               timings = None,
+                               warm_starts = None):
+    '''
+    Running several independent fits of one experiment and merging their results into
+    processed_data_dict.
+    Each fitting configuration is a dict with 'fitting_parameters', 'parameters_mapping',
+    'general_prefix' and optionally 'print_results'. With parallel = True the fits run
+    concurrently in a process pool with one worker per configuration. In both cases the
+    results are merged in the order of fitting_configurations, so the output does not
+    depend on which fit finishes first. With a timings dict, the wall time of each fit is
+    recorded under its general_prefix. warm_starts maps general_prefix to the starting
+    values of that fit (see fitting_wrapper); fits without an entry start cold.
+    '''
+
+    warm_starts = warm_starts or {}
+    fit_warm_starts = [warm_starts.get(fitting_configuration['general_prefix'])
+                       for fitting_configuration in fitting_configurations]
+
+    if parallel:
+        with ProcessPoolExecutor(max_workers = len(fitting_configurations)) as executor:
+            fit_outputs = list(executor.map(fitting_task,
+                                            [experiment] * len(fitting_configurations),
+                                            fitting_configurations,
+                                            [common_time] * len(fitting_configurations),
+                                            fit_warm_starts))
+    else:
+        fit_outputs = [fitting_task(experiment, fitting_configuration, common_time, warm_start)
+                       for fitting_configuration, warm_start in zip(fitting_configurations, fit_warm_starts)]
+
+    for fitting_configuration, (fit_results, duration, cache_statistics, records) in zip(fitting_configurations, fit_outputs):
+        processed_data_dict |= fit_results
+        merge_records(records)
+
+        # Fits in worker processes are counted in this process
+        if parallel:
+            for key, value in cache_statistics.items():
+                FIT_CACHE_STATISTICS[key] += value
+
+        if timings is not None:
+            timings[fitting_configuration['general_prefix']] = duration
 
     return processed_data_dict
-    
 
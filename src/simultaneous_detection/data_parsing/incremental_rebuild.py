@@ -0,0 +1,160 @@
+import os
+import json
+import hashlib
+
+import h5py
+
+from pyKES.database.database_experiments import save_nested_dict_to_hdf5, write_df_to_hdf, SCHEMA_VERSION
+
+from simultaneous_detection.data_parsing.raw_data_reading_functions import hash_file
+
+FINGERPRINT_ATTRIBUTE = 'input_fingerprint'
+
+def experiment_fingerprint(metadata_dict,
+                           raw_data_files,
+                           processing_parameters):
+    '''
+    Fingerprint of everything that goes into processing and fitting one experiment:
+    its overview row (metadata_dict), the content hashes of its raw data files and the
+    PROCESSING_PARAMETERS sub-dicts used for it. Any change to one of them changes
+    the fingerprint.
+    '''
+
+    # Missing files are left to fail during processing, where the error is reported per experiment
+    fingerprint_input = {
+        'metadata': metadata_dict,
+        'raw_data_files': {os.path.basename(file): hash_file(file) if os.path.exists(file) else None
+                           for file in raw_data_files},
+        'processing_parameters': processing_parameters,
+    }
+
+    serialized = json.dumps(fingerprint_input, sort_keys = True, default = str)
+
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+def load_stored_fingerprints(filename):
+    '''
+    Reading the input fingerprints of all experiments stored in a dataset .h5 file
+    without loading any data. Experiments written without a fingerprint map to None.
+    '''
+
+    if not os.path.exists(filename):
+        return {}
+
+    stored_fingerprints = {}
+
+    with h5py.File(filename, 'r') as f:
+        for exp_name in f.keys():
+            if exp_name == 'overview_df':
+                continue
+
+            fingerprint = f[exp_name].attrs.get(FINGERPRINT_ATTRIBUTE)
+
+            if isinstance(fingerprint, bytes):
+                fingerprint = fingerprint.decode('utf-8')
+
+            stored_fingerprints[exp_name] = fingerprint
+
+    return stored_fingerprints
+
+def select_changed_experiments(fingerprints, stored_fingerprints):
+    '''
+    Comparing current fingerprints with those stored in an existing dataset.
+    Returns the experiments that need processing (new or changed inputs) and
+    the stored experiments that are no longer in the overview sheet.
+    '''
+
+    changed_experiments = [name for name, fingerprint in fingerprints.items()
+                           if stored_fingerprints.get(name) != fingerprint]
+    removed_experiments = [name for name in stored_fingerprints
+                           if name not in fingerprints]
+
+    return changed_experiments, removed_experiments
+
+def write_experiment_to_hdf5(h5_file, experiment, fingerprint = None):
+    '''
+    Writing one experiment group in the layout of ExperimentalDataset.save_to_hdf5,
+    replacing an existing group of the same name.
+    '''
+
+    exp_name = experiment.experiment_name
+
+    if exp_name in h5_file:
+        del h5_file[exp_name]
+
+    exp_grp = h5_file.create_group(exp_name)
+    exp_grp.attrs['experiment_name'] = experiment.experiment_name
+    exp_grp.attrs['raw_data_file'] = experiment.raw_data_file
+    exp_grp.attrs['color'] = experiment.color
+    exp_grp.attrs['group'] = experiment.group
+
+    if experiment.version:
+        exp_grp.attrs['version'] = json.dumps(experiment.version)
+
+    if fingerprint is not None:
+        exp_grp.attrs[FINGERPRINT_ATTRIBUTE] = fingerprint
+
+    for data_group_name in ('raw_data', 'metadata', 'processed_data'):
+        data_dict = getattr(experiment, data_group_name)
+
+        if data_dict:
+            data_group = exp_grp.create_group(data_group_name)
+            save_nested_dict_to_hdf5(data_group, data_dict)
+
+def write_fingerprints_to_hdf5(filename, fingerprints):
+    '''
+    Attaching input fingerprints to the experiment groups of an existing .h5 file,
+    e.g. after a full ExperimentalDataset.save_to_hdf5.
+    '''
+
+    with h5py.File(filename, 'a') as f:
+        for exp_name, fingerprint in fingerprints.items():
+            if exp_name in f:
+                f[exp_name].attrs[FINGERPRINT_ATTRIBUTE] = fingerprint
+
+def patch_experiments_in_hdf5(dataset,
+                              filename,
+                              fingerprints,
+                              removed_experiments = ()):
+    '''
+    Updating an existing dataset .h5 file in place: the experiments in dataset.experiments
+    are (re)written together with their fingerprints, removed experiments are deleted and
+    the overview sheet and dataset-level dictionaries are refreshed. All other experiment
+    groups are left untouched.
+    '''
+
+    with h5py.File(filename, 'a') as f:
+
+        for exp_name in removed_experiments:
+            if exp_name in f:
+                del f[exp_name]
+                print(f"Experiment {exp_name} removed.")
+
+        for exp_name, experiment in dataset.experiments.items():
+            write_experiment_to_hdf5(f, experiment, fingerprints.get(exp_name))
+            print(f"Experiment {exp_name} updated successfully.")
+
+        if not dataset.overview_df.empty:
+            write_df_to_hdf(f, dataset.overview_df, key = 'overview_df')
+
+        f.attrs['schema_version'] = SCHEMA_VERSION
+        f.attrs['version'] = json.dumps(dataset.stamp_version())
+
+        if dataset.plotting_instruction:
+            f.attrs['plotting_instruction'] = json.dumps(dataset.plotting_instruction)
+        if dataset.group_mapping:
+            f.attrs['group_mapping'] = json.dumps(dataset.group_mapping)
+        if dataset.processing_parameters:
+            f.attrs['processing_parameters'] = json.dumps(dataset.processing_parameters)
+
+def load_stored_version(filename):
+    '''
+    Dataset-level version dictionary of an existing .h5 file, so that an incremental
+    rebuild keeps the creation timestamp of the dataset.
+    '''
+
+    with h5py.File(filename, 'r') as f:
+        if 'version' in f.attrs:
+            return json.loads(f.attrs['version'])
+
+    return {}
@@ -0,0 +1,171 @@
+import os
+import sys
+import json
+import time
+import functools
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import resource
+    RESOURCE_AVAILABLE = True
+except ImportError:
+    RESOURCE_AVAILABLE = False
+
+INSTRUMENTATION_ENVIRONMENT_VARIABLE = 'SIMULTANEOUS_DETECTION_INSTRUMENTATION'
+
+INSTRUMENTATION = {'enabled': os.environ.get(INSTRUMENTATION_ENVIRONMENT_VARIABLE) == '1'}
+
+# Records of the instrumented calls of this process, and the calls currently running
+INSTRUMENTATION_RECORDS = []
+ACTIVE_RECORDS = []
+
+def enable_instrumentation(enabled = True):
+    '''
+    Switching the instrumentation on or off. The setting is also stored in the environment,
+    so that worker processes started afterwards (fork or spawn) inherit it.
+    '''
+
+    INSTRUMENTATION['enabled'] = enabled
+    os.environ[INSTRUMENTATION_ENVIRONMENT_VARIABLE] = '1' if enabled else '0'
+
+def peak_rss():
+    '''
+    Peak resident set size of this process so far in bytes (None without the resource module).
+    '''
+
+    if not RESOURCE_AVAILABLE:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Bytes on macOS, kilobytes on Linux
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+@contextmanager
+def instrument(stage):
+    '''
+    Recording wall time, CPU time and peak RSS of a stage in INSTRUMENTATION_RECORDS.
+    Does nothing if the instrumentation is disabled.
+    '''
+
+    if not INSTRUMENTATION['enabled']:
+        yield
+        return
+
+    record = {'stage': stage, 'pid': os.getpid(), 'objective_evaluations': None}
+    ACTIVE_RECORDS.append(record)
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+
+    try:
+        yield
+    finally:
+        record['wall_time'] = time.perf_counter() - wall_start
+        record['cpu_time'] = time.process_time() - cpu_start
+        record['peak_rss'] = peak_rss()
+        ACTIVE_RECORDS.remove(record)
+        INSTRUMENTATION_RECORDS.append(record)
+
+def instrumented(stage = None, detail = None):
+    '''
+    Decorator recording every call of a function with instrument. The stage is the function
+    name (or stage), followed by the value of the keyword argument detail if it is passed,
+    e.g. 'processing_data/H2' for detail = 'prefix'. Disabled, a call only costs the check
+    of INSTRUMENTATION['enabled'].
+    '''
+
+    def decorator(function):
+        name = stage or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+
+            if not INSTRUMENTATION['enabled']:
+                return function(*args, **kwargs)
+
+            with instrument(f'{name}/{kwargs[detail]}' if detail in kwargs else name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+def record_objective_evaluations(evaluations):
+    '''
+    Adding objective function evaluations to the innermost running instrumented call.
+    '''
+
+    if INSTRUMENTATION['enabled'] and ACTIVE_RECORDS:
+        record = ACTIVE_RECORDS[-1]
+        record['objective_evaluations'] = (record['objective_evaluations'] or 0) + int(evaluations)
+
+def collect_records(start):
+    '''
+    Removing and returning the records of this process from index start on, to hand them to the
+    parent process (see batch_processing.process_single_experiment).
+    '''
+
+    records = INSTRUMENTATION_RECORDS[start:]
+    del INSTRUMENTATION_RECORDS[start:]
+
+    return records
+
+def merge_records(records):
+    '''
+    Adding records collected in another process (see collect_records) to this process.
+    '''
+
+    INSTRUMENTATION_RECORDS.extend(records)
+
+def instrumentation_table(records):
+    '''
+    Records aggregated per stage: number of calls, total, mean and maximum wall time, total CPU
+    time (s), maximum peak RSS (MB) of the processes and objective evaluations (fits only),
+    sorted by total wall time.
+    '''
+
+    if not records:
+        return pd.DataFrame(columns = ['stage', 'calls', 'wall_time_total', 'wall_time_mean', 'wall_time_max',
+                                       'cpu_time_total', 'peak_rss_MB', 'objective_evaluations_total',
+                                       'objective_evaluations_mean'])
+
+    df = pd.DataFrame(records)
+    df['peak_rss'] = pd.to_numeric(df['peak_rss']) / 1024 ** 2
+    df['objective_evaluations'] = pd.to_numeric(df['objective_evaluations'])
+
+    table = df.groupby('stage').agg(calls = ('wall_time', 'size'),
+                                    wall_time_total = ('wall_time', 'sum'),
+                                    wall_time_mean = ('wall_time', 'mean'),
+                                    wall_time_max = ('wall_time', 'max'),
+                                    cpu_time_total = ('cpu_time', 'sum'),
+                                    peak_rss_MB = ('peak_rss', 'max'),
+                                    objective_evaluations_total = ('objective_evaluations', 'sum'),
+                                    objective_evaluations_mean = ('objective_evaluations', 'mean'))
+
+    # Stages without objective evaluations
+    evaluated = df.groupby('stage')['objective_evaluations'].count() > 0
+    table.loc[~evaluated, ['objective_evaluations_total', 'objective_evaluations_mean']] = float('nan')
+
+    return table.sort_values('wall_time_total', ascending = False).reset_index()
+
+def print_instrumentation_report(records):
+
+    table = instrumentation_table(records)
+
+    print(f"Instrumentation: {len(records)} calls in {len({record['pid'] for record in records})} processes")
+    print(table.to_string(index = False, float_format = lambda value: f'{value:.4g}'))
+
+def write_instrumentation_report(records, json_file):
+    '''
+    Saving the per-stage table and all records as JSON.
+    '''
+
+    table = instrumentation_table(records)
+
+    with open(json_file, 'w') as file:
+        json.dump({'stages': json.loads(table.to_json(orient = 'records')),
+                   'records': records},
+                  file, indent = 2)
+
+    return json_file
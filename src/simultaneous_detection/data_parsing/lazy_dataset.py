@@ -0,0 +1,207 @@
+import json
+import pickle
+from collections.abc import Mapping
+
+import h5py
+import numpy as np
+
+from pyKES.database.database_experiments import load_nested_dict_from_hdf5, read_df_from_hdf
+
+SCALAR_INDEX_ATTRIBUTE = 'scalar_index'
+MEMORY_MAP_MIN_SIZE = 1024 # Smaller arrays are read into memory
+
+def decode_hdf5_dataset(dataset, memory_map = False):
+    '''
+    Value of one HDF5 dataset, decoded as in pyKES load_nested_dict_from_hdf5.
+    With memory_map = True, contiguous uncompressed arrays are returned as read-only
+    np.memmap of the file instead of being read into memory.
+    '''
+
+    data_type = dataset.attrs.get('type')
+
+    if data_type == 'bool':
+        return bool(dataset[()])
+    if data_type == 'json':
+        return json.loads(dataset[()].decode('utf-8'))
+    if data_type == 'pickle':
+        return pickle.loads(dataset[()].tobytes())
+
+    if (memory_map
+        and dataset.shape
+        and dataset.size >= MEMORY_MAP_MIN_SIZE
+        and dataset.chunks is None
+        and dataset.compression is None
+        and dataset.dtype.kind in 'biuf'):
+
+        offset = dataset.id.get_offset()
+
+        if offset is not None:
+            return np.memmap(dataset.file.filename, dtype = dataset.dtype, mode = 'r',
+                             offset = offset, shape = dataset.shape)
+
+    value = dataset[()]
+
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    if isinstance(value, (np.integer, np.floating)):
+        return value.item()
+
+    return value
+
+def scalar_entries(group):
+    '''
+    All scalar entries of an experiment data group (0-d datasets and nested groups
+    of 0-d datasets such as '{general_prefix}_all_rate_constants'), decoded.
+    '''
+
+    scalars = {}
+
+    for name, item in group.items():
+        key = name.replace('__SLASH__', '/')
+
+        if isinstance(item, h5py.Dataset):
+            if item.shape == () or item.attrs.get('type') in ('bool', 'json'):
+                scalars[key] = decode_hdf5_dataset(item)
+
+        elif all(isinstance(sub_item, h5py.Dataset) and sub_item.shape == () for sub_item in item.values()):
+            scalars[key] = load_nested_dict_from_hdf5(item)
+
+    return scalars
+
+def write_scalar_index(filename, experiment_names = None):
+    '''
+    Storing the scalar entries of metadata and processed_data of each experiment as a
+    JSON attribute of its group, so that LazyExperimentalDataset can serve them without
+    touching the data. The attribute is ignored by ExperimentalDataset.load_from_hdf5.
+    '''
+
+    with h5py.File(filename, 'a') as f:
+        for exp_name in experiment_names or list(f.keys()):
+            if exp_name == 'overview_df' or exp_name not in f:
+                continue
+
+            index = {data_group_name: scalar_entries(f[exp_name][data_group_name])
+                     for data_group_name in ('metadata', 'processed_data')
+                     if data_group_name in f[exp_name]}
+
+            f[exp_name].attrs[SCALAR_INDEX_ATTRIBUTE] = json.dumps(index, default = str)
+
+class LazyDataDict(Mapping):
+    '''
+    Read-only dict view of an experiment data group ('raw_data', 'metadata' or
+    'processed_data'). Entries are read from the file on first access and kept;
+    scalars from the scalar index are available without reading.
+    '''
+
+    def __init__(self, group, scalars = None, memory_map = True):
+
+        self._group = group
+        self._memory_map = memory_map
+        self._names = {name.replace('__SLASH__', '/'): name for name in group.keys()} if group is not None else {}
+        self._values = dict(scalars or {})
+
+    def __getitem__(self, key):
+
+        if key not in self._values:
+            if key not in self._names:
+                raise KeyError(key)
+
+            item = self._group[self._names[key]]
+
+            if isinstance(item, h5py.Dataset):
+                self._values[key] = decode_hdf5_dataset(item, memory_map = self._memory_map)
+            else:
+                self._values[key] = load_nested_dict_from_hdf5(item)
+
+        return self._values[key]
+
+    def __getattr__(self, key):
+
+        # Entries as attributes, so that pyKES resolve_experiment_attributes resolves
+        # paths such as 'processed_data/H2_data_reaction' (it only indexes real dicts)
+        if key.startswith('_'):
+            raise AttributeError(key)
+
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key) from None
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, key):
+        return key in self._names
+
+    def __repr__(self):
+        return f'LazyDataDict({len(self._names)} entries, {len(self._values)} loaded)'
+
+class LazyExperiment:
+    '''
+    Experiment with the attributes of pyKES Experiment, whose raw_data and processed_data
+    are LazyDataDicts.
+    '''
+
+    def __init__(self, exp_group, memory_map = True):
+
+        self.experiment_name = exp_group.attrs['experiment_name']
+        self.raw_data_file = exp_group.attrs['raw_data_file']
+        self.color = exp_group.attrs['color']
+        self.group = exp_group.attrs.get('group', '')
+        self.version = json.loads(exp_group.attrs['version']) if 'version' in exp_group.attrs else {}
+
+        index = json.loads(exp_group.attrs[SCALAR_INDEX_ATTRIBUTE]) if SCALAR_INDEX_ATTRIBUTE in exp_group.attrs else {}
+
+        data_groups = {data_group_name: exp_group[data_group_name] if data_group_name in exp_group else None
+                       for data_group_name in ('raw_data', 'metadata', 'processed_data')}
+
+        self.raw_data = LazyDataDict(data_groups['raw_data'], memory_map = memory_map)
+        self.metadata = LazyDataDict(data_groups['metadata'], index.get('metadata'), memory_map = memory_map)
+        self.processed_data = LazyDataDict(data_groups['processed_data'], index.get('processed_data'), memory_map = memory_map)
+
+    def __repr__(self):
+        return f'LazyExperiment({self.experiment_name})'
+
+class LazyExperimentalDataset:
+    '''
+    Read-only view of a dataset .h5 file written by ExperimentalDataset.save_to_hdf5,
+    a drop-in for ExperimentalDataset.load_from_hdf5 in analysis and plotting scripts.
+    The file is opened once; the overview sheet and dataset-level dictionaries are read
+    immediately, experiment data only when accessed (see LazyDataDict). Scalar results are
+    served from the scalar index written by write_scalar_index, if present.
+
+    Usage:
+        with LazyExperimentalDataset('data/....h5') as dataset:
+            rate_constants = dataset.experiments['NB-353'].processed_data['Fit_all_rate_constants']
+    '''
+
+    def __init__(self, filename, memory_map = True):
+
+        self.filename = filename
+        self._file = h5py.File(filename, 'r')
+
+        self.overview_df = read_df_from_hdf(self._file, key = 'overview_df')
+
+        schema_version = self._file.attrs.get('schema_version')
+        self.schema_version = schema_version.decode('utf-8') if isinstance(schema_version, bytes) else schema_version
+
+        for attribute in ('plotting_instruction', 'group_mapping', 'processing_parameters', 'version'):
+            setattr(self, attribute, json.loads(self._file.attrs[attribute]) if attribute in self._file.attrs else {})
+
+        self.experiments = {exp_name: LazyExperiment(self._file[exp_name], memory_map = memory_map)
+                            for exp_name in self._file.keys() if exp_name != 'overview_df'}
+
+    def list_experiments(self):
+        return list(self.experiments.keys())
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,514 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from pyKES.utilities.find_nearest import find_nearest
+
+from simultaneous_detection.data_parsing.raw_data_reading_functions import (H2_COLUMN_MAPPING,
+                                                                           O2_CHANNEL_MAPPING,
+                                                                           firesting_column_to_float)
+from simultaneous_detection.data_parsing.data_processing import convert_gases_to_umol_L, processing_data
+from simultaneous_detection.data_parsing.ragged_processing import savgol_interior, savgol_edge
+from simultaneous_detection.data_parsing.online_polynomial import OnlinePolynomialFit
+from simultaneous_detection.data_parsing.processing_parameters import PROCESSING_PARAMETERS
+from simultaneous_detection.data_parsing.parsing_O2_H2_data import (metadata_retrival_function,
+                                                                    raw_data_files,
+                                                                    signal_processing_specifications)
+
+class FileTail:
+    '''
+    Complete lines appended to a growing text file since the previous call. The read position
+    and an incomplete last line are kept, so every byte of the file is read only once.
+    '''
+
+    def __init__(self, file_name, encoding):
+
+        self.file_name = file_name
+        self.encoding = encoding
+        self.position = 0
+        self.partial_line = b''
+
+    def read_lines(self):
+
+        if not os.path.exists(self.file_name):
+            return []
+
+        if os.path.getsize(self.file_name) < self.position:
+            raise ValueError(f'{self.file_name} was truncated while being followed.')
+
+        with open(self.file_name, 'rb') as file:
+            file.seek(self.position)
+            chunk = file.read()
+
+        self.position += len(chunk)
+
+        lines = (self.partial_line + chunk).split(b'\n')
+        self.partial_line = lines.pop()
+
+        return [line.decode(self.encoding).rstrip('\r') for line in lines]
+
+class UniAmpTail:
+    '''
+    Rows appended to a UniAmp H2 sensor file (see reading_H2_file), parsed into the time and
+    H2 columns of mode ('liquid' or 'gas').
+    '''
+
+    def __init__(self, file_H2, mode = 'liquid'):
+
+        if mode not in ('liquid', 'gas'):
+            raise ValueError("Mode must be either 'liquid' or 'gas'.")
+
+        self.tail = FileTail(file_H2, 'utf-8-sig')
+        self.mode = mode
+        self.column_indices = None
+
+    def read(self):
+        '''
+        New samples as (time, H2) arrays, empty until the header line is complete.
+        '''
+
+        lines = self.tail.read_lines()
+
+        if self.column_indices is None and lines:
+            header = lines.pop(0).split(';')
+            self.column_indices = (header.index(H2_COLUMN_MAPPING['time']),
+                                   header.index(H2_COLUMN_MAPPING[self.mode]))
+
+        if self.column_indices is None:
+            return np.empty(0), np.empty(0)
+
+        rows = [line.split(';') for line in lines if line.strip()]
+
+        return tuple(firesting_column_to_float([fields[index] if index < len(fields) else '' for fields in rows])
+                     for index in self.column_indices)
+
+class FireStingTail:
+    '''
+    Rows appended to a FireSting O2 file (see parse_firesting_file), parsed into the dt and O2
+    columns of channel (see O2_CHANNEL_MAPPING). The '#' header block is skipped as it arrives.
+    '''
+
+    def __init__(self, file_O2, channel):
+
+        self.tail = FileTail(file_O2, 'ISO8859')
+        self.column_names = O2_CHANNEL_MAPPING[channel]
+        self.column_indices = None
+
+    def read(self):
+        '''
+        New samples as (time, O2) arrays, empty until the column header is complete.
+        '''
+
+        lines = [line.split('#', 1)[0] for line in self.tail.read_lines()]
+        lines = [line for line in lines if line.strip()]
+
+        if self.column_indices is None and lines:
+            header = lines.pop(0).split('\t')
+            self.column_indices = (header.index(self.column_names['dt']),
+                                   header.index(self.column_names['O2']))
+
+        if self.column_indices is None:
+            return np.empty(0), np.empty(0)
+
+        rows = [line.split('\t') for line in lines]
+
+        return tuple(firesting_column_to_float([fields[index] if index < len(fields) else '' for fields in rows])
+                     for index in self.column_indices)
+
+class RollingBuffer:
+    '''
+    Growing float64 array with amortized O(1) appends (the capacity is doubled when full).
+    values is a view of the filled part.
+    '''
+
+    def __init__(self, capacity = 4096):
+
+        self._values = np.empty(capacity)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def values(self):
+        return self._values[:self.size]
+
+    def resize(self, size):
+
+        if size > len(self._values):
+            grown = np.empty(max(size, 2 * len(self._values)))
+            grown[:self.size] = self._values[:self.size]
+            self._values = grown
+
+        self.size = size
+
+    def extend(self, values):
+
+        start = self.size
+        self.resize(start + len(values))
+        self._values[start:self.size] = values
+
+class StreamingSavgol:
+    '''
+    scipy savgol_filter (mode = 'interp') of a growing array, updated without smoothing the
+    whole array again. As in ragged_savgol_filter, interior points are a convolution with the
+    Savitzky-Golay coefficients and the window_length // 2 points at both ends are polynomial
+    fits to the first and last window_length points. Interior points whose inputs are final
+    are stored, only the rest (the last window_length // 2 + new points) is recomputed.
+    '''
+
+    def __init__(self, window_length, polyorder):
+
+        self.window_length = window_length
+        self.polyorder = polyorder
+        self.halflen = window_length // 2
+        self.smoothed = RollingBuffer()
+        self.final = 0 # smoothed[:final] no longer changes
+
+    def update(self, values, n_final):
+        '''
+        Smoothing values, of which the first n_final no longer change. Returns the smoothed
+        values (a view), or None while values is shorter than window_length.
+        '''
+
+        n = len(values)
+        w, h = self.window_length, self.halflen
+
+        if n < w:
+            return None
+
+        lo = self.final
+        self.smoothed.resize(n)
+        smoothed = self.smoothed.values
+
+        start, stop = max(lo, h), n - h
+
+        if stop > start:
+            smoothed[start:stop] = savgol_interior(values, w, self.polyorder, start, stop)
+
+        if lo < h:
+            smoothed[lo:h] = savgol_edge(values[:w], self.polyorder, np.arange(lo, h))
+
+        smoothed[n - h:] = savgol_edge(values[n - w:], self.polyorder, np.arange(w - h, w))
+
+        if n_final >= w:
+            self.final = max(self.final, n_final - h)
+
+        return smoothed
+
+class LiveTrace:
+    '''
+    Signal processing of one growing sensor trace, following processing_data: gas phase
+    conversion, offset correction to the irradiation window, Savitzky-Golay smoothing, rate
+    (np.diff of the smoothed data), smoothed rate and the max_rate of the polynomial fit
+    (see online_polynomial.OnlinePolynomialFit). Every update only processes the new
+    samples and the last smoothing window.
+    A missing (NaN) irradiation start is taken as 0 s, a missing end leaves the window open.
+    '''
+
+    def __init__(self,
+                 prefix,
+                 start,
+                 end,
+                 liquid_phase_volume,
+                 gas_phase_volume,
+                 offset,
+                 savgol_window,
+                 savgol_polyorder,
+                 savgol_window_diff,
+                 savgol_polyorder_diff,
+                 interval_resampling,
+                 poly_order):
+
+        self.prefix = prefix
+        self.start = 0.0 if pd.isna(start) else start
+        self.end = None if pd.isna(end) else end
+        self.liquid_phase_volume = liquid_phase_volume
+        self.gas_phase_volume = gas_phase_volume
+        self.processing_parameters = {'offset': offset,
+                                      'savgol_window': savgol_window,
+                                      'savgol_polyorder': savgol_polyorder,
+                                      'savgol_window_diff': savgol_window_diff,
+                                      'savgol_polyorder_diff': savgol_polyorder_diff,
+                                      'interval_resampling': interval_resampling,
+                                      'poly_order': poly_order}
+
+        self.time = RollingBuffer()
+        self.data = RollingBuffer()
+
+        self.reaction_start = None # Index of the first sample of the irradiation window
+        self.reaction_end = None # Index behind the last sample, once the window is closed
+        self.time_reaction = RollingBuffer()
+        self.data_reaction = RollingBuffer()
+        self.data_diff = RollingBuffer()
+
+        self.smoothing = StreamingSavgol(savgol_window, savgol_polyorder)
+        self.smoothing_diff = StreamingSavgol(savgol_window_diff, savgol_polyorder_diff)
+
+        self.polynomial = OnlinePolynomialFit(poly_order)
+
+        self.data_smoothed = None
+        self.data_diff_smoothed = None
+
+    def append(self, time, data):
+        '''
+        Adding new raw samples and updating the processed data.
+        '''
+
+        if len(time) == 0:
+            return
+
+        n_before = len(self.time)
+        self.time.extend(time)
+        self.data.extend(data)
+
+        self.extend_reaction_window(n_before)
+        self.update_rates()
+
+    def converted(self, data):
+        '''
+        Gas phase data in μmol/L, as in processing_data.
+        '''
+
+        if 'gas' in self.prefix:
+            return convert_gases_to_umol_L(data,
+                                           self.liquid_phase_volume,
+                                           self.gas_phase_volume,
+                                           H2 = 'H2' in self.prefix)
+
+        return data
+
+    def extend_reaction_window(self, n_before):
+        '''
+        offset_correction for the new samples: the window starts at the sample nearest to
+        start + offset (known once a later sample exists) and ends before the sample nearest
+        to end.
+        '''
+
+        time, data = self.time.values, self.data.values
+        window_start = self.start + self.processing_parameters['offset']
+
+        if self.reaction_start is None:
+            if time[-1] < window_start:
+                return
+            self.reaction_start = find_nearest(time, window_start)[0]
+            n_before = self.reaction_start
+
+        if self.reaction_end is not None:
+            return
+
+        stop = len(time)
+
+        if self.end is not None and time[-1] >= self.end:
+            self.reaction_end = find_nearest(time, self.end)[0]
+            stop = self.reaction_end
+
+        if stop > n_before:
+            n_reaction = len(self.time_reaction)
+            self.time_reaction.extend(time[n_before:stop] - time[self.reaction_start])
+            self.data_reaction.extend(self.converted(data[n_before:stop]) - self.converted(data[self.reaction_start]))
+            self.polynomial.append(self.time_reaction.values[n_reaction:], self.data_reaction.values[n_reaction:])
+
+    def update_rates(self):
+
+        time_reaction = self.time_reaction.values
+        smoothed_final = self.smoothing.final
+
+        self.data_smoothed = self.smoothing.update(self.data_reaction.values, len(time_reaction))
+
+        if self.data_smoothed is None:
+            return
+
+        # Only differences of smoothed values that changed are recomputed
+        first_changed = max(smoothed_final - 1, 0)
+        self.data_diff.resize(len(time_reaction) - 1)
+        self.data_diff.values[first_changed:] = (np.diff(self.data_smoothed[first_changed:])
+                                                 / np.diff(time_reaction[first_changed:]))
+
+        self.data_diff_smoothed = self.smoothing_diff.update(self.data_diff.values,
+                                                             max(self.smoothing.final - 1, 0))
+
+    @property
+    def ready(self):
+        return self.data_diff_smoothed is not None
+
+    @property
+    def max_rate(self):
+        return self.polynomial.max_rate(self.time_reaction.values)
+
+    def processed_data(self):
+        '''
+        The streamed arrays under the keys of processing_data (the resampled data is left out).
+        '''
+
+        time_reaction = self.time_reaction.values
+        poly_fit = self.polynomial.evaluate(time_reaction)
+
+        return {f'{self.prefix}_time_reaction': self.time_reaction.values,
+                f'{self.prefix}_data_reaction': self.data_reaction.values,
+                f'{self.prefix}_data_smoothed': self.data_smoothed,
+                f'{self.prefix}_data_diff': self.data_diff.values,
+                f'{self.prefix}_time_diff': self.time_reaction.values[1:],
+                f'{self.prefix}_data_diff_smoothed': self.data_diff_smoothed,
+                f'{self.prefix}_poly_fit': poly_fit,
+                f'{self.prefix}_poly_fit_diff': np.diff(poly_fit) / np.diff(time_reaction),
+                f'{self.prefix}_max_rate': self.max_rate}
+
+    def full_processing(self):
+        '''
+        processing_data of the raw samples received so far (all keys, including the
+        polynomial fit and max_rate). Needs a closed irradiation window.
+        '''
+
+        return processing_data(time = self.time.values,
+                               data = self.data.values,
+                               start = self.start,
+                               end = self.end,
+                               prefix = self.prefix,
+                               liquid_phase_volume = self.liquid_phase_volume,
+                               gas_phase_volume = self.gas_phase_volume,
+                               **self.processing_parameters)
+
+def latest_value(time, values, at_time):
+    '''
+    values interpolated at at_time, searching only the end of the traces.
+    '''
+
+    index = np.searchsorted(time, at_time)
+    lower = max(index - 1, 0)
+    upper = min(index + 1, len(time))
+
+    return np.interp(at_time, time[lower:upper], values[lower:upper])
+
+class LiveExperiment:
+    '''
+    Tail-following processing of the H2 (UniAmp) and O2 (FireSting) files of an experiment
+    while they are written. Each update reads the rows appended since the previous update
+    and returns the current smoothed H2 and O2 amounts and rates and the running H2/O2 ratios
+    (2 for stoichiometric water splitting), which are also kept as history.
+    The processing parameters and irradiation window are those of processing_function.
+    '''
+
+    def __init__(self, metadata_dict, processing_parameters = PROCESSING_PARAMETERS, files = None):
+
+        file_H2, file_O2 = files if files is not None else raw_data_files(metadata_dict)
+        gas_phase = 'Gas phase' in metadata_dict['group']
+
+        self.experiment_name = metadata_dict['experiment_name']
+        self.tails = [UniAmpTail(file_H2, mode = 'gas' if gas_phase else 'liquid'),
+                      FireStingTail(file_O2, channel = 4 if gas_phase else 2)]
+
+        self.traces = [LiveTrace(prefix = prefix,
+                                 start = metadata_dict[f'{sensor} Irradiation start [s]'],
+                                 end = metadata_dict[f'{sensor} Irradiation end [s]'],
+                                 liquid_phase_volume = metadata_dict['Liquid phase volume [mL]'],
+                                 gas_phase_volume = metadata_dict['Gas phase volume [mL]'],
+                                 **processing_parameters[parameters_key])
+                       for parameters_key, prefix, _, _, sensor in signal_processing_specifications(metadata_dict)]
+
+        self.history = {key: RollingBuffer(256) for key in ('time', 'H2/O2 ratio', 'H2/O2 rate ratio')}
+
+    @property
+    def H2(self):
+        return self.traces[0]
+
+    @property
+    def O2(self):
+        return self.traces[1]
+
+    def update(self):
+        '''
+        Reading the appended rows of both files. Returns the current status (see status)
+        or None while a trace has less than one smoothing window within the irradiation window.
+        '''
+
+        for tail, trace in zip(self.tails, self.traces):
+            trace.append(*tail.read())
+
+        status = self.status()
+
+        if status is not None and (len(self.history['time']) == 0 or status['time'] > self.history['time'].values[-1]):
+            for key, buffer in self.history.items():
+                buffer.extend([status[key]])
+
+        return status
+
+    def status(self):
+        '''
+        Smoothed amounts and smoothed rates of H2 and O2 at the latest reaction time covered
+        by both traces, their ratios and the max_rate of both traces so far.
+        '''
+
+        if not (self.H2.ready and self.O2.ready):
+            return None
+
+        current_time = min(self.H2.time_reaction.values[-1], self.O2.time_reaction.values[-1])
+        status = {'time': current_time}
+
+        for name, trace in (('H2', self.H2), ('O2', self.O2)):
+            status[f'{name} amount'] = latest_value(trace.time_reaction.values, trace.data_smoothed, current_time)
+            status[f'{name} rate'] = latest_value(trace.time_reaction.values[1:], trace.data_diff_smoothed, current_time)
+            status[f'{name} max rate'] = trace.max_rate
+
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            status['H2/O2 ratio'] = np.float64(status['H2 amount']) / status['O2 amount']
+            status['H2/O2 rate ratio'] = np.float64(status['H2 rate']) / status['O2 rate']
+
+        return status
+
+    def processed_data(self):
+        '''
+        The streamed arrays of both traces, with the keys of processing_data.
+        '''
+
+        return self.H2.processed_data() | self.O2.processed_data()
+
+def print_live_status(experiment_name, status):
+
+    print(f"{experiment_name} t = {status['time']:.0f} s: "
+          f"H2 {status['H2 amount']:.3g} ({status['H2 rate']:.3g}/s), "
+          f"O2 {status['O2 amount']:.3g} ({status['O2 rate']:.3g}/s), "
+          f"H2/O2 {status['H2/O2 ratio']:.3f} (rates {status['H2/O2 rate ratio']:.3f})")
+
+def monitor_experiment(experiment_name,
+                       overview_file = 'data/251204_O2_H2_Experiment_Overview.xlsx',
+                       poll_interval = 5.0,
+                       callback = print_live_status,
+                       idle_timeout = None):
+    '''
+    Following the raw data files of a running experiment (metadata from the overview sheet,
+    irradiation start and end may still be empty) and calling callback(experiment_name, status)
+    after every poll with new data. Stops on KeyboardInterrupt or when no new rows arrived for
+    idle_timeout seconds. Returns the LiveExperiment, e.g. for plotting its history.
+
+    Usage:
+        live = monitor_experiment('NB-370', poll_interval = 2.0)
+        plt.plot(live.history['time'].values, live.history['H2/O2 ratio'].values)
+    '''
+
+    overview_df = pd.read_excel(overview_file)
+    live = LiveExperiment(metadata_retrival_function(experiment_name, overview_df))
+
+    last_data = time.monotonic()
+
+    try:
+        while True:
+            positions = [tail.tail.position for tail in live.tails]
+            status = live.update()
+
+            if positions != [tail.tail.position for tail in live.tails]:
+                last_data = time.monotonic()
+                if status is not None:
+                    callback(experiment_name, status)
+
+            elif idle_timeout is not None and time.monotonic() - last_data > idle_timeout:
+                break
+
+            time.sleep(poll_interval)
+
+    except KeyboardInterrupt:
+        pass
+
+    return live
@@ -0,0 +1,272 @@
+from math import comb
+from functools import lru_cache
+
+import numpy as np
+from numpy.polynomial import polynomial as P
+
+@lru_cache(maxsize = None)
+def binomial_table(order):
+    '''
+    comb(k, j) and the exponent k - j (0 above the diagonal) for k, j = 0..order.
+    '''
+
+    binomials = np.array([[comb(k, j) for j in range(order + 1)] for k in range(order + 1)], dtype = np.float64)
+    exponents = np.maximum(np.arange(order + 1)[:, None] - np.arange(order + 1)[None, :], 0)
+
+    return binomials, exponents
+
+def moment_transform(order, a, b):
+    '''
+    Matrix M with M @ [sum(u**j)] = [sum((a * u + b)**k)] (k, j = 0..order), from the
+    binomial expansion. For arrays a and b, one matrix per element (shape (..., order + 1, order + 1)).
+    '''
+
+    binomials, exponents = binomial_table(order)
+
+    def powers(x):
+        x = np.asarray(x, dtype = np.float64)[..., None]
+        return np.cumprod(np.concatenate((np.ones_like(x), np.repeat(x, order, axis = -1)), axis = -1), axis = -1)
+
+    return binomials * powers(a)[..., None, :] * powers(b)[..., exponents]
+
+def fit_from_moments(power_sums, weighted_sums):
+    '''
+    Least squares polynomial coefficients (lowest order first) from the sums of u**k
+    (k = 0..2 * order) and u**k * y (k = 0..order), solving the normal equations with the
+    column scaling of np.polyfit.
+    '''
+
+    order = len(weighted_sums) - 1
+    index = np.arange(order + 1)
+    normal_matrix = power_sums[index[:, None] + index[None, :]]
+
+    scale = np.sqrt(np.diag(normal_matrix))
+    scale[scale == 0] = 1
+
+    try:
+        coefficients = np.linalg.solve(normal_matrix / np.outer(scale, scale), weighted_sums / scale)
+    except np.linalg.LinAlgError:
+        # Fewer distinct samples than coefficients, minimum norm solution as np.polyfit
+        coefficients = np.linalg.lstsq(normal_matrix / np.outer(scale, scale), weighted_sums / scale, rcond = None)[0]
+
+    return coefficients / scale
+
+def max_secant_slope(coefficients, time, center, scale):
+    '''
+    max(np.diff(polyval) / np.diff(time)) of a polynomial in u = (time - center) / scale,
+    as for the poly_fit_diff of processing_data, without evaluating every sample: the
+    secant slopes are averages of the derivative, so only the intervals at both ends of
+    time and around the maxima of the derivative (roots of the second derivative) are
+    evaluated.
+    '''
+
+    n = len(time)
+    intervals = [0, n - 2]
+
+    if len(coefficients) > 3:
+        roots = P.polyroots(P.polyder(coefficients, 2))
+        roots = center + scale * roots[np.abs(roots.imag) < 1e-9].real
+
+        for root in roots[(roots > time[0]) & (roots < time[-1])]:
+            index = int(np.searchsorted(time, root))
+            intervals.extend(range(index - 3, index + 3))
+
+    intervals = np.array(sorted({min(max(index, 0), n - 2) for index in intervals}))
+
+    values = P.polyval((time[intervals] - center) / scale, coefficients)
+    next_values = P.polyval((time[intervals + 1] - center) / scale, coefficients)
+
+    return np.max((next_values - values) / (time[intervals + 1] - time[intervals]))
+
+class OnlinePolynomialFit:
+    '''
+    Least squares polynomial fit of poly_order (np.polyfit) kept up to date while samples
+    are appended (or removed, for sliding windows). Only the sufficient statistics, the
+    sums of u**k and u**k * y with u = (time - center) / scale, are stored, so an update costs
+    O(poly_order) per sample and the fit O(poly_order**3) for the small linear solve,
+    independent of the number of samples; max_rate adds a binary search in the sample times.
+    center and scale follow the range of the samples (scale a power of two), the sums are
+    transformed when they change (see moment_transform), which keeps the normal equations
+    well conditioned.
+
+    Usage:
+        fit = OnlinePolynomialFit(4)
+        fit.append(time_reaction, data_reaction)
+        fit.max_rate(time_reaction) # max(poly_fit_diff) of processing_data
+    '''
+
+    def __init__(self, poly_order):
+
+        self.poly_order = poly_order
+        self.center = 0.0
+        self.scale = 1.0
+        self.count = 0
+        self.time_range = None
+        self.power_sums = np.zeros(2 * poly_order + 1)
+        self.weighted_sums = np.zeros(poly_order + 1)
+
+    def rescale(self, center, scale):
+        '''
+        Changing the variable u of the stored sums.
+        '''
+
+        a = self.scale / scale
+        b = (self.center - center) / scale
+
+        self.power_sums = moment_transform(2 * self.poly_order, a, b) @ self.power_sums
+        self.weighted_sums = moment_transform(self.poly_order, a, b) @ self.weighted_sums
+        self.center, self.scale = center, scale
+
+    def add(self, time, data, sign):
+
+        time = np.asarray(time, dtype = np.float64)
+        data = np.asarray(data, dtype = np.float64)
+
+        if len(time) == 0:
+            return
+
+        if sign > 0:
+            low, high = time.min(), time.max()
+
+            if self.time_range is not None:
+                low, high = min(low, self.time_range[0]), max(high, self.time_range[1])
+
+            self.time_range = (low, high)
+
+            if low < self.center - self.scale or high > self.center + self.scale:
+                half_range = max((high - low) / 2, np.finfo(float).tiny)
+                self.rescale((low + high) / 2, 2.0 ** np.ceil(np.log2(half_range)))
+
+        powers = np.vander((time - self.center) / self.scale, 2 * self.poly_order + 1, increasing = True)
+
+        self.power_sums += sign * powers.sum(axis = 0)
+        self.weighted_sums += sign * data @ powers[:, :self.poly_order + 1]
+        self.count += sign * len(time)
+
+    def append(self, time, data):
+        self.add(time, data, 1)
+
+    def remove(self, time, data):
+        self.add(time, data, -1)
+
+    def coefficients(self):
+        '''
+        Fitted coefficients in u, lowest order first.
+        '''
+
+        return fit_from_moments(self.power_sums, self.weighted_sums)
+
+    def polyfit_coefficients(self):
+        '''
+        Fitted coefficients in time, highest order first (the layout of np.polyfit).
+        '''
+
+        in_time = P.Polynomial(self.coefficients())(P.Polynomial([-self.center / self.scale, 1 / self.scale]))
+        coefficients = np.zeros(self.poly_order + 1)
+        coefficients[:len(in_time.coef)] = in_time.coef
+
+        return coefficients[::-1]
+
+    def evaluate(self, time):
+        return P.polyval((np.asarray(time) - self.center) / self.scale, self.coefficients())
+
+    def max_rate(self, time):
+        '''
+        max_rate of processing_data, for time the sample times of the fitted data.
+        '''
+
+        return max_secant_slope(self.coefficients(), np.asarray(time), self.center, self.scale)
+
+class MomentTree:
+    '''
+    Sums of u**k (k = 0..2 * poly_order) and u**k * y (k = 0..poly_order) over any index range
+    of a trace in O(log n * poly_order**2), u being time centered on and scaled to the range.
+    Each node of a segment tree stores the sums of its samples in its own variable (centered on
+    and scaled to the node's time span), and a range combines O(log n) nodes transformed to its
+    variable (see moment_transform). Unlike differences of prefix sums, no large sums cancel,
+    so short ranges are as accurate as long ones.
+    '''
+
+    def __init__(self, time, data, poly_order):
+
+        self.time = np.asarray(time, dtype = np.float64)
+        self.poly_order = poly_order
+
+        n = len(self.time)
+        self.size = 1 << max(n - 1, 0).bit_length()
+        nodes = 2 * self.size
+
+        # Padding leaves repeat the last time and hold no samples
+        leaf_time = np.full(self.size, self.time[-1])
+        leaf_time[:n] = self.time
+
+        self.time_min = np.empty(nodes)
+        self.time_max = np.empty(nodes)
+        self.center = np.empty(nodes)
+        self.scale = np.ones(nodes)
+        self.power_sums = np.zeros((nodes, 2 * poly_order + 1))
+        self.weighted_sums = np.zeros((nodes, poly_order + 1))
+
+        self.time_min[self.size:] = self.time_max[self.size:] = self.center[self.size:] = leaf_time
+        self.power_sums[self.size:self.size + n, 0] = 1
+        self.weighted_sums[self.size:self.size + n, 0] = data
+
+        level_start = self.size // 2
+
+        while level_start >= 1:
+            parents = np.arange(level_start, 2 * level_start)
+            children = (2 * parents, 2 * parents + 1)
+
+            self.time_min[parents] = np.minimum(self.time_min[children[0]], self.time_min[children[1]])
+            self.time_max[parents] = np.maximum(self.time_max[children[0]], self.time_max[children[1]])
+            self.center[parents], self.scale[parents] = self.variable(self.time_min[parents], self.time_max[parents])
+
+            for child in children:
+                self.power_sums[parents] += self.transformed(child, self.center[parents], self.scale[parents],
+                                                             self.power_sums, 2 * poly_order)
+                self.weighted_sums[parents] += self.transformed(child, self.center[parents], self.scale[parents],
+                                                                self.weighted_sums, poly_order)
+
+            level_start //= 2
+
+    @staticmethod
+    def variable(time_min, time_max):
+        '''
+        Center and scale of u for a time span (scale 1 for a single time).
+        '''
+
+        half_span = (time_max - time_min) / 2
+
+        return (time_min + time_max) / 2, np.where(half_span > 0, half_span, 1.0)
+
+    def transformed(self, nodes, center, scale, sums, order):
+
+        transforms = moment_transform(order, self.scale[nodes] / scale, (self.center[nodes] - center) / scale)
+
+        return np.einsum('nkj,nj->nk', transforms, sums[nodes])
+
+    def query(self, first, last):
+        '''
+        Sums over the samples first:last, with the center and scale of their u.
+        '''
+
+        nodes = []
+        left, right = first + self.size, last + self.size
+
+        while left < right:
+            if left & 1:
+                nodes.append(left)
+                left += 1
+            if right & 1:
+                right -= 1
+                nodes.append(right)
+            left //= 2
+            right //= 2
+
+        nodes = np.array(nodes)
+        center, scale = self.variable(self.time[first], self.time[last - 1])
+
+        power_sums = self.transformed(nodes, center, scale, self.power_sums, 2 * self.poly_order).sum(axis = 0)
+        weighted_sums = self.transformed(nodes, center, scale, self.weighted_sums, self.poly_order).sum(axis = 0)
+
+        return power_sums, weighted_sums, float(center), float(scale)
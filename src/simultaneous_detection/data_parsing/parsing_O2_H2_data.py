@@ -1,16 +1,66 @@
+import os
+from datetime import datetime
+from functools import partial
+
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
 import pprint as pp
 
-from pyKES.database.data_processing import read_in_experiments_multiprocessing
 from pyKES.database.database_experiments import ExperimentalDataset, Experiment
 from pyKES.utilities.harmonize_time_series import harmonize_time_series
 from pyKES.fitting_ODE import Fitting_Model, square_loss_time_series_normalized, objective_function
 
-from simultaneous_detection.data_parsing.raw_data_reading_functions import reading_H2_file, reading_O2_file
-from simultaneous_detection.data_parsing.data_processing import processing_data, fitting_wrapper
+from simultaneous_detection.data_parsing.raw_data_reading_functions import (reading_H2_file, 
+                                                                           reading_O2_file, 
+                                                                           cached_reading,
+                                                                           print_raw_data_cache_statistics)
+from simultaneous_detection.data_parsing.data_processing import processing_data, run_fitting_configurations
+from simultaneous_detection.data_parsing.ragged_processing import batch_processing_data
 from simultaneous_detection.data_parsing.processing_parameters import PROCESSING_PARAMETERS, GROUP_MAPPING, PLOTTING_INSTRUCTIONS
+from simultaneous_detection.data_parsing.incremental_rebuild import (experiment_fingerprint,
+                                                                     load_stored_fingerprints,
+                                                                     load_stored_version,
+                                                                     select_changed_experiments,
+                                                                     patch_experiments_in_hdf5,
+                                                                     write_fingerprints_to_hdf5)
+from simultaneous_detection.data_parsing.batch_processing import (run_batch,
+                                                                  stage_timer,
+                                                                  timing_table,
+                                                                  failure_report,
+                                                                  raw_data_cache_statistics,
+                                                                  fit_cache_statistics,
+                                                                  instrumentation_records)
+from simultaneous_detection.data_parsing.instrumentation import (INSTRUMENTATION,
+                                                                 INSTRUMENTATION_RECORDS,
+                                                                 enable_instrumentation,
+                                                                 instrument,
+                                                                 instrumented,
+                                                                 print_instrumentation_report,
+                                                                 write_instrumentation_report)
+from simultaneous_detection.data_parsing.lazy_dataset import write_scalar_index
+from simultaneous_detection.data_parsing.chunked_storage import save_dataset_chunked
+from simultaneous_detection.data_parsing.snapshot_store import create_snapshot
+from simultaneous_detection.data_parsing.results_table import write_results_table
+from simultaneous_detection.data_parsing.warm_start import load_previous_fits, warm_start_for_experiment
+from simultaneous_detection.fitting.fit_cache import clear_fit_cache, print_fit_cache_statistics
+
+FITTING_CONFIGURATIONS = [
+    {'fitting_parameters': PROCESSING_PARAMETERS['fitting_parameters'],
+     'parameters_mapping': PROCESSING_PARAMETERS['fitting_parameters_mapping'],
+     'general_prefix': 'Fit'},
+    {'fitting_parameters': PROCESSING_PARAMETERS['fitting_parameters_fixed'],
+     'parameters_mapping': PROCESSING_PARAMETERS['fitting_parameters_fixed_mapping'],
+     'general_prefix': 'Fit_fixed'},
+    {'fitting_parameters': PROCESSING_PARAMETERS['fitting_parameters_flexible_H2'],
+     'parameters_mapping': PROCESSING_PARAMETERS['fitting_parameters_flexible_H2_mapping'],
+     'general_prefix': 'Fit_Flexible_H2',
+     'print_results': True},
+    {'fitting_parameters': PROCESSING_PARAMETERS['fitting_parameters_flexible_O2'],
+     'parameters_mapping': PROCESSING_PARAMETERS['fitting_parameters_flexible_O2_mapping'],
+     'general_prefix': 'Fit_Flexible_O2',
+     'print_results': True},
+]
 
 def metadata_retrival_function(experiment_name, overview_df):
     '''
@@ -33,98 +83,146 @@ def metadata_retrival_function(experiment_name, overview_df):
 
     return metadata_dict
 
-def raw_data_reading_function(experiment_name, metadata_dict):
+def raw_data_files(metadata_dict):
     '''
+    Paths of the H2 and O2 raw data files of an experiment.
     '''
 
     file_H2 = f'data/H2_data/{metadata_dict["File name H2"]}'
     file_O2 = f'data/O2_data/{metadata_dict["File name O2"]}'
 
+    return file_H2, file_O2
+
+def relevant_processing_parameters(metadata_dict):
+    '''
+    The PROCESSING_PARAMETERS sub-dicts that processing_function uses for an experiment:
+    gas phase experiments only use the gas phase processing parameters, liquid phase
+    experiments the liquid phase processing parameters and all four fitting configurations.
+    '''
+
     if 'Gas phase' in metadata_dict['group']:
-        raw_data_H2 = reading_H2_file(file_H2, mode = 'gas')
-        raw_data_O2 = reading_O2_file(file_O2, channel = 4)
+        keys = ['H2_processing_parameters_gas_phase',
+                'O2_processing_parameters_gas_phase']
+    else:
+        keys = ['H2_processing_parameters',
+                'O2_processing_parameters',
+                'fitting_parameters',
+                'fitting_parameters_mapping',
+                'fitting_parameters_fixed',
+                'fitting_parameters_fixed_mapping',
+                'fitting_parameters_flexible_H2',
+                'fitting_parameters_flexible_H2_mapping',
+                'fitting_parameters_flexible_O2',
+                'fitting_parameters_flexible_O2_mapping']
+
+    return {key: PROCESSING_PARAMETERS[key] for key in keys}
+
+@instrumented()
+def raw_data_reading_function(experiment_name, metadata_dict):
+    '''
+    '''
+
+    file_H2, file_O2 = raw_data_files(metadata_dict)
+
+    if 'Gas phase' in metadata_dict['group']:
+        raw_data_H2 = cached_reading(reading_H2_file, file_H2, mode = 'gas')
+        raw_data_O2 = cached_reading(reading_O2_file, file_O2, channel = 4)
 
     else:
-        raw_data_H2 = reading_H2_file(file_H2, mode = 'liquid')
-        raw_data_O2 = reading_O2_file(file_O2, channel = 2)
+        raw_data_H2 = cached_reading(reading_H2_file, file_H2, mode = 'liquid')
+        raw_data_O2 = cached_reading(reading_O2_file, file_O2, channel = 2)
 
     return raw_data_H2 | raw_data_O2
 
-def processing_function(raw_data_dict, metadata_dict):
+@instrumented()
+def processing_function(raw_data_dict, 
+                        metadata_dict, 
+                        timings = None, 
+                        parallel_fits = False,
+                        previous_fits = None):
     '''
+    With a timings dict, the wall time of the signal processing and of each fit is
+    recorded in it (see batch_processing.stage_timer).
+    With parallel_fits = True, the four fits of liquid phase experiments run concurrently
+    in a process pool (see run_fitting_configurations).
+    With previous_fits (see warm_start.load_previous_fits), the fits start from the rate
+    constants of the previous dataset, or from the group means for new experiments.
     '''
 
-    if 'Gas phase' in metadata_dict['group']:
-        prefix_H2 = 'H2_gas'
-        prefix_O2 = 'O2_gas'
-        raw_data_H2_string = 'H2_Pa'
-        raw_data_O2_string = 'O2_data'
-
-        processed_H2 = processing_data(
-            time = raw_data_dict['H2_time_s'],
-            data = raw_data_dict[raw_data_H2_string],
-            start = metadata_dict['Unisense Irradiation start [s]'],
-            end = metadata_dict['Unisense Irradiation end [s]'],
-            prefix = prefix_H2,
-            liquid_phase_volume = metadata_dict['Liquid phase volume [mL]'],
-            gas_phase_volume = metadata_dict['Gas phase volume [mL]'],
-            **PROCESSING_PARAMETERS['H2_processing_parameters_gas_phase']
-        )
+    with stage_timer(timings, 'signal_processing'):
+
+        if 'Gas phase' in metadata_dict['group']:
+            prefix_H2 = 'H2_gas'
+            prefix_O2 = 'O2_gas'
+            raw_data_H2_string = 'H2_Pa'
+            raw_data_O2_string = 'O2_data'
+
+            processed_H2 = processing_data(
+                time = raw_data_dict['H2_time_s'],
+                data = raw_data_dict[raw_data_H2_string],
+                start = metadata_dict['Unisense Irradiation start [s]'],
+                end = metadata_dict['Unisense Irradiation end [s]'],
+                prefix = prefix_H2,
+                liquid_phase_volume = metadata_dict['Liquid phase volume [mL]'],
+                gas_phase_volume = metadata_dict['Gas phase volume [mL]'],
+                **PROCESSING_PARAMETERS['H2_processing_parameters_gas_phase']
+            )
 
-        processed_O2 = processing_data(
-            time = raw_data_dict['O2_time_s'],
-            data = raw_data_dict[raw_data_O2_string],
-            start = metadata_dict['Pyroscience Irradiation start [s]'],
-            end = metadata_dict['Pyroscience Irradiation end [s]'],
-            prefix = prefix_O2,
-            liquid_phase_volume = metadata_dict['Liquid phase volume [mL]'],
-            gas_phase_volume = metadata_dict['Gas phase volume [mL]'],
-            **PROCESSING_PARAMETERS['O2_processing_parameters_gas_phase']
-        )
+            processed_O2 = processing_data(
+                time = raw_data_dict['O2_time_s'],
+                data = raw_data_dict[raw_data_O2_string],
+                start = metadata_dict['Pyroscience Irradiation start [s]'],
+                end = metadata_dict['Pyroscience Irradiation end [s]'],
+                prefix = prefix_O2,
+                liquid_phase_volume = metadata_dict['Liquid phase volume [mL]'],
+                gas_phase_volume = metadata_dict['Gas phase volume [mL]'],
+                **PROCESSING_PARAMETERS['O2_processing_parameters_gas_phase']
+            )
 
-    else:
-        prefix_H2 = 'H2'
-        prefix_O2 = 'O2'
-        raw_data_H2_string = 'H2_umol_L'
-        raw_data_O2_string = 'O2_data'
-
-        processed_H2 = processing_data(
-            time = raw_data_dict['H2_time_s'],
-            data = raw_data_dict[raw_data_H2_string],
-            start = metadata_dict['Unisense Irradiation start [s]'],
-            end = metadata_dict['Unisense Irradiation end [s]'],
-            prefix = prefix_H2,
-            liquid_phase_volume = metadata_dict['Liquid phase volume [mL]'],
-            gas_phase_volume = metadata_dict['Gas phase volume [mL]'],
-            **PROCESSING_PARAMETERS['H2_processing_parameters']
-        )
+        else:
+            prefix_H2 = 'H2'
+            prefix_O2 = 'O2'
+            raw_data_H2_string = 'H2_umol_L'
+            raw_data_O2_string = 'O2_data'
+
+            processed_H2 = processing_data(
+                time = raw_data_dict['H2_time_s'],
+                data = raw_data_dict[raw_data_H2_string],
+                start = metadata_dict['Unisense Irradiation start [s]'],
+                end = metadata_dict['Unisense Irradiation end [s]'],
+                prefix = prefix_H2,
+                liquid_phase_volume = metadata_dict['Liquid phase volume [mL]'],
+                gas_phase_volume = metadata_dict['Gas phase volume [mL]'],
+                **PROCESSING_PARAMETERS['H2_processing_parameters']
+            )
 
-        processed_O2 = processing_data(
-            time = raw_data_dict['O2_time_s'],
-            data = raw_data_dict[raw_data_O2_string],
-            start = metadata_dict['Pyroscience Irradiation start [s]'],
-            end = metadata_dict['Pyroscience Irradiation end [s]'],
-            prefix = prefix_O2,
-            liquid_phase_volume = metadata_dict['Liquid phase volume [mL]'],
-            gas_phase_volume = metadata_dict['Gas phase volume [mL]'],
-            **PROCESSING_PARAMETERS['O2_processing_parameters']
-        )
+            processed_O2 = processing_data(
+                time = raw_data_dict['O2_time_s'],
+                data = raw_data_dict[raw_data_O2_string],
+                start = metadata_dict['Pyroscience Irradiation start [s]'],
+                end = metadata_dict['Pyroscience Irradiation end [s]'],
+                prefix = prefix_O2,
+                liquid_phase_volume = metadata_dict['Liquid phase volume [mL]'],
+                gas_phase_volume = metadata_dict['Gas phase volume [mL]'],
+                **PROCESSING_PARAMETERS['O2_processing_parameters']
+            )
 
-    processed_data_dict = processed_H2 | processed_O2
+        processed_data_dict = processed_H2 | processed_O2
 
-    ### Harmonizing time series for fitting
-    common_time, H2_data_aligned, O2_data_aligned = harmonize_time_series(
-        processed_data_dict[f'{prefix_H2}_time_reaction'],
-        processed_data_dict[f'{prefix_H2}_data_reaction'],
-        processed_data_dict[f'{prefix_O2}_time_reaction'],
-        processed_data_dict[f'{prefix_O2}_data_reaction']
-    )
+        ### Harmonizing time series for fitting
+        with instrument('harmonize_time_series'):
+            common_time, H2_data_aligned, O2_data_aligned = harmonize_time_series(
+                processed_data_dict[f'{prefix_H2}_time_reaction'],
+                processed_data_dict[f'{prefix_H2}_data_reaction'],
+                processed_data_dict[f'{prefix_O2}_time_reaction'],
+                processed_data_dict[f'{prefix_O2}_data_reaction']
+            )
+
+        processed_data_dict['common_time_reaction'] = common_time
+        processed_data_dict['flexible_diff_time'] = common_time[1:]
+        processed_data_dict[f'{prefix_H2}_data_aligned'] = H2_data_aligned
+        processed_data_dict[f'{prefix_O2}_data_aligned'] = O2_data_aligned
 
-    processed_data_dict['common_time_reaction'] = common_time
-    processed_data_dict['flexible_diff_time'] = common_time[1:]
-    processed_data_dict[f'{prefix_H2}_data_aligned'] = H2_data_aligned
-    processed_data_dict[f'{prefix_O2}_data_aligned'] = O2_data_aligned
-    
     ### Creating experiment object for fitting
     experiment = Experiment(
             experiment_name = metadata_dict['experiment_name'],
@@ -138,47 +236,99 @@ def processing_function(raw_data_dict, metadata_dict):
     
     if 'Gas phase' not in metadata_dict['group']:
 
-        processed_data_dict = fitting_wrapper(
-            experiment,
-            PROCESSING_PARAMETERS['fitting_parameters'],
-            PROCESSING_PARAMETERS['fitting_parameters_mapping'],
-            processed_data_dict,
-            common_time,
-            general_prefix = 'Fit'
-        )
+        if previous_fits is not None:
+            warm_starts = warm_start_for_experiment(previous_fits, 
+                                                    metadata_dict['experiment_name'], 
+                                                    metadata_dict['group'])
+        else:
+            warm_starts = None
 
-        processed_data_dict = fitting_wrapper(
+        processed_data_dict = run_fitting_configurations(
             experiment,
-            PROCESSING_PARAMETERS['fitting_parameters_fixed'],
-            PROCESSING_PARAMETERS['fitting_parameters_fixed_mapping'],
+            FITTING_CONFIGURATIONS,
             processed_data_dict,
             common_time,
-            general_prefix = 'Fit_fixed'
+            parallel = parallel_fits,
+            timings = timings,
+            warm_starts = warm_starts
         )
 
-        processed_data_dict = fitting_wrapper(
-            experiment,
-            PROCESSING_PARAMETERS['fitting_parameters_flexible_H2'],
-            PROCESSING_PARAMETERS['fitting_parameters_flexible_H2_mapping'],
-            processed_data_dict,
-            common_time,
-            print_results = True,
-            general_prefix = 'Fit_Flexible_H2'
-        )
+    return processed_data_dict
 
-        processed_data_dict = fitting_wrapper(
-            experiment,
-            PROCESSING_PARAMETERS['fitting_parameters_flexible_O2'],
-            PROCESSING_PARAMETERS['fitting_parameters_flexible_O2_mapping'],
-            processed_data_dict,
-            common_time,
-            print_results = True,
-            general_prefix = 'Fit_Flexible_O2'
+def signal_processing_specifications(metadata_dict):
+    '''
+    PROCESSING_PARAMETERS key, prefix, raw data keys and irradiation columns of the H2 and
+    O2 traces of an experiment, as used in processing_function.
+    '''
+
+    if 'Gas phase' in metadata_dict['group']:
+        return [('H2_processing_parameters_gas_phase', 'H2_gas', 'H2_time_s', 'H2_Pa', 'Unisense'),
+                ('O2_processing_parameters_gas_phase', 'O2_gas', 'O2_time_s', 'O2_data', 'Pyroscience')]
+
+    return [('H2_processing_parameters', 'H2', 'H2_time_s', 'H2_umol_L', 'Unisense'),
+            ('O2_processing_parameters', 'O2', 'O2_time_s', 'O2_data', 'Pyroscience')]
+
+def batch_signal_processing(metadata_dicts, 
+                            raw_data_dicts, 
+                            processing_parameters = PROCESSING_PARAMETERS):
+    '''
+    Signal processing (processing_data) of many experiments at once, without fitting.
+    The traces are grouped by their PROCESSING_PARAMETERS sub-dict and every group is 
+    processed in one pass by ragged_processing.batch_processing_data, so the whole dataset
+    can be reprocessed quickly after a parameter change (pass a modified copy of
+    PROCESSING_PARAMETERS as processing_parameters).
+    metadata_dicts and raw_data_dicts map experiment names to the outputs of
+    metadata_retrival_function and raw_data_reading_function.
+    Returns {experiment_name: processed_data_dict} with the same keys as processing_function
+    before harmonizing and fitting.
+    '''
+
+    trace_groups = {}
+
+    for experiment_name, metadata_dict in metadata_dicts.items():
+        for parameters_key, prefix, time_key, data_key, sensor in signal_processing_specifications(metadata_dict):
+            trace_groups.setdefault((parameters_key, prefix), []).append((experiment_name, time_key, data_key, sensor))
+
+    processed_data_dicts = {experiment_name: {} for experiment_name in metadata_dicts}
+
+    for (parameters_key, prefix), traces in trace_groups.items():
+        metadata = [metadata_dicts[experiment_name] for experiment_name, _, _, _ in traces]
+
+        processed_traces = batch_processing_data(
+            time_traces = [raw_data_dicts[experiment_name][time_key] for experiment_name, time_key, _, _ in traces],
+            data_traces = [raw_data_dicts[experiment_name][data_key] for experiment_name, _, data_key, _ in traces],
+            starts = [metadata_dict[f'{sensor} Irradiation start [s]'] for metadata_dict, (_, _, _, sensor) in zip(metadata, traces)],
+            ends = [metadata_dict[f'{sensor} Irradiation end [s]'] for metadata_dict, (_, _, _, sensor) in zip(metadata, traces)],
+            prefix = prefix,
+            liquid_phase_volumes = [metadata_dict['Liquid phase volume [mL]'] for metadata_dict in metadata],
+            gas_phase_volumes = [metadata_dict['Gas phase volume [mL]'] for metadata_dict in metadata],
+            **processing_parameters[parameters_key]
         )
 
-    return processed_data_dict
+        for (experiment_name, _, _, _), processed_trace in zip(traces, processed_traces):
+            processed_data_dicts[experiment_name] |= processed_trace
+
+    return processed_data_dicts
+
+def snapshot_output_file(output_file, snapshot = True):
+    '''
+    Storing output_file in the snapshot store, named after the file and the current time,
+    or snapshot if it is a string.
+    '''
 
-def generate_dataset():
+    name = snapshot if isinstance(snapshot, str) else f'{datetime.now():%y%m%d_%H%M%S}_{os.path.splitext(os.path.basename(output_file))[0]}'
+    print(f'Snapshot {create_snapshot(output_file, name)} created')
+
+def generate_dataset(incremental = False,
+                     overview_file = 'data/251204_O2_H2_Experiment_Overview.xlsx',
+                     output_file = 'data/251204_processed_O2_H2_data_gas_D2O_regrouped.h5',
+                     workers = None,
+                     parallel_fits = False,
+                     warm_start = False,
+                     refit = False,
+                     instrument_stages = False,
+                     compression = 'gzip',
+                     snapshot = False):
     """
     Generate a complete simultaneous O2/H2 experimental dataset from Excel metadata and raw data files.
 
@@ -233,6 +383,8 @@ def generate_dataset():
     - Extract metadata using metadata_retrival_function
     - Read H2 data from 'data/H2_data/{File name H2}'
     - Read O2 data from 'data/O2_data/{File name O2}' (channel 2)
+      (both through the raw data cache in 'data/raw_data_cache', so only new or
+      edited files are parsed again)
     - Merge H2 and O2 raw data dictionaries
     - Process H2 data:
         * Apply Savitzky-Golay filter (window=30, polyorder=3)
@@ -245,9 +397,62 @@ def generate_dataset():
     - Create Experiment object with all data and metadata
     5. Save complete dataset to HDF5 file for future loading
 
+    Incremental Mode
+    ----------------
+    Every experiment group in the output file carries an input fingerprint, a hash of
+    its overview row, the content of its raw data files and the PROCESSING_PARAMETERS
+    sub-dicts used for it (see relevant_processing_parameters). With incremental = True
+    and an existing output file, only experiments whose fingerprint changed (or that
+    are new) are processed and fitted again, and only their groups are rewritten in
+    the existing file. Experiments no longer in the overview sheet are removed.
+
+    Warm Start
+    ----------
+    With warm_start = True, the rate constants and fitting errors stored in the existing
+    output file seed the fits: each fit is first refined locally (Nelder-Mead) from the
+    previous rate constants and the global differential evolution only runs if the
+    refined error is worse than the previous one. New experiments start from the mean
+    rate constants of their group and always run the seeded global search.
+
+    Fit Cache
+    ---------
+    Every fit is stored in the fit cache 'data/fit_cache', keyed by a hash of its fitting
+    parameters and the fitted arrays (see fit_cache.fit_cache_key). Experiments whose data
+    and fitting parameters did not change (e.g. after editing a plot colour or a gas phase
+    experiment) are not fitted again. With refit = True the cache is cleared first.
+
+    Parameters
+    ----------
+    incremental : bool, optional
+        Reprocess only changed experiments and patch them into output_file.
+    overview_file : str, optional
+        Overview Excel sheet listing the experiments.
+    output_file : str, optional
+        HDF5 file the dataset is saved to.
+    workers : int, optional
+        Number of worker processes, defaults to the number of CPUs (a quarter of
+        them with parallel_fits, as every worker then starts four fitting processes).
+    parallel_fits : bool, optional
+        Run the four fits of each liquid phase experiment concurrently.
+    warm_start : bool, optional
+        Seed the fits with the results stored in output_file.
+    refit : bool, optional
+        Clear the fit cache, so that all fits run again.
+    instrument_stages : bool, optional
+        Record wall time, CPU time and peak RSS of every raw_data_reading_function,
+        processing_function, processing_data, harmonize_time_series, fitting_wrapper
+        (with its objective evaluations) and save_to_hdf5 call, see Instrumentation.
+    compression : str or None, optional
+        'gzip' (readable everywhere) or, opt-in, 'zstd' (blosc, writers and readers need
+        hdf5plugin) for the chunked storage layout, None for the single-write layout of
+        save_to_hdf5, see Storage.
+    snapshot : bool or str, optional
+        Also store the saved dataset in the snapshot store (see Storage), named after
+        output_file and the current time, or snapshot if it is a string.
+
     Output File
     -----------
-    Saves dataset to 'data/251105_processed_O2_H2_data.h5' containing:
+    Saves dataset to output_file containing:
     - All experiment objects with raw and processed data
     - Merged O2 and H2 datasets for each experiment
     - Smoothed data and evolution rates (derivatives)
@@ -255,39 +460,164 @@ def generate_dataset():
     - Metadata for filtering and analysis
     - Overview DataFrame for quick experiment lookup
 
+    Each experiment group also carries a JSON index of its scalar results (see 
+    lazy_dataset.write_scalar_index) for LazyExperimentalDataset. All scalar results,
+    joined with the overview sheet, are also saved as a columnar table with one row per
+    experiment, '{output_file stem}_results.parquet' (or '_results.h5' without pyarrow),
+    see results_table.read_results_table.
+
+    The per-experiment timings (read, signal processing and each of the four fits) and 
+    errors of failed experiments are saved next to it as '{output_file stem}_timings.csv'.
+
+    Storage
+    -------
+    By default the dataset is saved with chunked_storage.save_dataset_chunked: one group per
+    experiment (the layout of save_to_hdf5, read by ExperimentalDataset.load_from_hdf5 and
+    LazyExperimentalDataset) with chunked arrays compressed by gzip and a byte shuffle.
+    Groups whose content hash did not change are not rewritten, and the space of rewritten
+    groups is reused, so repeated saves cost in proportion to the changes. With
+    compression = 'zstd' the arrays are compressed by blosc/zstd instead; reading such
+    files needs hdf5plugin, which importing simultaneous_detection registers.
+    chunked_storage.read_experiment reads a single experiment.
+
+    Dated versions of a dataset are kept in the snapshot store (snapshot_store,
+    data/snapshots) rather than as copies of the file: every array is stored once by content
+    hash and each snapshot is a small manifest, so snapshots of unchanged data take almost no
+    space and two versions are compared with snapshot_store.diff_snapshots.
+
+    Instrumentation
+    ---------------
+    With instrument_stages = True, the instrumented calls of all worker processes (and of
+    the parallel fits) are aggregated per stage (see instrumentation.instrumentation_table),
+    printed and saved with all individual calls as '{output_file stem}_instrumentation.json'.
+    The instrumentation can also be switched on for single calls with
+    instrumentation.enable_instrumentation; disabled, it only costs a flag check per call.
+
     Notes
     -----
     - Processes all experiments listed in the Excel overview file
     - Preserves 'TRUE'/'FALSE' strings in 'active' and 'D2O' columns for filtering
     - H2 uses stronger smoothing (window=30) than O2 (window=10)
     - Evolution rates calculated as derivatives of smoothed data
-    - Uses multiprocessing for efficient parallel data processing
+    - Uses a process pool (batch_processing.run_batch); a failing experiment is reported 
+      and skipped instead of aborting the run
     - Time arrays for derivatives are one element shorter due to np.diff
     """
 
     overview_df = pd.read_excel(
-        'data/251204_O2_H2_Experiment_Overview.xlsx',
+        overview_file,
         sheet_name='Sheet1',
         dtype={'active': str,
                'D2O': str}  # Force 'active' and 'D2O' columns to be read as strings
     )
 
+    fingerprints = {}
+
+    for experiment_name in overview_df['Experiment']:
+        metadata_dict = metadata_retrival_function(experiment_name, overview_df)
+        fingerprints[experiment_name] = experiment_fingerprint(
+            metadata_dict,
+            raw_data_files(metadata_dict),
+            relevant_processing_parameters(metadata_dict)
+        )
+
+    incremental = incremental and os.path.exists(output_file)
+
+    if incremental:
+        changed_experiments, removed_experiments = select_changed_experiments(
+            fingerprints, 
+            load_stored_fingerprints(output_file)
+        )
+
+        print(f'Incremental rebuild: {len(changed_experiments)} of {len(fingerprints)} experiments changed, '
+              f'{len(removed_experiments)} removed.')
+
+        if not changed_experiments and not removed_experiments:
+            if snapshot:
+                snapshot_output_file(output_file, snapshot)
+            return
+
+        processing_df = overview_df[overview_df['Experiment'].isin(changed_experiments)]
+    else:
+        processing_df = overview_df
+
     dataset = ExperimentalDataset(
-                    overview_df = overview_df,
+                    overview_df = processing_df,
                     group_mapping = GROUP_MAPPING,
                     plotting_instruction = PLOTTING_INSTRUCTIONS,
                     processing_parameters = PROCESSING_PARAMETERS
                     )
+    
+    if incremental:
+        dataset.version = load_stored_version(output_file)
+
+    if parallel_fits and workers is None:
+        workers = max(1, os.cpu_count() // len(FITTING_CONFIGURATIONS))
+
+    if refit:
+        print(f'Fit cache cleared ({clear_fit_cache()} fits removed)')
+
+    if instrument_stages:
+        instrumentation_enabled = INSTRUMENTATION['enabled']
+        enable_instrumentation()
+        records_start = len(INSTRUMENTATION_RECORDS)
+
+    # The previous instrumentation setting is restored also if processing fails
+    try:
+        if warm_start:
+            previous_fits = load_previous_fits(output_file, 
+                                               [configuration['general_prefix'] for configuration in FITTING_CONFIGURATIONS])
+            print(f'Warm start from the fits of {len(previous_fits)} experiments in {output_file}')
+        else:
+            previous_fits = None
+
+        results = run_batch(
+            dataset,
+            metadata_retrival_function,
+            raw_data_reading_function,
+            partial(processing_function, parallel_fits = parallel_fits, previous_fits = previous_fits),
+            workers = workers
+        )
 
-    results = read_in_experiments_multiprocessing(
-        dataset,
-        metadata_retrival_function,
-        raw_data_reading_function,
-        processing_function,
-        overview_df_based_processing = True,
-    )
-
-    dataset.save_to_hdf5('data/251204_processed_O2_H2_data_gas_D2O_regrouped.h5')
+        failure_report(results)
+        print_raw_data_cache_statistics(raw_data_cache_statistics(results))
+        print_fit_cache_statistics(fit_cache_statistics(results))
+
+        dataset.overview_df = overview_df # Full overview sheet is stored, also when only a subset was processed
+
+        with instrument('save_to_hdf5'):
+            if compression is not None:
+                written_experiments = save_dataset_chunked(dataset,
+                                                           output_file,
+                                                           fingerprints,
+                                                           removed_experiments if incremental else None,
+                                                           compression = compression)['written']
+            elif incremental:
+                patch_experiments_in_hdf5(dataset, output_file, fingerprints, removed_experiments)
+                written_experiments = list(dataset.experiments)
+            else:
+                dataset.save_to_hdf5(output_file)
+                write_fingerprints_to_hdf5(output_file, fingerprints)
+                written_experiments = list(dataset.experiments)
+
+        write_scalar_index(output_file, written_experiments)
+        print(f'Results table saved to {write_results_table(output_file)}')
+
+        if snapshot:
+            snapshot_output_file(output_file, snapshot)
+
+        timing_file = f'{os.path.splitext(output_file)[0]}_timings.csv'
+        timing_table(results).to_csv(timing_file, index = False)
+        print(f'Timings saved to {timing_file}')
+
+        if instrument_stages:
+            records = instrumentation_records(results) + INSTRUMENTATION_RECORDS[records_start:]
+            print_instrumentation_report(records)
+            instrumentation_file = f'{os.path.splitext(output_file)[0]}_instrumentation.json'
+            print(f'Instrumentation saved to {write_instrumentation_report(records, instrumentation_file)}')
+    finally:
+        if instrument_stages:
+            enable_instrumentation(instrumentation_enabled)
 
 def debugging_function():
 
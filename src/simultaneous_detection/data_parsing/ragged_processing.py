@@ -0,0 +1,329 @@
+from functools import lru_cache
+
+import numpy as np
+from scipy.ndimage import convolve1d
+from scipy.signal import savgol_coeffs
+
+from pyKES.utilities.find_nearest import find_nearest
+
+from simultaneous_detection.data_parsing.data_processing import convert_gases_to_umol_L
+
+def concatenate_traces(traces):
+    '''
+    Concatenating a list of 1D arrays into the ragged layout used in this module:
+    one concatenated array and offsets (length len(traces) + 1), trace i being
+    values[offsets[i]:offsets[i + 1]].
+    '''
+
+    lengths = [len(trace) for trace in traces]
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+
+    return np.concatenate(traces).astype(np.float64), offsets
+
+def split_traces(values, offsets):
+    '''
+    Splitting concatenated values back into a list of arrays (views).
+    '''
+
+    return [values[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+def ragged_arange(lengths):
+    '''
+    np.arange(length) for each length, concatenated.
+    '''
+
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+
+    return np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+
+def ragged_diff(values, offsets):
+    '''
+    np.diff within each trace. Returns the differences and their offsets (every trace
+    one element shorter).
+    '''
+
+    within_trace = np.ones(len(values) - 1, dtype = bool)
+    within_trace[offsets[1:-1] - 1] = False
+
+    return np.diff(values)[within_trace], offsets - np.arange(len(offsets))
+
+def ragged_offset_correction(time, data, offsets, offset, starts, ends):
+    '''
+    pyKES offset_correction applied to every trace: cutting each trace to its
+    [start + offset, end) window and shifting time and data to start at zero.
+    '''
+
+    trace_starts = []
+    trace_ends = []
+
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        idx = find_nearest(time[offsets[i]:offsets[i + 1]], (start + offset, end))
+        trace_starts.append(offsets[i] + idx[0])
+        trace_ends.append(offsets[i] + idx[1])
+
+    trace_starts = np.array(trace_starts, dtype = np.int64)
+    lengths = np.array(trace_ends, dtype = np.int64) - trace_starts
+
+    index = np.repeat(trace_starts, lengths) + ragged_arange(lengths)
+    reaction_offsets = np.concatenate(([0], np.cumsum(lengths)))
+
+    time_reaction = time[index] - np.repeat(time[trace_starts], lengths)
+    data_reaction = data[index] - np.repeat(data[trace_starts], lengths)
+
+    return time_reaction, data_reaction, reaction_offsets
+
+@lru_cache(maxsize = None)
+def cached_savgol_coefficients(window_length, polyorder):
+    '''
+    Savitzky-Golay convolution coefficients, computed once per parameter set.
+    '''
+
+    return savgol_coeffs(window_length, polyorder)
+
+def savgol_interior(values, window_length, polyorder, start, stop):
+    '''
+    Interior points start:stop of scipy savgol_filter of values (the convolution with the
+    Savitzky-Golay coefficients), computed from the neighbouring points only.
+    '''
+
+    segment_start = max(0, start - window_length)
+    segment = values[segment_start:min(len(values), stop + window_length)]
+    convolved = convolve1d(segment, cached_savgol_coefficients(window_length, polyorder), mode = 'constant')
+
+    return convolved[start - segment_start:stop - segment_start]
+
+def savgol_edge(window_values, polyorder, positions):
+    '''
+    Edge points of scipy savgol_filter (mode = 'interp'): the polynomial fit to the first or
+    last window_length values, evaluated at positions within that window.
+    '''
+
+    window = np.arange(len(window_values), dtype = np.float64)
+
+    return np.polyval(np.polyfit(window, window_values, polyorder), positions)
+
+def ragged_savgol_filter(values, offsets, window_length, polyorder):
+    '''
+    scipy savgol_filter (mode = 'interp') applied to every trace.
+    The interior of all traces is smoothed by one convolution of the concatenated array,
+    the window_length // 2 points at both ends of each trace are replaced by polynomial
+    fits to the first and last window_length points, all traces in one np.polyfit call.
+    '''
+
+    lengths = np.diff(offsets)
+
+    if np.any(lengths < window_length):
+        raise ValueError("If mode is 'interp', window_length must be less "
+                         "than or equal to the size of x.")
+
+    smoothed = convolve1d(values, cached_savgol_coefficients(window_length, polyorder), mode = 'constant')
+
+    halflen = window_length // 2
+    window = np.arange(window_length)
+
+    for window_starts, interp_positions in ((offsets[:-1], np.arange(halflen)),
+                                            (offsets[1:] - window_length, np.arange(window_length - halflen, window_length))):
+        edges = values[window_starts[None, :] + window[:, None]]
+        coefficients = np.polyfit(window.astype(np.float64), edges, polyorder)
+        smoothed[window_starts[None, :] + interp_positions[:, None]] = np.polyval(coefficients, interp_positions[:, None])
+
+    return smoothed
+
+def ragged_resample(time, data, offsets, interval):
+    '''
+    pyKES resample_time_series applied to every trace whose time starts at zero:
+    the mean of the data in bins of width interval, with the bin centers as new time.
+    All traces share the bin edges np.arange(0, t_max + interval, interval) up to their own
+    last edge, so one set of edges, np.searchsorted and np.bincount serve all traces.
+    '''
+
+    trace_ends = np.array([time[offsets[i + 1] - 1] for i in range(len(offsets) - 1)])
+    bins_per_trace = np.array([len(np.arange(0, end + interval, interval)) - 1 for end in trace_ends])
+
+    edges = np.arange(0, trace_ends.max() + interval, interval)
+    trace_index = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+    # Values on the last edge of a trace belong to its last bin, as in binned_statistic
+    bin_index = np.minimum(np.searchsorted(edges, time, side = 'right') - 1,
+                           bins_per_trace[trace_index] - 1)
+
+    resampled_offsets = np.concatenate(([0], np.cumsum(bins_per_trace)))
+    flat_index = resampled_offsets[trace_index] + bin_index
+
+    counts = np.bincount(flat_index, minlength = resampled_offsets[-1])
+    sums = np.bincount(flat_index, weights = data, minlength = resampled_offsets[-1])
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        data_resampled = sums / counts
+
+    bin_centers = (edges[:-1] + edges[1:]) / 2
+    time_resampled = bin_centers[ragged_arange(bins_per_trace)]
+
+    return time_resampled, data_resampled, resampled_offsets
+
+def ragged_polyfit(time, data, offsets, poly_order):
+    '''
+    np.polyfit and np.polyval of every trace. The Vandermonde matrices of all traces are
+    zero-padded to the longest trace (zero rows do not change a least squares solution)
+    and solved in one batched QR decomposition, with the column scaling of np.polyfit.
+    Returns the fitted values.
+    '''
+
+    lengths = np.diff(offsets)
+    n_traces = len(lengths)
+    row = ragged_arange(lengths)
+    trace_index = np.repeat(np.arange(n_traces), lengths)
+
+    vandermonde_flat = np.vander(time, poly_order + 1)
+
+    vandermonde = np.zeros((n_traces, lengths.max(), poly_order + 1))
+    vandermonde[trace_index, row] = vandermonde_flat
+
+    rhs = np.zeros((n_traces, lengths.max()))
+    rhs[trace_index, row] = data
+
+    scale = np.sqrt((vandermonde * vandermonde).sum(axis = 1))
+    scale[scale == 0] = 1
+
+    q, r = np.linalg.qr(vandermonde / scale[:, None, :])
+    coefficients = np.linalg.solve(r, np.einsum('nij,ni->nj', q, rhs)[..., None])[..., 0] / scale
+
+    return np.einsum('ij,ij->i', vandermonde_flat, coefficients[trace_index])
+
+def ragged_processing_data(time,
+                           data,
+                           offsets,
+                           offset,
+                           savgol_window,
+                           savgol_polyorder,
+                           savgol_window_diff,
+                           savgol_polyorder_diff,
+                           interval_resampling,
+                           poly_order,
+                           starts,
+                           ends,
+                           prefix,
+                           liquid_phase_volumes,
+                           gas_phase_volumes):
+    '''
+    data_processing.processing_data for concatenated traces (see concatenate_traces),
+    all processed with the same processing parameters, so that every step is one NumPy
+    operation on the concatenated arrays instead of one call per trace.
+    starts, ends and the phase volumes are per trace. Returns a dict with the same keys
+    as processing_data, the arrays concatenated over all traces ({prefix}_max_rate holds
+    one value per trace), and a dict with the offsets of each key.
+    '''
+
+    time = np.asarray(time, dtype = np.float64)
+    data = np.asarray(data, dtype = np.float64)
+
+    if 'gas' in prefix:
+        lengths = np.diff(offsets)
+        data = convert_gases_to_umol_L(data,
+                                       np.repeat(np.asarray(liquid_phase_volumes, dtype = np.float64), lengths),
+                                       np.repeat(np.asarray(gas_phase_volumes, dtype = np.float64), lengths),
+                                       H2 = 'H2' in prefix)
+
+    time_reaction, data_reaction, reaction_offsets = ragged_offset_correction(time, data, offsets, offset, starts, ends)
+
+    data_smoothed = ragged_savgol_filter(data_reaction, reaction_offsets, savgol_window, savgol_polyorder)
+
+    data_diff, diff_offsets = ragged_diff(data_smoothed, reaction_offsets)
+    time_step, _ = ragged_diff(time_reaction, reaction_offsets)
+    data_diff = data_diff / time_step
+
+    within_trace = np.ones(len(time_reaction), dtype = bool)
+    within_trace[reaction_offsets[:-1]] = False
+    time_diff = time_reaction[within_trace]
+
+    data_diff_smoothed = ragged_savgol_filter(data_diff, diff_offsets, savgol_window_diff, savgol_polyorder_diff)
+
+    time_resampled, data_resampled, resampled_offsets = ragged_resample(time_reaction, data_reaction,
+                                                                        reaction_offsets, interval_resampling)
+    data_resampled_step, resampled_diff_offsets = ragged_diff(data_resampled, resampled_offsets)
+    time_resampled_step, _ = ragged_diff(time_resampled, resampled_offsets)
+    data_resampled_diff = data_resampled_step / time_resampled_step
+
+    within_trace = np.ones(len(time_resampled), dtype = bool)
+    within_trace[resampled_offsets[:-1]] = False
+    time_resampled_diff = time_resampled[within_trace]
+
+    data_poly_fit = ragged_polyfit(time_reaction, data_reaction, reaction_offsets, poly_order)
+
+    poly_fit_step, _ = ragged_diff(data_poly_fit, reaction_offsets)
+    poly_fit_diff = poly_fit_step / time_step
+    max_rate = np.maximum.reduceat(poly_fit_diff, diff_offsets[:-1])
+
+    processed_data = {
+        f'{prefix}_time_reaction': time_reaction,
+        f'{prefix}_data_reaction': data_reaction,
+        f'{prefix}_data_smoothed': data_smoothed,
+        f'{prefix}_data_diff': data_diff,
+        f'{prefix}_time_diff': time_diff,
+        f'{prefix}_data_resampled': data_resampled,
+        f'{prefix}_time_resampled': time_resampled,
+        f'{prefix}_data_resampled_diff': data_resampled_diff,
+        f'{prefix}_time_resampled_diff': time_resampled_diff,
+        f'{prefix}_data_diff_smoothed': data_diff_smoothed,
+        f'{prefix}_poly_fit': data_poly_fit,
+        f'{prefix}_poly_fit_diff': poly_fit_diff,
+        f'{prefix}_max_rate': max_rate,
+    }
+
+    key_offsets = {
+        f'{prefix}_time_reaction': reaction_offsets,
+        f'{prefix}_data_reaction': reaction_offsets,
+        f'{prefix}_data_smoothed': reaction_offsets,
+        f'{prefix}_data_diff': diff_offsets,
+        f'{prefix}_time_diff': diff_offsets,
+        f'{prefix}_data_resampled': resampled_offsets,
+        f'{prefix}_time_resampled': resampled_offsets,
+        f'{prefix}_data_resampled_diff': resampled_diff_offsets,
+        f'{prefix}_time_resampled_diff': resampled_diff_offsets,
+        f'{prefix}_data_diff_smoothed': diff_offsets,
+        f'{prefix}_poly_fit': reaction_offsets,
+        f'{prefix}_poly_fit_diff': diff_offsets,
+        f'{prefix}_max_rate': np.arange(len(offsets)),
+    }
+
+    return processed_data, key_offsets
+
+def batch_processing_data(time_traces,
+                          data_traces,
+                          starts,
+                          ends,
+                          prefix,
+                          liquid_phase_volumes,
+                          gas_phase_volumes,
+                          **processing_parameters):
+    '''
+    Processing a list of traces with one set of processing parameters (e.g. one
+    PROCESSING_PARAMETERS sub-dict). Returns one dict per trace, with the same keys and
+    values as data_processing.processing_data (arrays are views into the batch results).
+    '''
+
+    time, offsets = concatenate_traces(time_traces)
+    data, _ = concatenate_traces(data_traces)
+
+    processed_data, key_offsets = ragged_processing_data(
+        time,
+        data,
+        offsets,
+        starts = starts,
+        ends = ends,
+        prefix = prefix,
+        liquid_phase_volumes = liquid_phase_volumes,
+        gas_phase_volumes = gas_phase_volumes,
+        **processing_parameters
+    )
+
+    processed_traces = [{} for _ in time_traces]
+
+    for key, values in processed_data.items():
+        for processed_trace, trace_values in zip(processed_traces, split_traces(values, key_offsets[key])):
+            processed_trace[key] = trace_values
+
+    for processed_trace in processed_traces:
+        processed_trace[f'{prefix}_max_rate'] = processed_trace[f'{prefix}_max_rate'][0]
+
+    return processed_traces
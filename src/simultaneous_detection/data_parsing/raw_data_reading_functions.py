@@ -1,16 +1,81 @@
+import os
+import json
+import hashlib
+import tempfile
+import zipfile
+
+import numpy as np
 import pandas as pd
 
-def reading_H2_file(file_H2, mode = 'liquid'):
+try:
+    import pyarrow
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+RAW_DATA_CACHE_DIRECTORY = 'data/raw_data_cache'
+
+RAW_DATA_CACHE_STATISTICS = {'hits': 0, 'misses': 0}
+
+# Part of every raw data cache key: increase whenever the output of a reading function changes
+CACHE_FORMAT_VERSION = 2
+
+H2_COLUMN_MAPPING = {'time': 'Time since start (s)',
+                      'temperature': 'Sensor 2 - TEMP-UNIAMP (°C)',
+                      'pressure': 'Sensor 3 - Pressure (mbar)',
+                      'liquid': 'Sensor 1 - H2 (μmol/L)',
+                      'gas': 'Sensor 1 - H2 (Pa)'}
+
+def reading_H2_header(file_H2):
+    '''
+    Column names of a UniAmp H2 sensor file, read from its first line only.
+    '''
+
+    with open(file_H2, 'r', encoding = 'utf-8-sig') as file:
+        header = file.readline().rstrip('\r\n')
+
+    return header.split(';')
+
+def reading_H2_file(file_H2, 
+                    mode = 'liquid', 
+                    read_pressure = False,
+                    engine = None):
     '''
     Reading data from UniAmp H2 sensor files.
+    Only the time, H2 (μmol/L for mode = 'liquid', Pa for mode = 'gas') and temperature
+    columns are parsed, as float64; with read_pressure = True the pressure channel is 
+    read in the same pass and returned as 'H2_pressure_mbar'. 
+    engine is passed to pd.read_csv and defaults to 'pyarrow' when pyarrow is installed
+    and to the C engine otherwise.
     '''
 
-    raw_data = pd.read_csv(file_H2, sep = ';')
+    if mode not in ('liquid', 'gas'):
+        raise ValueError("Mode must be either 'liquid' or 'gas'.")
+
+    if engine is None:
+        engine = 'pyarrow' if PYARROW_AVAILABLE else 'c'
+
+    requested_columns = [H2_COLUMN_MAPPING['time'], 
+                         H2_COLUMN_MAPPING[mode], 
+                         H2_COLUMN_MAPPING['temperature']]
+
+    if read_pressure:
+        requested_columns.append(H2_COLUMN_MAPPING['pressure'])
+
+    # Projecting onto the columns present in the file, missing ones raise a KeyError below
+    header = reading_H2_header(file_H2)
+    usecols = [column for column in requested_columns if column in header]
+
+    raw_data = pd.read_csv(file_H2, 
+                           sep = ';', 
+                           usecols = usecols,
+                           dtype = {column: np.float64 for column in usecols},
+                           engine = engine)
     
-    time_s = raw_data['Time since start (s)'].to_numpy()
+    time_s = raw_data[H2_COLUMN_MAPPING['time']].to_numpy()
 
     try:
-        H2_temp = raw_data['Sensor 2 - TEMP-UNIAMP (°C)'].to_numpy()
+        H2_temp = raw_data[H2_COLUMN_MAPPING['temperature']].to_numpy()
     except KeyError:
         H2_temp = 0
 
@@ -19,61 +84,129 @@ def reading_H2_file(file_H2, mode = 'liquid'):
             'H2_temperature': H2_temp}
     
     if mode == 'liquid':
-        H2_umol_L = raw_data['Sensor 1 - H2 (μmol/L)'].to_numpy()
+        H2_umol_L = raw_data[H2_COLUMN_MAPPING['liquid']].to_numpy()
         raw_data_dict['H2_umol_L'] = H2_umol_L
 
     elif mode == 'gas':
-        H2_Pa = raw_data['Sensor 1 - H2 (Pa)'].to_numpy()
+        H2_Pa = raw_data[H2_COLUMN_MAPPING['gas']].to_numpy()
         raw_data_dict['H2_Pa'] = H2_Pa
-    
-    else:
-        raise ValueError("Mode must be either 'liquid' or 'gas'.")
+
+    if read_pressure:
+        raw_data_dict['H2_pressure_mbar'] = raw_data[H2_COLUMN_MAPPING['pressure']].to_numpy()
 
     return raw_data_dict
 
+O2_CHANNEL_MAPPING = {1: {'O2': 'Oxygen (%O2) [A Ch.1 Main]', 
+                          'dt': ' dt (s) [A Ch.1 Main]',
+                          'Temp': 'Sample Temp. (°C) [A Ch.1 CompT]'},
+                      2: {'O2': 'Oxygen (µmol/L) [A Ch.2 Main]',
+                          'dt': ' dt (s) [A Ch.2 Main]',
+                          'Temp': 'Sample Temp. (°C) [A Ch.2 CompT]'},
+                      3: {'O2': 'Oxygen (µmol/L) [A Ch.1 Main]', 
+                          'dt': ' dt (s) [A Ch.1 Main]',
+                          'Temp': 'Sample Temp. (°C) [A Ch.1 CompT]'},
+                      4: {'O2': 'Oxygen (%O2) [A Ch.2 Main]',
+                          'dt': ' dt (s) [A Ch.2 Main]',
+                          'Temp': 'Sample Temp. (°C) [A Ch.2 CompT]'},
+                      5: {'O2': 'Oxygen (%O2) [ Ch.1 Main]',
+                          'dt': ' dt (s) [ Ch.1 Main]',
+                          'Temp': 'Optical Temp. (°C) [ Ch.1 CompT]'}}
+
+FIRESTING_TIMESTAMP_FORMAT = '%d-%m-%Y %H:%M:%S.%f'
+
+def parse_firesting_file(file_O2, column_names):
+    '''
+    Single-pass parser for PyroScience Workbench (FireSting) text files.
+    The '#' header block is skipped, the column header is read once and only the requested
+    columns are collected as strings; fields behind the last requested column are not split.
+    Follows the pd.read_csv settings of the original reader: ISO8859 decoding, tab separation,
+    '#' starting a comment anywhere in a line and blank lines being skipped.
+    Returns a dict mapping column name to list of strings (empty fields as ''). Requested
+    columns that are not in the file are left out, so indexing them raises a KeyError,
+    as for the DataFrame returned by pd.read_csv.
+    '''
+
+    with open(file_O2, 'r', encoding = 'ISO8859', newline = '') as file:
+
+        header = None
+
+        for line in file:
+            line = line.split('#', 1)[0].rstrip('\r\n')
+            if line.strip():
+                header = line.split('\t')
+                break
+
+        if header is None:
+            raise ValueError(f'No column header found in {file_O2}')
+
+        column_indices = {column_name: header.index(column_name)
+                          for column_name in column_names if column_name in header}
+
+        if not column_indices:
+            return {}
+
+        # Fields behind the last requested column are left unsplit
+        max_split = max(column_indices.values()) + 1
+
+        text = file.read()
+
+        if '#' in text:
+            lines = [line.split('#', 1)[0] for line in text.split('\n')]
+        else:
+            lines = text.split('\n')
+
+        rows = [line.rstrip('\r').split('\t', max_split) for line in lines if line.strip()]
+
+    columns = {}
+
+    for column_name, index in column_indices.items():
+        columns[column_name] = [fields[index] if index < len(fields) else '' for fields in rows]
+
+    return columns
+
+def firesting_column_to_float(values):
+    '''
+    Converting a column of strings from parse_firesting_file to a float64 array, 
+    with empty fields as NaN.
+    '''
+
+    return np.array([value or 'nan' for value in values], dtype = np.float64)
+
 def reading_O2_file(file_O2,
-                    channel):
-    '''
-	Reading data from FireStingO2 files. 
-	channel 1 = gas phase O2 on channel 1
-	channel 2 = liquid phase O2 on channel 2
-	channel 3 = liquid phase O2 on channel 1
-	channel 4 = gas phase O2 on channel 2
-	channel 5 = gas phase O2 on channel 1 with updated naming convention
-	'''
-
-    channel_mapping = {1: {'O2': 'Oxygen (%O2) [A Ch.1 Main]', 
-						   'dt': ' dt (s) [A Ch.1 Main]',
-						   'Temp': 'Sample Temp. (°C) [A Ch.1 CompT]'},
-					   2: {'O2': 'Oxygen (µmol/L) [A Ch.2 Main]',
-					   	   'dt': ' dt (s) [A Ch.2 Main]',
-					   	   'Temp': 'Sample Temp. (°C) [A Ch.2 CompT]'},
-					   3: {'O2': 'Oxygen (µmol/L) [A Ch.1 Main]', 
-						   'dt': ' dt (s) [A Ch.1 Main]',
-						   'Temp': 'Sample Temp. (°C) [A Ch.1 CompT]'},
-					   4: {'O2': 'Oxygen (%O2) [A Ch.2 Main]',
-					   	   'dt': ' dt (s) [A Ch.2 Main]',
-					   	   'Temp': 'Sample Temp. (°C) [A Ch.2 CompT]'},
-					   5: {'O2': 'Oxygen (%O2) [ Ch.1 Main]',
-							'dt': ' dt (s) [ Ch.1 Main]',
-							'Temp': 'Optical Temp. (°C) [ Ch.1 CompT]'}}
-				
-    data = pd.read_csv(
-                file_O2, 
-				encoding = 'ISO8859', 
-                sep = '	', 
-				skip_blank_lines = True, 
-                comment = '#', 
-                parse_dates = [0], 
-                dayfirst = True)
-	
-    data_strings = channel_mapping[channel]
-
-    o2_data = data[data_strings['O2']].to_numpy()
-    time = data[data_strings['dt']].to_numpy()
+                    channel,
+                    parse_timestamps = False):
+    '''
+    Reading data from FireStingO2 files. 
+    channel 1 = gas phase O2 on channel 1
+    channel 2 = liquid phase O2 on channel 2
+    channel 3 = liquid phase O2 on channel 1
+    channel 4 = gas phase O2 on channel 2
+    channel 5 = gas phase O2 on channel 1 with updated naming convention
+
+    Only the columns of the requested channel are decoded (see parse_firesting_file).
+    Timestamps are not needed for processing and are only parsed with 
+    parse_timestamps = True, returned as 'O2_timestamps' (datetime64).
+    '''
+
+    data_strings = O2_CHANNEL_MAPPING[channel]
+
+    # Date and time columns of the channel share the bracketed suffix of its dt column
+    channel_suffix = data_strings['dt'][data_strings['dt'].index('['):]
+    date_column = f'Date {channel_suffix}'
+    time_column = f'Time {channel_suffix}'
+
+    column_names = [data_strings['O2'], data_strings['dt'], data_strings['Temp']]
+
+    if parse_timestamps:
+        column_names += [date_column, time_column]
+
+    columns = parse_firesting_file(file_O2, column_names)
+
+    o2_data = firesting_column_to_float(columns[data_strings['O2']])
+    time = firesting_column_to_float(columns[data_strings['dt']])
 
     try:
-        temp = data[data_strings['Temp']].to_numpy()
+        temp = firesting_column_to_float(columns[data_strings['Temp']])
     except KeyError:
         temp = 0
 
@@ -83,7 +216,125 @@ def reading_O2_file(file_O2,
         'O2_temperature': temp
     }
 
+    if parse_timestamps:
+        timestamps = pd.to_datetime(
+                        pd.Series(columns[date_column]) + ' ' + pd.Series(columns[time_column]),
+                        format = FIRESTING_TIMESTAMP_FORMAT,
+                        errors = 'coerce')
+        raw_data_dict['O2_timestamps'] = timestamps.to_numpy()
+
+    return raw_data_dict
+
+def hash_file(file_name, chunk_size = 1 << 20):
+    '''
+    SHA-256 hash of the content of a file, read in chunks.
+    '''
+
+    file_hash = hashlib.sha256()
+
+    with open(file_name, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+def raw_data_cache_key(file_name, reading_function, **reading_kwargs):
+    '''
+    Cache key for a parsed raw data file: content hash of the file combined with the
+    reading function, its options (mode, channel) and CACHE_FORMAT_VERSION, so that the
+    same file read with a different channel mapping or by a changed reader gets its own entry.
+    '''
+
+    options = json.dumps({'function': reading_function.__name__,
+                          'format_version': CACHE_FORMAT_VERSION,
+                          **reading_kwargs}, sort_keys = True)
+    key_hash = hashlib.sha256(f'{hash_file(file_name)}|{options}'.encode('utf-8'))
+
+    return key_hash.hexdigest()
+
+def save_raw_data_to_cache(raw_data_dict, cache_file):
+    '''
+    Storing a raw data dictionary as .npz. The file is first written to a temporary
+    file and then moved into place, so that concurrent workers never see partial entries.
+    '''
+
+    cache_directory = os.path.dirname(cache_file)
+    os.makedirs(cache_directory, exist_ok = True)
+
+    file_descriptor, temporary_file = tempfile.mkstemp(dir = cache_directory, suffix = '.npz.tmp')
+
+    try:
+        with os.fdopen(file_descriptor, 'wb') as file:
+            np.savez(file, **{key: np.asarray(value) for key, value in raw_data_dict.items()})
+        os.replace(temporary_file, cache_file)
+    except BaseException:
+        os.remove(temporary_file)
+        raise
+
+def load_raw_data_from_cache(cache_file):
+    '''
+    Loading a raw data dictionary stored by save_raw_data_to_cache. 0-d arrays (e.g. the
+    temperature fallback of 0) are converted back to Python scalars.
+    '''
+
+    raw_data_dict = {}
+
+    with np.load(cache_file) as cached_data:
+        for key in cached_data.files:
+            value = cached_data[key]
+            raw_data_dict[key] = value.item() if value.ndim == 0 else value
+
     return raw_data_dict
 
+def cached_reading(reading_function, 
+                   file_name, 
+                   cache_directory = RAW_DATA_CACHE_DIRECTORY, 
+                   **reading_kwargs):
+    '''
+    Reading a raw data file through the on-disk cache.
+    reading_function is reading_H2_file or reading_O2_file, reading_kwargs are passed on to it
+    (mode or channel) and are part of the cache key. Only files whose content changed since the
+    last run are parsed again. With cache_directory = None the cache is bypassed.
+    Hits and misses are counted in RAW_DATA_CACHE_STATISTICS (per process).
+    '''
+
+    if cache_directory is None:
+        return reading_function(file_name, **reading_kwargs)
+
+    cache_key = raw_data_cache_key(file_name, reading_function, **reading_kwargs)
+    cache_file = os.path.join(cache_directory, f'{cache_key}.npz')
+
+    if os.path.exists(cache_file):
+        try:
+            raw_data_dict = load_raw_data_from_cache(cache_file)
+            RAW_DATA_CACHE_STATISTICS['hits'] += 1
+            return raw_data_dict
+        except (OSError, ValueError, zipfile.BadZipFile):
+            pass # Corrupted entry, parsed again and overwritten below
+
+    raw_data_dict = reading_function(file_name, **reading_kwargs)
+    save_raw_data_to_cache(raw_data_dict, cache_file)
+    RAW_DATA_CACHE_STATISTICS['misses'] += 1
+
+    return raw_data_dict
+
+def list_raw_data_cache(cache_directory = RAW_DATA_CACHE_DIRECTORY):
+    '''
+    Set of the entries currently stored in the raw data cache.
+    '''
+
+    if not os.path.isdir(cache_directory):
+        return set()
+
+    return {file for file in os.listdir(cache_directory) if file.endswith('.npz')}
+
+def print_raw_data_cache_statistics(statistics):
+    '''
+    Printing raw data cache hits and misses of a dataset generation run.
+    '''
 
+    total = statistics['hits'] + statistics['misses']
+    hit_rate = statistics['hits'] / total if total else 0.0
 
+    print(f"Raw data cache: {statistics['hits']} hits, {statistics['misses']} misses "
+          f"({hit_rate:.0%} of {total} files read from cache)")
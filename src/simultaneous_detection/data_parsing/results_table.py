@@ -0,0 +1,149 @@
+import os
+import json
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from pyKES.database.database_experiments import read_df_from_hdf
+
+from simultaneous_detection.data_parsing.raw_data_reading_functions import PYARROW_AVAILABLE
+from simultaneous_detection.data_parsing.lazy_dataset import SCALAR_INDEX_ATTRIBUTE, scalar_entries
+
+def flatten_scalars(scalars):
+    '''
+    Flattening the scalar entries of processed_data into columns. Nested dicts such as
+    'Fit_all_rate_constants' become one column per entry, e.g. 'Fit_all_rate_constants/k1'.
+    '''
+
+    columns = {}
+
+    for key, value in scalars.items():
+        if isinstance(value, dict):
+            for name, nested_value in value.items():
+                columns[f'{key}/{name}'] = nested_value
+        else:
+            columns[key] = value
+
+    return columns
+
+def build_results_table(filename):
+    '''
+    One row per experiment of a dataset .h5 file and one column per scalar result
+    (max rates, rate constants, fitting errors, ...), joined with the overview sheet.
+    The scalars are taken from the scalar index of each experiment group (see
+    lazy_dataset.write_scalar_index) or, for files without index, read from processed_data.
+    Experiments of the overview sheet without processed data keep empty result columns.
+    '''
+
+    rows = []
+
+    with h5py.File(filename, 'r') as f:
+        overview_df = read_df_from_hdf(f, key = 'overview_df')
+
+        for exp_name in f.keys():
+            if exp_name == 'overview_df':
+                continue
+
+            exp_group = f[exp_name]
+
+            if SCALAR_INDEX_ATTRIBUTE in exp_group.attrs:
+                scalars = json.loads(exp_group.attrs[SCALAR_INDEX_ATTRIBUTE]).get('processed_data', {})
+            elif 'processed_data' in exp_group:
+                scalars = scalar_entries(exp_group['processed_data'])
+            else:
+                scalars = {}
+
+            rows.append({'Experiment': exp_name, **flatten_scalars(scalars)})
+
+    results = pd.DataFrame(rows, columns = ['Experiment'] if not rows else None)
+
+    if overview_df.empty:
+        return results
+
+    return overview_df.merge(results, on = 'Experiment', how = 'left')
+
+def write_columnar_hdf5(table, filename):
+    '''
+    Writing a DataFrame to an HDF5 file as one dataset per column, so that single columns
+    can be read without the rest. Numeric and boolean columns keep their dtype, all other
+    columns are stored as strings (missing values as '').
+    '''
+
+    with h5py.File(filename, 'w') as f:
+        f.attrs['columns'] = json.dumps(list(table.columns))
+
+        for index, column in enumerate(table.columns):
+            values = table[column]
+
+            if values.dtype.kind in 'biuf':
+                data = values.to_numpy()
+            else:
+                data = values.where(values.notna(), '').astype(str).to_numpy(dtype = object)
+                data = np.array(data, dtype = h5py.string_dtype())
+
+            # Column names may contain '/', so datasets are named by position
+            f.create_dataset(f'column_{index}', data = data)
+
+def read_columnar_hdf5(filename, columns = None):
+    '''
+    Reading a table written by write_columnar_hdf5, optionally only some columns.
+    '''
+
+    with h5py.File(filename, 'r') as f:
+        all_columns = json.loads(f.attrs['columns'])
+        columns = all_columns if columns is None else columns
+
+        data = {}
+
+        for column in columns:
+            dataset = f[f'column_{all_columns.index(column)}']
+
+            if h5py.check_string_dtype(dataset.dtype):
+                data[column] = dataset.asstr()[()]
+            else:
+                data[column] = dataset[()]
+
+    return pd.DataFrame(data)
+
+def results_table_file(filename):
+    '''
+    Default results table next to a dataset .h5 file: Parquet if pyarrow is available,
+    a columnar HDF5 file otherwise.
+    '''
+
+    extension = 'parquet' if PYARROW_AVAILABLE else 'h5'
+
+    return f'{os.path.splitext(filename)[0]}_results.{extension}'
+
+def write_results_table(filename, table_file = None):
+    '''
+    Building the results table of a dataset .h5 file and saving it as Parquet or columnar
+    HDF5, depending on the extension of table_file (default see results_table_file).
+    Returns the path of the table.
+    '''
+
+    table_file = table_file or results_table_file(filename)
+    table = build_results_table(filename)
+
+    if table_file.endswith('.parquet'):
+        table.to_parquet(table_file, index = False)
+    else:
+        write_columnar_hdf5(table, table_file)
+
+    return table_file
+
+def read_results_table(table_file, columns = None):
+    '''
+    Reading a results table written by write_results_table, optionally only some columns.
+
+    Usage:
+        table = read_results_table('data/..._results.parquet',
+                                   columns = ['Experiment', 'group', 'Fit_all_rate_constants/k2'])
+        table.groupby('group')['Fit_all_rate_constants/k2'].agg(['mean', 'std'])
+    '''
+
+    if table_file.endswith('.parquet'):
+        return pd.read_parquet(table_file, columns = columns)
+
+    return read_columnar_hdf5(table_file, columns = columns)
@@ -0,0 +1,425 @@
+import os
+import json
+import pickle
+import hashlib
+import argparse
+import tempfile
+import time
+from io import StringIO
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from pyKES.database.database_experiments import Experiment, ExperimentalDataset
+
+SNAPSHOT_DIRECTORY = 'data/snapshots'
+
+def object_path(store_directory, object_hash, extension):
+    return os.path.join(store_directory, 'objects', object_hash[:2], f'{object_hash[2:]}.{extension}')
+
+def write_atomically(path, write):
+    '''
+    Writing a file through a temporary file in the same directory, so that an interrupted
+    write never leaves a partial object or manifest.
+    '''
+
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    file_descriptor, temporary_path = tempfile.mkstemp(dir = os.path.dirname(path), suffix = '.tmp')
+
+    try:
+        with os.fdopen(file_descriptor, 'wb') as file:
+            write(file)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+def store_object(path, write):
+    '''
+    Writing an object unless it is already stored. A reused object is touched, so that
+    collect_garbage running meanwhile does not delete it before the manifest is written.
+    '''
+
+    if os.path.exists(path):
+        try:
+            os.utime(path)
+            return
+        except FileNotFoundError:
+            pass
+
+    write_atomically(path, write)
+
+def store_value(value, store_directory):
+    '''
+    Manifest entry of a value: arrays are stored once in the object store under the hash of
+    their dtype, shape and content ({'array': hash, 'dtype', 'shape'}), dicts become dicts of
+    entries, JSON values are kept inline and anything else is pickled into the store
+    ({'pickle': hash}).
+    '''
+
+    if isinstance(value, dict):
+        return {'dict': {str(key): store_value(item, store_directory) for key, item in value.items()}}
+
+    if isinstance(value, (np.integer, np.floating, np.bool_)):
+        value = value.item()
+
+    if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+        array = np.ascontiguousarray(value)
+        array_hash = hashlib.sha256(f'{array.dtype.str}|{array.shape}|'.encode('utf-8'))
+        array_hash.update(array.tobytes())
+        object_hash = array_hash.hexdigest()
+        path = object_path(store_directory, object_hash, 'npy')
+
+        store_object(path, lambda file: np.save(file, array, allow_pickle = False))
+
+        return {'array': object_hash, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return {'value': value}
+
+    try:
+        return {'json': json.loads(json.dumps(value))}
+    except (TypeError, ValueError):
+        data = pickle.dumps(value)
+        object_hash = hashlib.sha256(data).hexdigest()
+        path = object_path(store_directory, object_hash, 'pickle')
+
+        store_object(path, lambda file: file.write(data))
+
+        return {'pickle': object_hash}
+
+def load_value(entry, store_directory, memory_map = True):
+    '''
+    Value of a manifest entry (see store_value). Arrays are memory-mapped read-only by default.
+    '''
+
+    if 'dict' in entry:
+        return {key: load_value(item, store_directory, memory_map) for key, item in entry['dict'].items()}
+    if 'array' in entry:
+        return np.load(object_path(store_directory, entry['array'], 'npy'), mmap_mode = 'r' if memory_map else None)
+    if 'pickle' in entry:
+        with open(object_path(store_directory, entry['pickle'], 'pickle'), 'rb') as file:
+            return pickle.load(file)
+    if 'json' in entry:
+        return entry['json']
+
+    return entry['value']
+
+def manifest_path(store_directory, name):
+    return os.path.join(store_directory, 'manifests', f'{name}.json')
+
+def create_snapshot(source, name = None, store_directory = SNAPSHOT_DIRECTORY, note = ''):
+    '''
+    Storing a dataset (ExperimentalDataset or a dataset .h5 file) as snapshot: every array
+    goes into the content-addressed object store, where arrays already stored by earlier
+    snapshots are not written again, and the snapshot itself is a small JSON manifest of
+    hashes and scalars. name defaults to the file name of source or a timestamp.
+    Returns the name.
+
+    Usage:
+        create_snapshot('data/251130_processed_O2_H2_data.h5')
+        create_snapshot('data/251204_processed_O2_H2_data_with_fits.h5')
+        print_snapshot_diff(diff_snapshots('251130_processed_O2_H2_data',
+                                           '251204_processed_O2_H2_data_with_fits'))
+    '''
+
+    if isinstance(source, str):
+        name = name or os.path.splitext(os.path.basename(source))[0]
+        dataset = ExperimentalDataset.load_from_hdf5(source)
+        source_name = source
+    else:
+        name = name or f'{datetime.now():%y%m%d_%H%M%S}'
+        dataset = source
+        source_name = ''
+
+    path = manifest_path(store_directory, name)
+
+    if os.path.exists(path):
+        raise ValueError(f'Snapshot {name} already exists in {store_directory}')
+
+    manifest = {'name': name,
+                'created': datetime.now().isoformat(timespec = 'seconds'),
+                'source': source_name,
+                'note': note,
+                'overview_df': dataset.overview_df.to_json(orient = 'split', date_format = 'iso'),
+                'attributes': {attribute: store_value(getattr(dataset, attribute, None) or {}, store_directory)
+                               for attribute in ('plotting_instruction', 'group_mapping', 'processing_parameters', 'version')},
+                'experiments': {}}
+
+    for exp_name, experiment in dataset.experiments.items():
+        manifest['experiments'][exp_name] = {
+            'attributes': {attribute: store_value(getattr(experiment, attribute, None), store_directory)
+                           for attribute in ('experiment_name', 'raw_data_file', 'color', 'group', 'version')},
+            **{data_group_name: {key: store_value(value, store_directory)
+                                 for key, value in (getattr(experiment, data_group_name) or {}).items()}
+               for data_group_name in ('raw_data', 'metadata', 'processed_data')}
+        }
+
+    write_atomically(path, lambda file: file.write(json.dumps(manifest).encode('utf-8')))
+
+    return name
+
+def read_manifest(name, store_directory = SNAPSHOT_DIRECTORY):
+
+    with open(manifest_path(store_directory, name)) as file:
+        return json.load(file)
+
+def load_snapshot(name, store_directory = SNAPSHOT_DIRECTORY, memory_map = True):
+    '''
+    ExperimentalDataset of a snapshot. Arrays are read-only memory maps of the object store
+    unless memory_map = False.
+    '''
+
+    manifest = read_manifest(name, store_directory)
+
+    dataset = ExperimentalDataset(overview_df = pd.read_json(StringIO(manifest['overview_df']), orient = 'split'))
+
+    for attribute, entry in manifest['attributes'].items():
+        setattr(dataset, attribute, load_value(entry, store_directory, memory_map))
+
+    for exp_name, stored in manifest['experiments'].items():
+        attributes = {attribute: load_value(entry, store_directory, memory_map)
+                      for attribute, entry in stored['attributes'].items()}
+
+        experiment = Experiment(
+            experiment_name = attributes['experiment_name'],
+            raw_data_file = attributes['raw_data_file'],
+            color = attributes['color'],
+            group = attributes['group'],
+            **{data_group_name: {key: load_value(entry, store_directory, memory_map)
+                                 for key, entry in stored[data_group_name].items()}
+               for data_group_name in ('raw_data', 'metadata', 'processed_data')}
+        )
+        experiment.version = attributes['version'] or {}
+
+        dataset.experiments[exp_name] = experiment
+
+    return dataset
+
+def entry_objects(entry):
+    '''
+    Objects (hash, extension) referenced by a manifest entry of store_value.
+    '''
+
+    if 'dict' in entry:
+        return set().union(*(entry_objects(item) for item in entry['dict'].values()))
+    if 'array' in entry:
+        return {(entry['array'], 'npy')}
+    if 'pickle' in entry:
+        return {(entry['pickle'], 'pickle')}
+
+    return set()
+
+def manifest_objects(manifest):
+    '''
+    Objects (hash, extension) referenced by a snapshot: the dataset attributes and, per
+    experiment, the attributes, raw_data, metadata and processed_data entries.
+    '''
+
+    entries = list(manifest['attributes'].values())
+
+    for stored in manifest['experiments'].values():
+        for part in ('attributes', 'raw_data', 'metadata', 'processed_data'):
+            entries.extend(stored[part].values())
+
+    return set().union(*(entry_objects(entry) for entry in entries))
+
+def list_snapshots(store_directory = SNAPSHOT_DIRECTORY):
+    '''
+    The snapshots of a store with their creation time, source, number of experiments and
+    the size of the objects they reference (shared objects count for every snapshot).
+    '''
+
+    rows = []
+    manifest_directory = os.path.join(store_directory, 'manifests')
+
+    for file_name in sorted(os.listdir(manifest_directory)) if os.path.isdir(manifest_directory) else []:
+        if not file_name.endswith('.json'):
+            continue
+
+        manifest = read_manifest(file_name[:-len('.json')], store_directory)
+        objects = manifest_objects(manifest)
+
+        rows.append({'name': manifest['name'],
+                     'created': manifest['created'],
+                     'source': manifest['source'],
+                     'note': manifest['note'],
+                     'experiments': len(manifest['experiments']),
+                     'referenced_MB': sum(os.path.getsize(object_path(store_directory, object_hash, extension))
+                                          for object_hash, extension in objects) / 1024 ** 2,
+                     'manifest_kB': os.path.getsize(os.path.join(manifest_directory, file_name)) / 1024})
+
+    return pd.DataFrame(rows, columns = ['name', 'created', 'source', 'note', 'experiments', 'referenced_MB', 'manifest_kB'])
+
+def store_size(store_directory = SNAPSHOT_DIRECTORY):
+    '''
+    Disk usage of the object store and of the manifests in bytes.
+    '''
+
+    sizes = {}
+
+    for part in ('objects', 'manifests'):
+        sizes[part] = sum(os.path.getsize(os.path.join(directory, file_name))
+                          for directory, _, file_names in os.walk(os.path.join(store_directory, part))
+                          for file_name in file_names)
+
+    return sizes
+
+def diff_snapshots(name_before, name_after, store_directory = SNAPSHOT_DIRECTORY):
+    '''
+    Differences between two snapshots, from their manifests only (arrays are compared by
+    hash, no array is read): experiments added and removed, and for every experiment in both
+    the changed attributes and keys of raw_data, metadata and processed_data, as
+    {key: (entry before, entry after)} with None for keys that exist in only one snapshot.
+    '''
+
+    before = read_manifest(name_before, store_directory)
+    after = read_manifest(name_after, store_directory)
+
+    diff = {'before': name_before,
+            'after': name_after,
+            'overview_changed': before['overview_df'] != after['overview_df'],
+            'attributes': {attribute: (before['attributes'].get(attribute), after['attributes'].get(attribute))
+                           for attribute in before['attributes'].keys() | after['attributes'].keys()
+                           if before['attributes'].get(attribute) != after['attributes'].get(attribute)},
+            'added': [exp_name for exp_name in after['experiments'] if exp_name not in before['experiments']],
+            'removed': [exp_name for exp_name in before['experiments'] if exp_name not in after['experiments']],
+            'changed': {},
+            'unchanged': []}
+
+    for exp_name, experiment_before in before['experiments'].items():
+        if exp_name not in after['experiments']:
+            continue
+
+        experiment_after = after['experiments'][exp_name]
+        changes = {}
+
+        for part in ('attributes', 'raw_data', 'metadata', 'processed_data'):
+            entries_before, entries_after = experiment_before[part], experiment_after[part]
+            changed_keys = {key: (entries_before.get(key), entries_after.get(key))
+                            for key in sorted(entries_before.keys() | entries_after.keys())
+                            if entries_before.get(key) != entries_after.get(key)}
+
+            if changed_keys:
+                changes[part] = changed_keys
+
+        if changes:
+            diff['changed'][exp_name] = changes
+        else:
+            diff['unchanged'].append(exp_name)
+
+    return diff
+
+def describe_entry(entry):
+    '''
+    Short description of a manifest entry for print_snapshot_diff.
+    '''
+
+    if entry is None:
+        return '-'
+    if 'array' in entry:
+        return f"array{tuple(entry['shape'])} {entry['array'][:8]}"
+    if 'value' in entry:
+        return repr(entry['value'])
+    if 'dict' in entry:
+        return f"dict({len(entry['dict'])})"
+
+    return next(iter(entry))
+
+def print_snapshot_diff(diff, max_keys = 20):
+
+    print(f"Snapshot diff {diff['before']} -> {diff['after']}")
+    print(f"    overview sheet {'changed' if diff['overview_changed'] else 'unchanged'}")
+
+    for attribute in diff['attributes']:
+        print(f'    dataset {attribute} changed')
+
+    print(f"    {len(diff['added'])} experiments added: {', '.join(diff['added'])}")
+    print(f"    {len(diff['removed'])} experiments removed: {', '.join(diff['removed'])}")
+    print(f"    {len(diff['unchanged'])} experiments unchanged, {len(diff['changed'])} changed")
+
+    for exp_name, changes in diff['changed'].items():
+        print(f'    {exp_name}')
+
+        for part, changed_keys in changes.items():
+            for key, (before, after) in list(changed_keys.items())[:max_keys]:
+                print(f'        {part}/{key}: {describe_entry(before)} -> {describe_entry(after)}')
+
+            if len(changed_keys) > max_keys:
+                print(f'        {part}: {len(changed_keys) - max_keys} more keys changed')
+
+def delete_snapshot(name, store_directory = SNAPSHOT_DIRECTORY):
+    '''
+    Removing the manifest of a snapshot; its objects are removed by collect_garbage if no
+    other snapshot references them.
+    '''
+
+    os.remove(manifest_path(store_directory, name))
+
+def collect_garbage(store_directory = SNAPSHOT_DIRECTORY, grace_period = 3600):
+    '''
+    Deleting objects that no snapshot references. Objects written or reused (see store_value)
+    within the last grace_period seconds are kept, as they may belong to a snapshot whose
+    manifest is still being created; create_snapshot calls that take longer must not run
+    concurrently. Returns the number of bytes freed.
+    '''
+
+    scan_start = time.time()
+    manifest_directory = os.path.join(store_directory, 'manifests')
+    referenced = set()
+
+    for file_name in os.listdir(manifest_directory):
+        if file_name.endswith('.json'):
+            referenced |= manifest_objects(read_manifest(file_name[:-len('.json')], store_directory))
+
+    referenced_paths = {object_path(store_directory, object_hash, extension) for object_hash, extension in referenced}
+    freed = 0
+
+    for directory, _, file_names in os.walk(os.path.join(store_directory, 'objects')):
+        for file_name in file_names:
+            path = os.path.join(directory, file_name)
+
+            if path not in referenced_paths and os.path.getmtime(path) < scan_start - grace_period:
+                freed += os.path.getsize(path)
+                os.remove(path)
+
+    return freed
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Content-addressed store of dataset snapshots.')
+    parser.add_argument('--store', default = SNAPSHOT_DIRECTORY)
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+    create_parser = subparsers.add_parser('create', help = 'store dataset .h5 files as snapshots')
+    create_parser.add_argument('files', nargs = '+')
+    create_parser.add_argument('--note', default = '')
+
+    subparsers.add_parser('list', help = 'list the snapshots')
+
+    diff_parser = subparsers.add_parser('diff', help = 'compare two snapshots')
+    diff_parser.add_argument('before')
+    diff_parser.add_argument('after')
+
+    delete_parser = subparsers.add_parser('delete', help = 'delete snapshots and their unreferenced objects')
+    delete_parser.add_argument('names', nargs = '+')
+
+    args = parser.parse_args()
+
+    if args.command == 'create':
+        for file_name in args.files:
+            print(f'Snapshot {create_snapshot(file_name, store_directory = args.store, note = args.note)} created')
+        print(f'Store size: {sum(store_size(args.store).values()) / 1024 ** 2:.1f} MB')
+    elif args.command == 'list':
+        print(list_snapshots(args.store).to_string(index = False))
+    elif args.command == 'diff':
+        print_snapshot_diff(diff_snapshots(args.before, args.after, args.store))
+    else:
+        for name in args.names:
+            delete_snapshot(name, args.store)
+        print(f'{collect_garbage(args.store) / 1024 ** 2:.1f} MB freed')
+
+
+if __name__ == "__main__":
+    main()
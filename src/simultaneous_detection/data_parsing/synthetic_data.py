@@ -0,0 +1,440 @@
+import os
+import time
+import argparse
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+from simultaneous_detection.data_parsing.raw_data_reading_functions import H2_COLUMN_MAPPING, O2_CHANNEL_MAPPING
+from simultaneous_detection.data_parsing.processing_parameters import PROCESSING_PARAMETERS, GROUP_MAPPING
+from simultaneous_detection.fitting.compiled_network import compile_network
+
+SYNTHETIC_RATE_CONSTANTS = {'k1': 4.3e-9, 'k2': 2.0e-3, 'k3': 4.5e-3}
+
+SYNTHETIC_START_TIME = datetime(2025, 10, 20, 21, 5, 23)
+
+MOLAR_VOLUME_STANDARD_CONDITIONS = 24.465 # L/mol at 25C and 1 atm, as in convert_gases_to_umol_L
+NORMAL_PRESSURE = 1013.25
+
+# Standard deviation of the sensor noise of the bundled experiments, in the units of the readings
+SENSOR_NOISE = {'H2_umol_L': 0.07, 'H2_Pa': 7.0, 'O2_umol_L': 0.002, 'O2_percent': 0.00015}
+
+def gas_from_umol_L(data, liquid_phase_volume, gas_phase_volume, H2 = False):
+    '''
+    Inverse of data_processing.convert_gases_to_umol_L: gas phase concentration (μmol per L of
+    liquid phase) to the sensor reading (vol% O2, or Pa H2 for H2 = True).
+    '''
+
+    gas_umol = data * liquid_phase_volume / 1000
+    gas_L = gas_umol / 1e6 * MOLAR_VOLUME_STANDARD_CONDITIONS
+    data = gas_L / (gas_phase_volume / 1000) * 100
+
+    if H2 is True:
+        data = data * NORMAL_PRESSURE
+
+    return data
+
+def simulate_reaction(time,
+                      irradiation_start,
+                      irradiation_end,
+                      rate_constants = SYNTHETIC_RATE_CONSTANTS,
+                      fitting_parameters = PROCESSING_PARAMETERS['fitting_parameters']):
+    '''
+    Concentrations of all species of the reaction network of fitting_parameters at time:
+    nothing before irradiation_start, the network with rate_constants during irradiation and
+    without the light-driven first reaction (its rate constant set to 0) after irradiation_end.
+    Returns {species: array}.
+    '''
+
+    network = compile_network(fitting_parameters['reaction_network'])
+    other_multipliers = fitting_parameters.get('other_multipliers', {})
+    light_rate_constant = network.parsed_reactions[0]['rate_constant']
+
+    concentrations = {species: np.zeros(len(time)) for species in network.species}
+    state = dict(fitting_parameters['initial_conditions'])
+
+    phases = [(irradiation_start, irradiation_end, rate_constants),
+              (irradiation_end, np.inf, {**rate_constants, light_rate_constant: 0.0})]
+
+    for phase_start, phase_end, phase_rate_constants in phases:
+        in_phase = (time >= phase_start) & (time < phase_end)
+
+        if not np.any(in_phase):
+            continue
+
+        times = np.concatenate(([phase_start], time[in_phase]))
+        solution = network.solve(phase_rate_constants, state, times, other_multipliers)
+
+        for index, species in enumerate(network.species):
+            concentrations[species][in_phase] = solution[1:, index]
+
+        state = {species: solution[-1, index] for index, species in enumerate(network.species)}
+
+    return concentrations
+
+def sensor_response(values, sample_interval, lag):
+    '''
+    Reading of a sensor with a first order response (time constant lag in s) to values sampled
+    every sample_interval seconds.
+    '''
+
+    if lag <= 0 or len(values) == 0:
+        return values
+
+    alpha = 1 - np.exp(-sample_interval / lag)
+    response, _ = lfilter([alpha], [1, alpha - 1], values, zi = [(1 - alpha) * values[0]])
+
+    return response
+
+def simulate_raw_data(duration = 3000.0,
+                      irradiation_start = 600.0,
+                      irradiation_end = 2400.0,
+                      mode = 'liquid',
+                      liquid_phase_volume = 25.0,
+                      gas_phase_volume = 58.0,
+                      rate_constants = SYNTHETIC_RATE_CONSTANTS,
+                      H2_sample_interval = 1.0,
+                      O2_sample_interval = 1.0,
+                      O2_logger_offset = 0.0,
+                      H2_lag = 0.0,
+                      O2_lag = 0.0,
+                      noise = 1.0,
+                      temperature = 20.0,
+                      seed = 0):
+    '''
+    Simulated H2 and O2 sensor traces (see simulate_reaction) as the raw_data_dict of
+    raw_data_reading_function, in the units of the sensors: μmol/L of the dissolved gases for
+    mode = 'liquid', Pa H2 and vol% O2 in the gas phase for mode = 'gas'.
+    Irradiation times are on the clock of the H2 logger; the O2 logger started O2_logger_offset
+    seconds later, so its irradiation start is irradiation_start - O2_logger_offset.
+    H2_lag and O2_lag are the response times of the sensors (see sensor_response), noise scales
+    the Gaussian noise of SENSOR_NOISE.
+    '''
+
+    rng = np.random.default_rng(seed)
+    time_H2 = np.arange(0.0, duration, H2_sample_interval)
+    time_O2 = np.arange(0.0, duration - O2_logger_offset, O2_sample_interval)
+
+    concentrations_H2 = simulate_reaction(time_H2, irradiation_start, irradiation_end, rate_constants)
+    concentrations_O2 = simulate_reaction(time_O2 + O2_logger_offset, irradiation_start, irradiation_end, rate_constants)
+
+    if mode == 'gas':
+        H2 = gas_from_umol_L(concentrations_H2['[H2-g]'], liquid_phase_volume, gas_phase_volume, H2 = True)
+        O2 = gas_from_umol_L(concentrations_O2['[O2-g]'], liquid_phase_volume, gas_phase_volume)
+        H2_key, O2_noise = 'H2_Pa', SENSOR_NOISE['O2_percent']
+    else:
+        H2, O2 = concentrations_H2['[H2-aq]'], concentrations_O2['[O2-aq]']
+        H2_key, O2_noise = 'H2_umol_L', SENSOR_NOISE['O2_umol_L']
+
+    H2 = sensor_response(H2, H2_sample_interval, H2_lag) + rng.normal(0, noise * SENSOR_NOISE[H2_key], len(time_H2))
+    O2 = sensor_response(O2, O2_sample_interval, O2_lag) + rng.normal(0, noise * O2_noise, len(time_O2))
+
+    return {'H2_time_s': time_H2,
+            'H2_temperature': temperature + rng.normal(0, 0.01, len(time_H2)),
+            H2_key: H2,
+            'O2_time_s': time_O2,
+            'O2_data': O2,
+            'O2_temperature': temperature + rng.normal(0, 0.01, len(time_O2))}
+
+def uniamp_header(mode = 'liquid'):
+    '''
+    Column names of a UniAmp H2 sensor file (see reading_H2_file).
+    '''
+
+    return ['Time (YYYY-MM-DD hh:mm:ss)',
+            'Time (ms)',
+            H2_COLUMN_MAPPING['time'],
+            'Raw, Sensor 1 - H2 (MilliVolt)',
+            H2_COLUMN_MAPPING[mode],
+            'Cal. ID, Sensor 1 - H2',
+            'Raw, Sensor 2 - TEMP-UNIAMP (Temperature)',
+            H2_COLUMN_MAPPING['temperature'],
+            'Cal. ID, Sensor 2 - TEMP-UNIAMP',
+            'Raw, Sensor 3 - Pressure (MilliVolt)',
+            H2_COLUMN_MAPPING['pressure'],
+            'Cal. ID, Sensor 3 - Pressure']
+
+def write_uniamp_file(file_name,
+                      time,
+                      H2,
+                      temperature,
+                      pressure,
+                      mode = 'liquid',
+                      start_time = SYNTHETIC_START_TIME):
+    '''
+    Writing a UniAmp H2 sensor file (';'-separated with trailing ';', UTF-8 with BOM,
+    CRLF line endings). H2 is in μmol/L for mode = 'liquid' and in Pa for mode = 'gas'.
+    '''
+
+    lines = [';'.join(uniamp_header(mode)) + ';']
+
+    for t, h2, temp, p in zip(time, H2, temperature, pressure):
+        timestamp = start_time + timedelta(seconds = float(t))
+        lines.append(f'{timestamp:%Y-%m-%d %H:%M:%S};{timestamp.microsecond // 1000};{t:.10g};'
+                     f'{h2 / 100:.12g};{h2:.12g};2;{temp:.12g};{temp:.12g};0;{p:.12g};{p:.12g};0;')
+
+    with open(file_name, 'w', encoding = 'utf-8-sig', newline = '') as file:
+        file.write('\r\n'.join(lines) + '\r\n')
+
+def firesting_header(channel):
+    '''
+    Column names of the main and temperature blocks of a FireSting file for channel
+    (see O2_CHANNEL_MAPPING), in the order of PyroScience Workbench.
+    '''
+
+    columns = O2_CHANNEL_MAPPING[channel]
+    main_suffix = columns['dt'][columns['dt'].index('['):]
+    temperature_suffix = columns['Temp'][columns['Temp'].index('['):]
+
+    return [f'Date {main_suffix}', f'Time {main_suffix}', columns['dt'], columns['O2'],
+            f'dphi (°) {main_suffix}', f'Signal Intensity (mV) {main_suffix}',
+            f'Ambient Light (mV) {main_suffix}', f'Status {main_suffix}',
+            f'Date {temperature_suffix}', f'Time {temperature_suffix}', f' dt (s) {temperature_suffix}',
+            columns['Temp'], f'Status {temperature_suffix}']
+
+def write_firesting_file(file_name,
+                         time,
+                         O2,
+                         temperature,
+                         channel,
+                         experiment_name = 'Synthetic',
+                         start_time = SYNTHETIC_START_TIME):
+    '''
+    Writing a FireSting O2 file for channel (tab-separated, ISO8859, CRLF line endings, '#'
+    header block). O2 is in the unit of the channel's O2 column (μmol/L or %O2).
+    '''
+
+    lines = ['#--- Experiment ' + '-' * 74,
+             f'#{experiment_name}',
+             '#',
+             '#--- System ' + '-' * 78,
+             '#Synthetic data written by simultaneous_detection.data_parsing.synthetic_data',
+             '#--- Measurement Data ' + '-' * 68,
+             '\t'.join(firesting_header(channel))]
+
+    for t, o2, temp in zip(time, O2, temperature):
+        timestamp = start_time + timedelta(seconds = float(t))
+        date = f'{timestamp:%d-%m-%Y}'
+        clock = f'{timestamp:%H:%M:%S}.{timestamp.microsecond // 1000:03d}'
+        lines.append(f'{date}\t{clock}\t{t:.3f}\t{o2:.6f}\t49.346001\t360\t1\tOK\t'
+                     f'{date}\t{clock}\t{t:.3f}\t{temp:.3f}\tOK\t\t\t')
+
+    with open(file_name, 'w', encoding = 'ISO8859', newline = '') as file:
+        file.write('\r\n'.join(lines) + '\r\n')
+
+def synthetic_experiment_specifications(experiment_count,
+                                        duration = 3000.0,
+                                        irradiation_time = 1500.0,
+                                        H2_sample_interval = 1.0,
+                                        O2_sample_interval = 1.0,
+                                        H2_lag = 2.0,
+                                        O2_lag = 5.0,
+                                        noise = 1.0,
+                                        seed = 0):
+    '''
+    Overview rows and simulation settings of experiment_count synthetic experiments, cycling
+    through the groups of GROUP_MAPPING with the experimental parameter of each group varied
+    (the rate constants follow it: k1 with the irradiance, k2 with the catalyst loading and the
+    temperature, a kinetic isotope effect for D2O), plus a 10% spread of the rate constants
+    between experiments. Returns a list of {'metadata': overview row, 'simulation': kwargs of
+    simulate_raw_data, 'channel': FireSting channel}.
+    '''
+
+    rng = np.random.default_rng(seed)
+    groups = [group for group in GROUP_MAPPING if group != 'Gas phase D2O']
+    colors = ['blue', 'red', 'green', 'orange', 'purple', 'brown', 'black', 'grey']
+    specifications = []
+
+    for index in range(experiment_count):
+        group = groups[index % len(groups)]
+        experiment_name = f'SYN-{index + 1:05d}'
+        start_time = SYNTHETIC_START_TIME + timedelta(hours = 2 * index)
+
+        irradiance, loading, temperature, D2O = 50, 0.001, 20, False
+
+        if group == 'Intensity':
+            irradiance = rng.choice([10, 25, 75, 100])
+        elif group == 'Loading':
+            loading = rng.choice([0.0005, 0.002, 0.005])
+        elif group == 'Temperature':
+            temperature = rng.choice([10, 30, 40, 50])
+        elif group == 'D2O':
+            D2O = True
+
+        spread = rng.lognormal(0, 0.1, 3)
+        rate_constants = {'k1': SYNTHETIC_RATE_CONSTANTS['k1'] * irradiance / 50 * (0.5 if D2O else 1) * spread[0],
+                          'k2': SYNTHETIC_RATE_CONSTANTS['k2'] * np.sqrt(loading / 0.001) * spread[1]
+                                * np.exp(-40e3 / 8.314 * (1 / (temperature + 273.15) - 1 / 293.15)),
+                          'k3': SYNTHETIC_RATE_CONSTANTS['k3'] * spread[2]}
+
+        mode = 'gas' if group == 'Gas phase' else 'liquid'
+        irradiation_start = float(np.round(rng.uniform(0.1, 0.25) * duration))
+        irradiation_end = min(irradiation_start + irradiation_time, duration)
+        O2_logger_offset = float(np.round(rng.uniform(-10, 10), 3))
+
+        metadata = {'Experiment': experiment_name,
+                    'group': group,
+                    'File name H2': f'{experiment_name}-Logger.csv',
+                    'File name O2': f'{start_time:%Y-%m-%d_%H%M%S}_{experiment_name}-Ch{4 if mode == "gas" else 2}.txt',
+                    'Unisense Irradiation start [s]': irradiation_start,
+                    'Unisense Irradiation end [s]': irradiation_end,
+                    'Pyroscience Irradiation start [s]': irradiation_start - O2_logger_offset,
+                    'Pyroscience Irradiation end [s]': irradiation_end - O2_logger_offset,
+                    'Irradiance [mW/cm2]': irradiance,
+                    'Catalyst concentration (g/L)': 0.5,
+                    'Catalyst loading [wt% Rh/Cr]': loading,
+                    'D2O': D2O,
+                    'Temperature [°C]': temperature,
+                    'Gas phase volume [mL]': 58,
+                    'Liquid phase volume [mL]': 25,
+                    'Active': True,
+                    'color': colors[index % len(colors)],
+                    'Notes': 'Synthetic'}
+
+        simulation = {'duration': duration,
+                      'irradiation_start': irradiation_start,
+                      'irradiation_end': irradiation_end,
+                      'mode': mode,
+                      'liquid_phase_volume': 25.0,
+                      'gas_phase_volume': 58.0,
+                      'rate_constants': rate_constants,
+                      'H2_sample_interval': H2_sample_interval,
+                      'O2_sample_interval': O2_sample_interval,
+                      'O2_logger_offset': O2_logger_offset,
+                      'H2_lag': H2_lag,
+                      'O2_lag': O2_lag,
+                      'noise': noise,
+                      'temperature': float(temperature),
+                      'seed': seed + index + 1}
+
+        specifications.append({'metadata': metadata,
+                               'simulation': simulation,
+                               'channel': 4 if mode == 'gas' else 2,
+                               'start_time': start_time})
+
+    return specifications
+
+def write_synthetic_experiment(specification, data_directory):
+    '''
+    Simulating one experiment of synthetic_experiment_specifications and writing its UniAmp
+    and FireSting files to data_directory/H2_data and data_directory/O2_data.
+    '''
+
+    metadata = specification['metadata']
+    simulation = specification['simulation']
+    raw_data_dict = simulate_raw_data(**simulation)
+    H2_key = 'H2_Pa' if simulation['mode'] == 'gas' else 'H2_umol_L'
+
+    write_uniamp_file(os.path.join(data_directory, 'H2_data', metadata['File name H2']),
+                      raw_data_dict['H2_time_s'],
+                      raw_data_dict[H2_key],
+                      raw_data_dict['H2_temperature'],
+                      np.full(len(raw_data_dict['H2_time_s']), 1006.4),
+                      mode = simulation['mode'],
+                      start_time = specification['start_time'])
+
+    write_firesting_file(os.path.join(data_directory, 'O2_data', metadata['File name O2']),
+                         raw_data_dict['O2_time_s'],
+                         raw_data_dict['O2_data'],
+                         raw_data_dict['O2_temperature'],
+                         specification['channel'],
+                         experiment_name = metadata['Experiment'],
+                         start_time = specification['start_time'] + timedelta(seconds = simulation['O2_logger_offset']))
+
+    return metadata['Experiment']
+
+def generate_synthetic_experiments(output_directory = 'synthetic_data',
+                                   experiment_count = 41,
+                                   duration = 3000.0,
+                                   irradiation_time = 1500.0,
+                                   H2_sample_interval = 1.0,
+                                   O2_sample_interval = 1.0,
+                                   H2_lag = 2.0,
+                                   O2_lag = 5.0,
+                                   noise = 1.0,
+                                   seed = 0,
+                                   workers = None):
+    '''
+    Writing experiment_count synthetic experiments (see synthetic_experiment_specifications)
+    with the layout of the bundled data: output_directory/data/H2_data (UniAmp CSV),
+    output_directory/data/O2_data (FireSting TXT) and the overview sheet
+    output_directory/data/Synthetic_O2_H2_Experiment_Overview.xlsx. The files are written by
+    workers processes (default: number of CPUs). Returns the path of the overview sheet.
+
+    The bundled dataset has 41 experiments of about 2000-5500 s at 1 Hz, so
+    experiment_count = 410 and 4100 stress-test the pipeline at 10x and 100x its size, and
+    longer runs or shorter sample intervals mimic long runs and high-rate loggers.
+
+    Usage (the raw data paths of raw_data_files are relative to the working directory):
+        overview_file = generate_synthetic_experiments('synthetic_data', experiment_count = 410)
+        os.chdir('synthetic_data')
+        generate_dataset(overview_file = 'data/Synthetic_O2_H2_Experiment_Overview.xlsx',
+                         output_file = 'data/synthetic_O2_H2_data.h5')
+    '''
+
+    data_directory = os.path.join(output_directory, 'data')
+    os.makedirs(os.path.join(data_directory, 'H2_data'), exist_ok = True)
+    os.makedirs(os.path.join(data_directory, 'O2_data'), exist_ok = True)
+
+    specifications = synthetic_experiment_specifications(experiment_count,
+                                                         duration = duration,
+                                                         irradiation_time = irradiation_time,
+                                                         H2_sample_interval = H2_sample_interval,
+                                                         O2_sample_interval = O2_sample_interval,
+                                                         H2_lag = H2_lag,
+                                                         O2_lag = O2_lag,
+                                                         noise = noise,
+                                                         seed = seed)
+
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        for completed, experiment_name in enumerate(executor.map(write_synthetic_experiment,
+                                                                 specifications,
+                                                                 [data_directory] * len(specifications),
+                                                                 chunksize = 8), 1):
+            if completed % 100 == 0 or completed == len(specifications):
+                print(f'{completed}/{len(specifications)} experiments written ({time.perf_counter() - start:.1f} s)')
+
+    overview_file = os.path.join(data_directory, 'Synthetic_O2_H2_Experiment_Overview.xlsx')
+    pd.DataFrame([specification['metadata'] for specification in specifications]).to_excel(overview_file, index = False)
+
+    return overview_file
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Writing synthetic H2/O2 experiments for scale and load testing.')
+    parser.add_argument('--output-directory', default = 'synthetic_data')
+    parser.add_argument('--experiments', type = int, default = 41, help = 'number of experiments (41 is the bundled dataset)')
+    parser.add_argument('--duration', type = float, default = 3000.0, help = 'run length in s')
+    parser.add_argument('--irradiation-time', type = float, default = 1500.0, help = 'irradiation time in s')
+    parser.add_argument('--H2-sample-interval', type = float, default = 1.0, help = 'seconds between H2 samples')
+    parser.add_argument('--O2-sample-interval', type = float, default = 1.0, help = 'seconds between O2 samples')
+    parser.add_argument('--H2-lag', type = float, default = 2.0, help = 'response time of the H2 sensor in s')
+    parser.add_argument('--O2-lag', type = float, default = 5.0, help = 'response time of the O2 sensor in s')
+    parser.add_argument('--noise', type = float, default = 1.0, help = 'noise relative to the bundled sensors')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--workers', type = int, default = None)
+
+    args = parser.parse_args()
+
+    overview_file = generate_synthetic_experiments(output_directory = args.output_directory,
+                                                   experiment_count = args.experiments,
+                                                   duration = args.duration,
+                                                   irradiation_time = args.irradiation_time,
+                                                   H2_sample_interval = args.H2_sample_interval,
+                                                   O2_sample_interval = args.O2_sample_interval,
+                                                   H2_lag = args.H2_lag,
+                                                   O2_lag = args.O2_lag,
+                                                   noise = args.noise,
+                                                   seed = args.seed,
+                                                   workers = args.workers)
+
+    print(f'Overview sheet written to {overview_file}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import os
+
+import h5py
+import numpy as np
+from scipy.optimize import minimize, OptimizeResult
+
+from simultaneous_detection.fitting.kinetic_solver import (optimize,
+                                                           prepare_experiments,
+                                                           compile_linear_network,
+                                                           prepared_objective_function)
+
+def load_previous_fits(filename, general_prefixes):
+    '''
+    Reading the optimized rate constants ('{general_prefix}_all_rate_constants') and fitting
+    errors ('{general_prefix}_fitting_error') of all experiments from a previous dataset .h5 file.
+    Only these scalars are read, not the experiment data.
+    Returns {experiment_name: {'group': str, 'fits': {general_prefix: {'rate_constants': dict,
+    'fitting_error': float}}}}.
+    '''
+
+    previous_fits = {}
+
+    if not os.path.exists(filename):
+        return previous_fits
+
+    with h5py.File(filename, 'r') as f:
+        for exp_name in f.keys():
+            if exp_name == 'overview_df' or 'processed_data' not in f[exp_name]:
+                continue
+
+            processed_data = f[exp_name]['processed_data']
+            group = f[exp_name].attrs.get('group', '')
+            fits = {}
+
+            for general_prefix in general_prefixes:
+                rate_constants_key = f'{general_prefix}_all_rate_constants'
+                error_key = f'{general_prefix}_fitting_error'
+
+                if rate_constants_key not in processed_data:
+                    continue
+
+                fits[general_prefix] = {
+                    'rate_constants': {name: float(value[()])
+                                       for name, value in processed_data[rate_constants_key].items()},
+                    'fitting_error': float(processed_data[error_key][()]) if error_key in processed_data else None
+                }
+
+            previous_fits[exp_name] = {'group': group, 'fits': fits}
+
+    return previous_fits
+
+def warm_start_for_experiment(previous_fits, experiment_name, group):
+    '''
+    Starting values for the fits of one experiment: its own previous rate constants and
+    fitting errors or, for experiments not fitted before, the mean rate constants of the
+    previous fits in the same group (without a fitting error to compare against).
+    Returns {general_prefix: {'rate_constants': dict, 'fitting_error': float or None}}.
+    '''
+
+    warm_start = dict(previous_fits.get(experiment_name, {}).get('fits', {}))
+
+    group_fits = [entry['fits'] for entry in previous_fits.values() if entry['group'] == group]
+    general_prefixes = {general_prefix for fits in group_fits for general_prefix in fits}
+
+    for general_prefix in general_prefixes - set(warm_start):
+        group_rate_constants = [fits[general_prefix]['rate_constants']
+                                for fits in group_fits if general_prefix in fits]
+        names = set.intersection(*(set(rate_constants) for rate_constants in group_rate_constants))
+
+        warm_start[general_prefix] = {
+            'rate_constants': {name: float(np.mean([rate_constants[name] for rate_constants in group_rate_constants]))
+                               for name in names},
+            'fitting_error': None
+        }
+
+    return warm_start
+
+def local_polish(model, x0):
+    '''
+    Local Nelder-Mead minimization of the objective function starting from x0, within the
+    bounds of model.rate_constants_to_optimize. For strictly positive bounds the search runs
+    in log10 space, as the rate constants span orders of magnitude.
+    '''
+
+    bounds = np.array(list(model.rate_constants_to_optimize.values()), dtype = float)
+
+    if np.all(bounds[:, 0] > 0):
+        transform, inverse_transform = np.log10, lambda z: 10 ** z
+    else:
+        transform, inverse_transform = (lambda x: x), (lambda z: z)
+
+    prepared_experiments = prepare_experiments(model)
+    linear_network = compile_linear_network(model.parsed_reactions, model.species)
+
+    result = minimize(
+        lambda z: prepared_objective_function(inverse_transform(z), model, prepared_experiments, linear_network),
+        x0 = transform(x0),
+        method = 'Nelder-Mead',
+        bounds = transform(bounds))
+
+    return OptimizeResult(x = np.clip(inverse_transform(result.x), bounds[:, 0], bounds[:, 1]),
+                          fun = result.fun,
+                          nfev = result.nfev,
+                          nit = result.nit,
+                          success = result.success,
+                          message = result.message)
+
+def warm_started_optimize(model,
+                          warm_start,
+                          tolerance = 0.01,
+                          print_results = False,
+                          disp = False):
+    '''
+    Optimizing a Fitting_Model starting from previously optimized rate constants.
+    warm_start is {'rate_constants': dict, 'fitting_error': float or None}. The starting values
+    are first refined by local_polish. The result is kept if its error does not exceed the
+    previous fitting error by more than the relative tolerance. Otherwise (or without a previous
+    error, e.g. for group means) the global differential evolution runs, with the polished
+    values seeded into its initial population.
+    Sets model.result like kinetic_solver.optimize.
+    '''
+
+    names = list(model.rate_constants_to_optimize)
+    bounds = np.array(list(model.rate_constants_to_optimize.values()), dtype = float)
+
+    if not all(name in warm_start['rate_constants'] for name in names):
+        optimize(model, print_results = print_results, disp = disp, vectorized = True)
+        return model.result
+
+    x0 = np.array([warm_start['rate_constants'][name] for name in names])
+    x0 = np.clip(x0, bounds[:, 0], bounds[:, 1])
+
+    polished = local_polish(model, x0)
+    previous_error = warm_start['fitting_error']
+
+    if previous_error is not None and polished.fun <= previous_error * (1 + tolerance):
+        model.result = polished
+
+        if print_results:
+            print(f'Warm start accepted after {polished.nfev} evaluations (error {polished.fun:.4g}, previous {previous_error:.4g})')
+
+        return model.result
+
+    model.x0 = polished.x
+    optimize(model, print_results = print_results, disp = disp, vectorized = True)
+
+    return model.result
@@ -0,0 +1,213 @@
+import numpy as np
+from numpy.polynomial import polynomial as P
+from scipy.ndimage import convolve1d
+
+from pyKES.utilities.find_nearest import find_nearest
+
+from simultaneous_detection.data_parsing.data_processing import convert_gases_to_umol_L
+from simultaneous_detection.data_parsing.ragged_processing import cached_savgol_coefficients, savgol_interior, savgol_edge
+from simultaneous_detection.data_parsing.online_polynomial import MomentTree, fit_from_moments, max_secant_slope
+from simultaneous_detection.data_parsing.processing_parameters import PROCESSING_PARAMETERS
+from simultaneous_detection.data_parsing.parsing_O2_H2_data import signal_processing_specifications
+
+def window_savgol_filter(values, precomputed, valid_start, valid_stop, window_length, polyorder):
+    '''
+    scipy savgol_filter (mode = 'interp') of values, for which precomputed[valid_start:valid_stop]
+    already holds the interior convolution (e.g. a slice of the convolution of the whole trace).
+    Only the remaining interior points and the window_length // 2 points at both ends are computed.
+    '''
+
+    n = len(values)
+    h = window_length // 2
+
+    if n < window_length:
+        raise ValueError("If mode is 'interp', window_length must be less "
+                         "than or equal to the size of x.")
+
+    smoothed = np.empty(n)
+    valid_start, valid_stop = max(valid_start, h), min(valid_stop, n - h)
+
+    if valid_stop > valid_start:
+        smoothed[valid_start:valid_stop] = precomputed[valid_start:valid_stop]
+    else:
+        valid_start = valid_stop = n - h
+
+    for start, stop in ((h, valid_start), (valid_stop, n - h)):
+        if stop > start:
+            smoothed[start:stop] = savgol_interior(values, window_length, polyorder, start, stop)
+
+    smoothed[:h] = savgol_edge(values[:window_length], polyorder, np.arange(h))
+    smoothed[n - h:] = savgol_edge(values[n - window_length:], polyorder, np.arange(window_length - h, window_length))
+
+    return smoothed
+
+class WindowedTrace:
+    '''
+    One sensor trace prepared for repeated processing_data with different irradiation windows.
+    The precomputation stores the sums of u**k and u**k * y of the polynomial fit in a
+    segment tree (see online_polynomial.MomentTree; prefix sums of powers of time lose up to
+    eight digits on short windows), prefix sums of the data for the resampling and the
+    Savitzky-Golay convolutions of the whole trace. For a window, the polynomial fit and
+    max_rate then cost O(log n) (see max_rate), and processing_data only recomputes the
+    smoothing near the window ends; the remaining work is slicing and elementwise arithmetic.
+    Offset correction does not change the fit: the fit of data - data[start] against
+    time - time[start] is the shifted fit of the uncorrected window.
+    '''
+
+    def __init__(self,
+                 time,
+                 data,
+                 prefix,
+                 liquid_phase_volume,
+                 gas_phase_volume,
+                 offset,
+                 savgol_window,
+                 savgol_polyorder,
+                 savgol_window_diff,
+                 savgol_polyorder_diff,
+                 interval_resampling,
+                 poly_order):
+
+        self.prefix = prefix
+        self.offset = offset
+        self.savgol_window = savgol_window
+        self.savgol_polyorder = savgol_polyorder
+        self.savgol_window_diff = savgol_window_diff
+        self.savgol_polyorder_diff = savgol_polyorder_diff
+        self.interval_resampling = interval_resampling
+        self.poly_order = poly_order
+
+        self.time = np.asarray(time, dtype = np.float64)
+        data = np.asarray(data, dtype = np.float64)
+
+        if 'gas' in prefix:
+            data = convert_gases_to_umol_L(data, liquid_phase_volume, gas_phase_volume, H2 = 'H2' in prefix)
+
+        self.data = data
+
+        self.moments = MomentTree(self.time, self.data, poly_order)
+        self.data_prefix_sums = np.concatenate(([0.0], np.cumsum(self.data)))
+
+        # Interior smoothing of the whole trace, valid for every window away from its ends
+        self.data_smoothed = convolve1d(self.data, cached_savgol_coefficients(savgol_window, savgol_polyorder),
+                                        mode = 'constant')
+        self.data_diff = np.diff(self.data_smoothed) / np.diff(self.time)
+        self.data_diff_smoothed = convolve1d(self.data_diff,
+                                             cached_savgol_coefficients(savgol_window_diff, savgol_polyorder_diff),
+                                             mode = 'constant')
+
+    def window_indices(self, start, end):
+        '''
+        First and behind-last index of the window of offset_correction.
+        '''
+
+        return find_nearest(self.time, (start + self.offset, end))
+
+    def window_fit(self, first, last):
+        '''
+        Polynomial fit to time[first:last], from the moment tree. Returns the coefficients
+        (lowest order first) in u = (time - center) / scale and center and scale of the window.
+        '''
+
+        power_sums, weighted_sums, center, scale = self.moments.query(first, last)
+
+        return fit_from_moments(power_sums, weighted_sums), center, scale
+
+    def max_rate(self, start, end):
+        '''
+        {prefix}_max_rate of processing_data for the irradiation window (start, end).
+        '''
+
+        first, last = self.window_indices(start, end)
+        coefficients, center, scale = self.window_fit(first, last)
+
+        return max_secant_slope(coefficients, self.time[first:last], center, scale)
+
+    def processing_data(self, start, end):
+        '''
+        The dict of processing_data for the irradiation window (start, end).
+        '''
+
+        first, last = self.window_indices(start, end)
+        n = last - first
+
+        time_reaction = self.time[first:last] - self.time[first]
+        data_reaction = self.data[first:last] - self.data[first]
+
+        data_smoothed = window_savgol_filter(data_reaction,
+                                             self.data_smoothed[first:last] - self.data[first],
+                                             0, n,
+                                             self.savgol_window,
+                                             self.savgol_polyorder)
+
+        data_diff = np.diff(data_smoothed) / np.diff(time_reaction)
+        time_diff = time_reaction[1:]
+
+        # The differences equal those of the whole trace where both smoothed points are interior,
+        # the smoothed differences where all their inputs are
+        h, h_diff = self.savgol_window // 2, self.savgol_window_diff // 2
+        data_diff_smoothed = window_savgol_filter(data_diff,
+                                                  self.data_diff_smoothed[first:last - 1],
+                                                  h + self.savgol_window_diff - 1 - h_diff,
+                                                  n - h - 1 - h_diff,
+                                                  self.savgol_window_diff,
+                                                  self.savgol_polyorder_diff)
+
+        # Resampling: bin means from the prefix sums of the data
+        edges = np.arange(0, time_reaction[-1] + self.interval_resampling, self.interval_resampling)
+        boundaries = np.concatenate(([0], np.searchsorted(time_reaction, edges[1:-1], side = 'left'), [n]))
+        counts = np.diff(boundaries)
+        data_sums = self.data_prefix_sums[first + boundaries]
+
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            data_resampled = (np.diff(data_sums) - counts * self.data[first]) / counts
+
+        time_resampled = (edges[:-1] + edges[1:]) / 2
+        data_resampled_diff = np.diff(data_resampled) / np.diff(time_resampled)
+        time_resampled_diff = time_resampled[1:]
+
+        coefficients, center, scale = self.window_fit(first, last)
+        data_poly_fit = P.polyval((self.time[first:last] - center) / scale, coefficients) - self.data[first]
+        poly_fit_diff = np.diff(data_poly_fit) / np.diff(time_reaction)
+        max_rate = np.max(poly_fit_diff)
+
+        return {
+            f'{self.prefix}_time_reaction': time_reaction,
+            f'{self.prefix}_data_reaction': data_reaction,
+            f'{self.prefix}_data_smoothed': data_smoothed,
+            f'{self.prefix}_data_diff': data_diff,
+            f'{self.prefix}_time_diff': time_diff,
+            f'{self.prefix}_data_resampled': data_resampled,
+            f'{self.prefix}_time_resampled': time_resampled,
+            f'{self.prefix}_data_resampled_diff': data_resampled_diff,
+            f'{self.prefix}_time_resampled_diff': time_resampled_diff,
+            f'{self.prefix}_data_diff_smoothed': data_diff_smoothed,
+            f'{self.prefix}_poly_fit': data_poly_fit,
+            f'{self.prefix}_poly_fit_diff': poly_fit_diff,
+            f'{self.prefix}_max_rate': max_rate,
+        }
+
+def windowed_traces(raw_data_dict, metadata_dict, processing_parameters = PROCESSING_PARAMETERS):
+    '''
+    WindowedTrace of the H2 and O2 traces of an experiment, as {prefix: (trace, sensor)},
+    sensor being the prefix of the irradiation columns of the overview sheet
+    (f'{sensor} Irradiation start [s]').
+
+    Usage:
+        traces = windowed_traces(raw_data_dict, metadata_dict)
+        trace, sensor = traces['H2']
+        trace.max_rate(metadata_dict[f'{sensor} Irradiation start [s]'], 2400.0)
+    '''
+
+    traces = {}
+
+    for parameters_key, prefix, time_key, data_key, sensor in signal_processing_specifications(metadata_dict):
+        trace = WindowedTrace(raw_data_dict[time_key],
+                              raw_data_dict[data_key],
+                              prefix = prefix,
+                              liquid_phase_volume = metadata_dict['Liquid phase volume [mL]'],
+                              gas_phase_volume = metadata_dict['Gas phase volume [mL]'],
+                              **processing_parameters[parameters_key])
+        traces[prefix] = (trace, sensor)
+
+    return traces
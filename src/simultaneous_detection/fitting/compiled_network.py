@@ -0,0 +1,199 @@
+from functools import lru_cache
+
+import numpy as np
+from scipy.integrate import odeint
+
+from pyKES.reaction_ODE import parse_reactions
+
+try:
+    import numba
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+def network_strings(parsed_reactions):
+    '''
+    Canonical reaction strings of a parsed reaction network, the cache key of compile_network.
+    '''
+
+    def side(species_count):
+        return ' + '.join(f'{coefficient!r} {species}' for species, coefficient in species_count.items())
+
+    strings = []
+
+    for reaction in parsed_reactions:
+        string = f"{side(reaction['reactants'])} > {side(reaction['products'])}, {reaction['rate_constant']}"
+
+        if reaction['other_multipliers']:
+            string += ' ; ' + ', '.join(reaction['other_multipliers'])
+
+        strings.append(string)
+
+    return tuple(strings)
+
+def power_term(index, exponent):
+
+    if exponent == 1:
+        return f'y[{index}]'
+
+    return f'y[{index}] ** {exponent!r}'
+
+def generate_source(parsed_reactions, species, rate_constant_names, multiplier_names, vectorized = True):
+    '''
+    Python source of rhs(y, t, k, m) and jacobian(y, t, k, m) of a parsed reaction network,
+    with one expression per reaction rate and species, so that no reaction dicts are interpreted
+    at run time. k and m are the values of rate_constant_names and multiplier_names. With
+    vectorized = True, y may also be an array (n_species, n_points) of states.
+    '''
+
+    n_species = len(species)
+    shape = f'({n_species},) + np.shape(y)[1:]' if vectorized else f'({n_species},)'
+    jacobian_shape = f'({n_species}, {n_species}) + np.shape(y)[1:]' if vectorized else f'({n_species}, {n_species})'
+
+    rate_lines = []
+    rate_terms = {index: [] for index in range(n_species)}
+    jacobian_terms = {}
+
+    for j, reaction in enumerate(parsed_reactions):
+        coefficient_factors = [f"k[{rate_constant_names.index(reaction['rate_constant'])}]"]
+        coefficient_factors += [f'm[{multiplier_names.index(multiplier)}]' for multiplier in reaction['other_multipliers']]
+
+        reactants = [(species.index(reactant), coefficient) for reactant, coefficient in reaction['reactants'].items()]
+
+        rate_lines.append(f'    r{j} = ' + ' * '.join(coefficient_factors + [power_term(i, c) for i, c in reactants]))
+
+        net = {}
+        for reactant, coefficient in reaction['reactants'].items():
+            net[species.index(reactant)] = net.get(species.index(reactant), 0) - coefficient
+        for product, coefficient in reaction['products'].items():
+            net[species.index(product)] = net.get(species.index(product), 0) + coefficient
+
+        for index, coefficient in net.items():
+            if coefficient != 0:
+                rate_terms[index].append(f'{coefficient!r} * r{j}')
+
+        # d r_j / d y_i by the power rule, multiplied into each affected species
+        for i, c in reactants:
+            derivative_factors = list(coefficient_factors)
+            derivative_factors += [power_term(other, other_c) for other, other_c in reactants if other != i]
+
+            if c != 1:
+                derivative_factors = [repr(c)] + derivative_factors + [power_term(i, c - 1)]
+
+            derivative = ' * '.join(derivative_factors)
+
+            for index, coefficient in net.items():
+                if coefficient != 0:
+                    jacobian_terms.setdefault((index, i), []).append(f'{coefficient!r} * {derivative}')
+
+    rhs_lines = ['def rhs(y, t, k, m):'] + rate_lines + [f'    dydt = np.empty({shape})']
+    rhs_lines += [f"    dydt[{index}] = {' + '.join(terms) if terms else '0.0'}" for index, terms in rate_terms.items()]
+    rhs_lines += ['    return dydt']
+
+    jacobian_lines = ['def jacobian(y, t, k, m):', f'    jac = np.zeros({jacobian_shape})']
+    jacobian_lines += [f"    jac[{index}, {i}] = {' + '.join(terms)}" for (index, i), terms in sorted(jacobian_terms.items())]
+    jacobian_lines += ['    return jac']
+
+    return '\n'.join(rhs_lines) + '\n\n' + '\n'.join(jacobian_lines) + '\n'
+
+class CompiledNetwork:
+    '''
+    Reaction network with generated rhs and jacobian functions (see generate_source), for
+    odeint. Obtained from compile_network.
+    '''
+
+    def __init__(self, reaction_network, backend = 'numpy'):
+
+        if backend not in ('numpy', 'numba'):
+            raise ValueError("backend must be either 'numpy' or 'numba'.")
+        if backend == 'numba' and not NUMBA_AVAILABLE:
+            raise ImportError("The 'numba' backend requires numba to be installed.")
+
+        self.reaction_network = reaction_network
+        self.backend = backend
+        self.parsed_reactions, self.species = parse_reactions(list(reaction_network))
+
+        self.rate_constant_names = list(dict.fromkeys(reaction['rate_constant'] for reaction in self.parsed_reactions))
+        self.multiplier_names = list(dict.fromkeys(multiplier for reaction in self.parsed_reactions
+                                                   for multiplier in reaction['other_multipliers']))
+
+        self.source = generate_source(self.parsed_reactions, self.species, self.rate_constant_names,
+                                      self.multiplier_names, vectorized = backend == 'numpy')
+
+        namespace = {'np': np}
+        exec(compile(self.source, f'<compiled network {hash(reaction_network)}>', 'exec'), namespace)
+
+        if backend == 'numba':
+            self.rhs = numba.njit(namespace['rhs'])
+            self.jacobian = numba.njit(namespace['jacobian'])
+        else:
+            self.rhs = namespace['rhs']
+            self.jacobian = namespace['jacobian']
+
+    def supports(self, other_multipliers = {}):
+        '''
+        Whether all multipliers are plain numbers (multipliers given as functions of the
+        concentrations, see pyKES resolve_other_multipliers, are not compiled).
+        '''
+
+        return all(not isinstance(other_multipliers.get(multiplier), dict) for multiplier in self.multiplier_names)
+
+    def parameter_vectors(self, rate_constants, other_multipliers = {}):
+
+        k = np.array([rate_constants[name] for name in self.rate_constant_names], dtype = np.float64)
+        m = np.array([other_multipliers[name] for name in self.multiplier_names], dtype = np.float64)
+
+        return k, m
+
+    def solve(self, rate_constants, initial_conditions, times, other_multipliers = {}):
+        '''
+        Drop-in for pyKES solve_ode_system (same odeint tolerances), with the generated
+        rhs and analytic jacobian.
+        '''
+
+        if not self.supports(other_multipliers):
+            raise ValueError('Multipliers given as functions are not supported by compiled networks.')
+
+        y0 = np.zeros(len(self.species))
+
+        for species, concentration in initial_conditions.items():
+            if species in self.species:
+                y0[self.species.index(species)] = concentration
+            else:
+                print(f'Warning: {species} not in species list')
+
+        return odeint(self.rhs, y0, times,
+                      args = self.parameter_vectors(rate_constants, other_multipliers),
+                      Dfun = self.jacobian,
+                      rtol = 1e-8, atol = 1e-10,
+                      mxstep = 5000)
+
+@lru_cache(maxsize = None)
+def _compile_network(canonical_network, backend):
+
+    return CompiledNetwork(canonical_network, backend)
+
+@lru_cache(maxsize = None)
+def _canonical_network(reaction_network):
+
+    return network_strings(parse_reactions(list(reaction_network))[0])
+
+def compile_network(reaction_network, backend = 'numpy'):
+    '''
+    CompiledNetwork of a list of reaction strings (as for pyKES parse_reactions), generated
+    once per network and backend ('numpy', or 'numba' if installed) and cached. Networks
+    are identified by their canonical strings (see network_strings).
+
+    Usage:
+        network = compile_network(['[H2O] > [O2-aq], k1', '[O2-aq] > [O2-g], k2'])
+        solution = network.solve({'k1': 1e-11, 'k2': 1e-2}, {'[H2O]': 55.5e6}, times)
+    '''
+
+    return _compile_network(_canonical_network(tuple(reaction_network)), backend)
+
+def compile_parsed_network(parsed_reactions, backend = 'numpy'):
+    '''
+    compile_network for an already parsed reaction network.
+    '''
+
+    return _compile_network(network_strings(parsed_reactions), backend)
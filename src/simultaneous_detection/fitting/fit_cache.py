@@ -0,0 +1,206 @@
+import os
+import json
+import hashlib
+import tempfile
+import zipfile
+
+import numpy as np
+
+from simultaneous_detection.fitting.kinetic_solver import prepare_experiments
+
+FIT_CACHE_DIRECTORY = 'data/fit_cache'
+FIT_CACHE_MAX_SIZE = 500 * 1024 ** 2 # bytes, least recently used entries are evicted above
+
+FIT_CACHE_STATISTICS = {'hits': 0, 'misses': 0}
+
+# Part of every fit cache key: increase whenever the optimizer, the refinement or the stored results change
+FIT_CACHE_VERSION = 1
+
+def canonical_value(value):
+    '''
+    JSON-serializable, deterministic representation of a fitting parameter: dicts sorted by
+    key, arrays replaced by a hash of dtype, shape and content, functions by their qualified name.
+    '''
+
+    if isinstance(value, dict):
+        return {str(key): canonical_value(value[key]) for key in sorted(value, key = str)}
+    if isinstance(value, (list, tuple)):
+        return [canonical_value(item) for item in value]
+    if isinstance(value, np.ndarray):
+        array = np.ascontiguousarray(value)
+        array_hash = hashlib.sha256(f'{array.dtype.str}|{array.shape}|'.encode('utf-8'))
+        array_hash.update(array.tobytes())
+        return f'array:{array_hash.hexdigest()}'
+    if isinstance(value, (np.integer, np.floating)):
+        return value.item()
+    if callable(value):
+        return f'function:{value.__module__}.{value.__qualname__}'
+
+    return value
+
+def fit_cache_key(model, **fitting_options):
+    '''
+    Cache key of a fit: hash of the reaction network, bounds, fixed rate constants, multipliers,
+    initial conditions, loss function and the resolved times and data of the experiments of a
+    Fitting_Model, combined with fitting_options that change the result (e.g. refine,
+    warm_start) and FIT_CACHE_VERSION. Attribute paths are resolved, so the key depends on
+    the fitted arrays, not on their names.
+    '''
+
+    experiments = [{key: value for key, value in prepared.items() if key != 'experiment_name'}
+                   for prepared in prepare_experiments(model)]
+
+    key_data = {'reaction_network': list(model.reaction_network),
+                'rate_constants_to_optimize': model.rate_constants_to_optimize,
+                'fixed_rate_constants': model.fixed_rate_constants,
+                'other_multipliers': model.other_multipliers,
+                'loss_function': model.loss_function,
+                'experiments': experiments,
+                'fitting_options': fitting_options,
+                'version': FIT_CACHE_VERSION}
+
+    serialized = json.dumps(canonical_value(key_data), sort_keys = True)
+
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+def save_fit_to_cache(fit, cache_file):
+    '''
+    Storing a fit ({'x', 'error', 'trajectories': {species: array}, 'standard_errors': {name: float}})
+    as .npz, through a temporary file as in raw_data_reading_functions.save_raw_data_to_cache.
+    '''
+
+    cache_directory = os.path.dirname(cache_file)
+    os.makedirs(cache_directory, exist_ok = True)
+
+    arrays = {'x': np.asarray(fit['x']), 'error': np.asarray(fit['error'])}
+    arrays |= {f'trajectory:{species}': np.asarray(values) for species, values in fit['trajectories'].items()}
+    arrays |= {f'standard_error:{name}': np.asarray(value) for name, value in fit.get('standard_errors', {}).items()}
+
+    file_descriptor, temporary_file = tempfile.mkstemp(dir = cache_directory, suffix = '.npz.tmp')
+
+    try:
+        with os.fdopen(file_descriptor, 'wb') as file:
+            np.savez(file, **arrays)
+        os.replace(temporary_file, cache_file)
+    except BaseException:
+        os.remove(temporary_file)
+        raise
+
+def load_fit_from_cache(cache_file):
+    '''
+    Loading a fit stored by save_fit_to_cache.
+    '''
+
+    fit = {'trajectories': {}, 'standard_errors': {}}
+
+    with np.load(cache_file) as cached_data:
+        for key in cached_data.files:
+            if key.startswith('trajectory:'):
+                fit['trajectories'][key.split(':', 1)[1]] = cached_data[key]
+            elif key.startswith('standard_error:'):
+                fit['standard_errors'][key.split(':', 1)[1]] = cached_data[key].item()
+            else:
+                fit[key] = cached_data[key]
+
+    fit['error'] = fit['error'].item()
+
+    return fit
+
+def cached_fit(cache_key, cache_directory = FIT_CACHE_DIRECTORY):
+    '''
+    Fit stored under cache_key, or None. A hit marks the entry as recently used.
+    Hits and misses are counted in FIT_CACHE_STATISTICS (per process).
+    '''
+
+    cache_file = os.path.join(cache_directory, f'{cache_key}.npz')
+
+    if os.path.exists(cache_file):
+        try:
+            fit = load_fit_from_cache(cache_file)
+            os.utime(cache_file)
+            FIT_CACHE_STATISTICS['hits'] += 1
+            return fit
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            pass # Corrupted entry, fitted again and overwritten
+
+    FIT_CACHE_STATISTICS['misses'] += 1
+
+    return None
+
+def store_fit(cache_key, fit, cache_directory = FIT_CACHE_DIRECTORY, max_size = FIT_CACHE_MAX_SIZE):
+    '''
+    Storing a fit under cache_key and evicting least recently used entries while the cache
+    exceeds max_size bytes.
+    '''
+
+    save_fit_to_cache(fit, os.path.join(cache_directory, f'{cache_key}.npz'))
+    evict_fit_cache(cache_directory, max_size)
+
+def evict_fit_cache(cache_directory = FIT_CACHE_DIRECTORY, max_size = FIT_CACHE_MAX_SIZE):
+    '''
+    Removing the least recently used (stored or read) entries until the cache is at most
+    max_size bytes. Returns the number of removed entries.
+    '''
+
+    entries = []
+
+    for file in os.listdir(cache_directory):
+        if file.endswith('.npz'):
+            try:
+                status = os.stat(os.path.join(cache_directory, file))
+                entries.append((status.st_mtime, status.st_size, file))
+            except FileNotFoundError:
+                pass # Removed by another worker
+
+    total_size = sum(size for _, size, _ in entries)
+    removed = 0
+
+    for _, size, file in sorted(entries):
+        if total_size <= max_size:
+            break
+
+        try:
+            os.remove(os.path.join(cache_directory, file))
+            removed += 1
+        except FileNotFoundError:
+            pass
+
+        total_size -= size
+
+    return removed
+
+def clear_fit_cache(cache_directory = FIT_CACHE_DIRECTORY, cache_keys = None):
+    '''
+    Explicit invalidation: removing the given cache keys (see fit_cache_key) or, by default,
+    all entries. Returns the number of removed entries.
+    '''
+
+    if not os.path.isdir(cache_directory):
+        return 0
+
+    if cache_keys is None:
+        files = [file for file in os.listdir(cache_directory) if file.endswith('.npz')]
+    else:
+        files = [f'{cache_key}.npz' for cache_key in cache_keys]
+
+    removed = 0
+
+    for file in files:
+        try:
+            os.remove(os.path.join(cache_directory, file))
+            removed += 1
+        except FileNotFoundError:
+            pass
+
+    return removed
+
+def print_fit_cache_statistics(statistics):
+    '''
+    Printing fit cache hits and misses of a dataset generation run.
+    '''
+
+    total = statistics['hits'] + statistics['misses']
+    hit_rate = statistics['hits'] / total if total else 0.0
+
+    print(f"Fit cache: {statistics['hits']} hits, {statistics['misses']} misses "
+          f"({hit_rate:.0%} of {total} fits read from cache)")
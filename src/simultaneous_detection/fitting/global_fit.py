@@ -0,0 +1,264 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.optimize import least_squares
+from pprint import pprint
+
+from pyKES.fitting_ODE import Fitting_Model, square_loss_time_series_normalized
+
+from simultaneous_detection.fitting.kinetic_solver import optimize, compile_linear_network, prepare_experiments
+from simultaneous_detection.fitting.sensitivity_refinement import residuals_and_jacobian, model_residuals
+
+GLOBAL_FIT_GROUPS = ('Intensity', 'Loading', 'Temperature', 'D2O')
+
+_worker_experiments = [] # Per-experiment models of the process pool workers, see set_worker_experiments
+
+def group_experiments(dataset, group):
+    '''
+    Active experiments of one group of a dataset (metadata 'Active' TRUE) with processed data.
+    '''
+
+    return [experiment for experiment in dataset.experiments.values()
+            if experiment.metadata['group'] == group
+            and str(experiment.metadata.get('Active', True)).upper() == 'TRUE'
+            and 'common_time_reaction' in experiment.processed_data]
+
+def experiment_model(fitting_parameters, experiment):
+    '''
+    Fitting_Model of a single experiment as in fitting_wrapper, with its prepared experiment
+    and compiled linear network (None for nonlinear networks).
+    '''
+
+    model = Fitting_Model(**fitting_parameters)
+    model.experiments = [experiment]
+    model.loss_function = square_loss_time_series_normalized
+
+    prepared_experiments = prepare_experiments(model)
+
+    # Only the prepared data is needed, the raw data is not sent to the workers
+    model.experiments = []
+
+    return model, prepared_experiments, compile_linear_network(model.parsed_reactions, model.species)
+
+def experiment_residuals_and_jacobian(x, model, prepared_experiments, linear_network):
+    '''
+    Residuals of one experiment and their Jacobian with respect to all rate constants to
+    optimize: analytic for linear networks, forward differences otherwise.
+    '''
+
+    if linear_network is not None:
+        return residuals_and_jacobian(x, model, prepared_experiments, linear_network)
+
+    residuals = model_residuals(x, model, prepared_experiments)
+    jacobian = np.empty((len(residuals), len(x)))
+
+    for i in range(len(x)):
+        step = np.sqrt(np.finfo(float).eps) * max(abs(x[i]), 1e-12)
+        x_step = x.copy()
+        x_step[i] += step
+        jacobian[:, i] = (model_residuals(x_step, model, prepared_experiments) - residuals) / step
+
+    return residuals, jacobian
+
+def set_worker_experiments(experiment_models):
+    '''
+    Process pool initializer: the experiment models are sent to each worker once instead of
+    with every evaluation.
+    '''
+
+    global _worker_experiments
+    _worker_experiments = experiment_models
+
+def evaluate_experiment(index, x):
+
+    return experiment_residuals_and_jacobian(x, *_worker_experiments[index])
+
+class HierarchicalParameters:
+    '''
+    Layout of the parameter vector of a global fit: the shared rate constants first, followed by
+    one block of per-experiment rate constants for each experiment.
+    '''
+
+    def __init__(self, rate_constants_to_optimize, shared, n_experiments):
+
+        unknown = set(shared) - set(rate_constants_to_optimize)
+
+        if unknown:
+            raise ValueError(f'Shared rate constants {sorted(unknown)} are not in rate_constants_to_optimize.')
+
+        self.names = list(rate_constants_to_optimize)
+        self.shared = [name for name in self.names if name in shared]
+        self.local = [name for name in self.names if name not in shared]
+        self.n_experiments = n_experiments
+
+        # Position of each rate constant of experiment e in the global vector
+        self.columns = np.empty((n_experiments, len(self.names)), dtype = int)
+
+        for position, name in enumerate(self.names):
+            if name in shared:
+                self.columns[:, position] = self.shared.index(name)
+            else:
+                self.columns[:, position] = (len(self.shared) + np.arange(n_experiments) * len(self.local)
+                                             + self.local.index(name))
+
+        bounds = np.array([rate_constants_to_optimize[name] for name in self.names], dtype = float)
+        self.bounds = np.empty((self.size, 2))
+        self.bounds[self.columns.ravel()] = np.tile(bounds, (n_experiments, 1))
+
+    @property
+    def size(self):
+        return len(self.shared) + self.n_experiments * len(self.local)
+
+    def experiment_vector(self, x, index):
+        return x[self.columns[index]]
+
+    def global_vector(self, experiment_vectors):
+        x = np.empty(self.size)
+
+        for index, experiment_x in enumerate(experiment_vectors):
+            x[self.columns[index]] = experiment_x
+
+        return x
+
+def global_fit(experiments,
+               fitting_parameters,
+               shared,
+               general_prefix = None,
+               workers = None,
+               print_results = False):
+    '''
+    Hierarchical fit of several experiments in one optimization: the rate constants in shared
+    are common to all experiments, all other rate constants of
+    fitting_parameters['rate_constants_to_optimize'] are fitted per experiment. The loss is the
+    sum of the per-experiment losses of fitting_wrapper (square_loss_time_series_normalized).
+
+    Starting values are the individual fits '{general_prefix}_all_rate_constants' of the
+    experiments (with the medians for shared rate constants) or, without general_prefix, one
+    global differential evolution with all rate constants shared. All parameters are then
+    optimized together by a bounded trust-region least squares fit (scipy least_squares) with
+    the Jacobians of the experiments, evaluated in parallel over workers processes.
+
+    Returns {'shared', 'per_experiment', 'standard_errors' (same layout), 'error',
+    'experiment_errors', 'result'}.
+    '''
+
+    experiment_names = [experiment.experiment_name for experiment in experiments]
+    experiment_models = [experiment_model(fitting_parameters, experiment) for experiment in experiments]
+
+    layout = HierarchicalParameters(fitting_parameters['rate_constants_to_optimize'], shared, len(experiments))
+
+    if general_prefix is not None:
+        individual_fits = np.array([[experiment.processed_data[f'{general_prefix}_all_rate_constants'][name]
+                                     for name in layout.names] for experiment in experiments])
+        shared_columns = [layout.names.index(name) for name in layout.shared]
+        individual_fits[:, shared_columns] = np.median(individual_fits[:, shared_columns], axis = 0)
+    else:
+        model = Fitting_Model(**fitting_parameters)
+        model.experiments = list(experiments)
+        model.loss_function = square_loss_time_series_normalized
+        optimize(model, vectorized = True, print_results = print_results)
+        individual_fits = np.tile(model.result.x, (len(experiments), 1))
+
+    x0 = np.clip(layout.global_vector(individual_fits), layout.bounds[:, 0], layout.bounds[:, 1])
+
+    workers = min(workers or os.cpu_count(), len(experiments))
+    executor = ProcessPoolExecutor(max_workers = workers,
+                                   initializer = set_worker_experiments,
+                                   initargs = (experiment_models,)) if workers > 1 else None
+
+    last_evaluation = {}
+
+    def evaluate(x):
+        key = x.tobytes()
+
+        if key not in last_evaluation:
+            experiment_vectors = [layout.experiment_vector(x, index) for index in range(len(experiments))]
+
+            if executor is not None:
+                evaluations = list(executor.map(evaluate_experiment, range(len(experiments)), experiment_vectors,
+                                                chunksize = int(np.ceil(len(experiments) / workers))))
+            else:
+                evaluations = [experiment_residuals_and_jacobian(experiment_x, *experiment_models[index])
+                               for index, experiment_x in enumerate(experiment_vectors)]
+
+            residuals = np.concatenate([experiment_residuals for experiment_residuals, _ in evaluations])
+            jacobian = np.zeros((len(residuals), layout.size))
+            row = 0
+
+            for index, (experiment_residuals, experiment_jacobian) in enumerate(evaluations):
+                jacobian[row:row + len(experiment_residuals), layout.columns[index]] = experiment_jacobian
+                row += len(experiment_residuals)
+
+            last_evaluation.clear()
+            last_evaluation[key] = (residuals, jacobian, [np.sum(r ** 2) for r, _ in evaluations])
+
+        return last_evaluation[key]
+
+    try:
+        result = least_squares(lambda x: evaluate(x)[0],
+                               x0,
+                               jac = lambda x: evaluate(x)[1],
+                               bounds = (layout.bounds[:, 0], layout.bounds[:, 1]),
+                               method = 'trf',
+                               x_scale = 'jac')
+
+        experiment_errors = evaluate(result.x)[2]
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    degrees_of_freedom = max(len(result.fun) - layout.size, 1)
+    covariance = np.sum(result.fun ** 2) / degrees_of_freedom * np.linalg.pinv(result.jac.T @ result.jac)
+    standard_errors = np.sqrt(np.diag(covariance))
+
+    def split(values):
+        return {'shared': {name: values[layout.shared.index(name)] for name in layout.shared},
+                'per_experiment': {experiment_name: {name: values[layout.columns[index][layout.names.index(name)]]
+                                                     for name in layout.local}
+                                   for index, experiment_name in enumerate(experiment_names)}}
+
+    fit = split(result.x)
+    fit['standard_errors'] = split(standard_errors)
+    fit['error'] = float(np.sum(experiment_errors))
+    fit['experiment_errors'] = dict(zip(experiment_names, map(float, experiment_errors)))
+    fit['result'] = result
+
+    if print_results:
+        print(f"Global fit of {len(experiments)} experiments: error {fit['error']:.6g} "
+              f'after {result.nfev} evaluations ({result.message})')
+        print('Shared rate constants:')
+        pprint(fit['shared'])
+        print('Per-experiment rate constants:')
+        pprint(fit['per_experiment'])
+
+    return fit
+
+def global_fits_by_group(dataset,
+                         fitting_parameters,
+                         shared,
+                         groups = GLOBAL_FIT_GROUPS,
+                         general_prefix = None,
+                         workers = None,
+                         print_results = False):
+    '''
+    One global_fit per group of a dataset, over the active experiments of the group.
+    Returns {group: fit}.
+    '''
+
+    fits = {}
+
+    for group in groups:
+        experiments = group_experiments(dataset, group)
+
+        if not experiments:
+            continue
+
+        fits[group] = global_fit(experiments,
+                                 fitting_parameters,
+                                 shared,
+                                 general_prefix = general_prefix,
+                                 workers = workers,
+                                 print_results = print_results)
+
+    return fits
@@ -0,0 +1,353 @@
+import numpy as np
+from scipy.linalg import expm
+from scipy.optimize import differential_evolution
+from pprint import pprint
+
+from pyKES.reaction_ODE import solve_ode_system
+from pyKES.fitting_ODE import square_loss_time_series, square_loss_time_series_normalized
+from pyKES.utilities.resolve_attributes import resolve_experiment_attributes
+
+from simultaneous_detection.fitting.compiled_network import compile_parsed_network
+
+EIGENVECTOR_CONDITION_LIMIT = 1e6 # Above, (near-)degenerate rates are solved with expm
+
+def compile_linear_network(parsed_reactions, species):
+    '''
+    Checking whether a parsed reaction network (pyKES parse_reactions) is linear, i.e. every
+    reaction has exactly one reactant with stoichiometry 1, so that dy/dt = A(k) y.
+    Returns None for other networks, otherwise a dict with
+    - 'stoichiometry': (n_species, n_reactions) net stoichiometric matrix
+    - 'reactant_matrix': (n_reactions, n_species) one-hot reactant of each reaction
+    - 'rate_constants': rate constant name of each reaction
+    - 'other_multipliers': multiplier names of each reaction
+    A(k) = stoichiometry @ diag(rates) @ reactant_matrix, see rate_matrix.
+    '''
+
+    stoichiometry = np.zeros((len(species), len(parsed_reactions)))
+    reactant_index = []
+
+    for j, reaction in enumerate(parsed_reactions):
+        if len(reaction['reactants']) != 1:
+            return None
+
+        (reactant, order), = reaction['reactants'].items()
+
+        if order != 1:
+            return None
+
+        reactant_index.append(species.index(reactant))
+        stoichiometry[species.index(reactant), j] -= 1
+
+        for product, coefficient in reaction['products'].items():
+            stoichiometry[species.index(product), j] += coefficient
+
+    reactant_matrix = np.zeros((len(parsed_reactions), len(species)))
+    reactant_matrix[np.arange(len(parsed_reactions)), reactant_index] = 1
+
+    return {'stoichiometry': stoichiometry,
+            'reactant_matrix': reactant_matrix,
+            'rate_constants': [reaction['rate_constant'] for reaction in parsed_reactions],
+            'other_multipliers': [reaction['other_multipliers'] for reaction in parsed_reactions]}
+
+def reaction_rates(linear_network, rate_constants, other_multipliers = {}):
+    '''
+    Rate coefficient of each reaction (rate constant times its multipliers), shape
+    (n_reactions,), or (n_reactions, population size) if rate constants are arrays of
+    candidate values. Returns None if a multiplier is not a plain number (e.g. a function
+    of the concentrations), in which case the network has to be integrated.
+    '''
+
+    rates = []
+
+    for rate_constant, multipliers in zip(linear_network['rate_constants'], linear_network['other_multipliers']):
+        rate = rate_constants[rate_constant]
+
+        for multiplier in multipliers:
+            value = other_multipliers[multiplier]
+
+            if isinstance(value, dict):
+                return None
+
+            rate = rate * value
+
+        rates.append(rate)
+
+    return np.array(np.broadcast_arrays(*rates), dtype = np.float64)
+
+def rate_matrix(linear_network, rates):
+    '''
+    Matrix A of dy/dt = A y for given reaction rate coefficients, or a stack of matrices
+    (population size, n_species, n_species) for rates of shape (n_reactions, population size).
+    '''
+
+    rates = np.moveaxis(rates, 0, -1)[..., None, :]
+
+    return (linear_network['stoichiometry'] * rates) @ linear_network['reactant_matrix']
+
+def initial_concentrations(species, initial_conditions):
+    '''
+    Initial concentration vector as built by pyKES solve_ode_system.
+    '''
+
+    y0 = np.zeros(len(species))
+
+    for spec, conc in initial_conditions.items():
+        if spec in species:
+            y0[species.index(spec)] = conc
+        else:
+            print(f'Warning: {spec} not in species list')
+
+    return y0
+
+def solve_linear_system(A, y0, times, output_species = None):
+    '''
+    Solution of dy/dt = A y, y(times[0]) = y0 at times, shape (len(times), len(y0)), or
+    (population size, len(times), len(y0)) for a stack of matrices A. With output_species
+    (list of species indices) only these columns are computed.
+    Uses the eigendecomposition of A (y(t) = V exp(Lambda t) V^-1 y0); where the eigenvectors
+    are (close to) linearly dependent, e.g. for equal rate constants in a chain, the matrix
+    exponential is evaluated for every time point instead.
+    '''
+
+    if A.ndim == 2:
+        return solve_linear_system(A[None], y0, times, output_species)[0]
+
+    times = np.asarray(times, dtype = np.float64) - times[0]
+    output_species = np.arange(len(y0)) if output_species is None else np.asarray(output_species)
+
+    eigenvalues, eigenvectors = np.linalg.eig(A)
+    well_conditioned = np.linalg.cond(eigenvectors) < EIGENVECTOR_CONDITION_LIMIT
+
+    solution = np.empty((len(A), len(times), len(output_species)))
+
+    if np.any(well_conditioned):
+        eigenvalues, eigenvectors = eigenvalues[well_conditioned], eigenvectors[well_conditioned]
+
+        # Networks without cycles have real eigenvalues, real arithmetic is much faster
+        if not np.iscomplexobj(eigenvalues) or np.all(eigenvalues.imag == 0):
+            eigenvalues, eigenvectors = eigenvalues.real, eigenvectors.real
+
+        coefficients = np.linalg.solve(eigenvectors, np.broadcast_to(y0, (len(eigenvectors), len(y0)))[..., None])[..., 0]
+
+        modes = np.exp(times[None, :, None] * eigenvalues[:, None, :]) * coefficients[:, None, :]
+        solution[well_conditioned] = (modes @ np.swapaxes(eigenvectors[:, output_species, :], 1, 2)).real
+
+    for index in np.flatnonzero(~well_conditioned):
+        solution[index] = (expm(A[index][None, :, :] * times[:, None, None]) @ y0)[:, output_species]
+
+    return solution
+
+def solve_kinetic_model(parsed_reactions,
+                        species,
+                        rate_constants,
+                        initial_conditions,
+                        times,
+                        other_multipliers = {},
+                        linear_network = None):
+    '''
+    Drop-in for pyKES solve_ode_system: linear networks (see compile_linear_network) are
+    solved in closed form, all others are integrated with the generated right-hand side and
+    Jacobian of compiled_network (or solve_ode_system for multipliers given as functions).
+    Pass the compiled linear_network to avoid compiling it on every call.
+    '''
+
+    if linear_network is None:
+        linear_network = compile_linear_network(parsed_reactions, species)
+
+    if linear_network is not None:
+        rates = reaction_rates(linear_network, rate_constants, other_multipliers)
+
+        if rates is not None:
+            return solve_linear_system(rate_matrix(linear_network, rates),
+                                       initial_concentrations(species, initial_conditions),
+                                       times)
+
+    compiled_network = compile_parsed_network(parsed_reactions)
+
+    if compiled_network.supports(other_multipliers):
+        return compiled_network.solve(rate_constants, initial_conditions, times, other_multipliers)
+
+    return solve_ode_system(parsed_reactions, species, rate_constants, initial_conditions, times, other_multipliers)
+
+def prepare_experiments(model):
+    '''
+    Resolving the experiment attributes of a Fitting_Model once (as done by pyKES
+    objective_function on every call): one dict per experiment with its name, weight,
+    initial conditions, other multipliers, times and data to be fitted.
+    '''
+
+    prepared_experiments = []
+
+    for experiment_entry in model.experiments:
+
+        if isinstance(experiment_entry, tuple):
+            experiment, weight = experiment_entry
+        else:
+            experiment, weight = experiment_entry, 1.0
+
+        prepared_experiments.append({
+            'experiment_name': experiment.experiment_name,
+            'weight': weight,
+            'initial_conditions': resolve_experiment_attributes(model.initial_conditions, experiment, mode = 'semi-strict'),
+            'other_multipliers': resolve_experiment_attributes(model.other_multipliers, experiment, mode = 'strict'),
+            'times': resolve_experiment_attributes(model.times, experiment, mode = 'strict')['times'],
+            'data_to_be_fitted': resolve_experiment_attributes(model.data_to_be_fitted, experiment, mode = 'semi-strict'),
+        })
+
+    return prepared_experiments
+
+def prepared_objective_function(rate_constants_to_optimize,
+                                model,
+                                prepared_experiments,
+                                linear_network = None,
+                                return_full = False):
+    '''
+    pyKES objective_function on experiments resolved by prepare_experiments, solving the
+    model with solve_kinetic_model. Same return values as objective_function.
+    '''
+
+    rate_constants = dict(zip(model.rate_constants_to_optimize.keys(), rate_constants_to_optimize))
+    rate_constants |= model.fixed_rate_constants
+
+    total_error = 0.0
+    full_output = {}
+    time_series = {}
+
+    for prepared in prepared_experiments:
+        experiment_name = prepared['experiment_name']
+        full_output[experiment_name] = {}
+
+        model_result = solve_kinetic_model(model.parsed_reactions,
+                                           model.species,
+                                           rate_constants,
+                                           prepared['initial_conditions'],
+                                           prepared['times'],
+                                           prepared['other_multipliers'],
+                                           linear_network = linear_network)
+        time_series[experiment_name] = model_result
+
+        experiment_error = 0.0
+
+        for species, data in prepared['data_to_be_fitted'].items():
+            model_data = model_result[:, model.species.index(species)]
+
+            error, model_data_transformed = model.loss_function(model_data, data, times = prepared['times'])
+
+            full_output[experiment_name][species] = model_data_transformed
+            experiment_error += error
+
+        total_error += experiment_error * prepared['weight']
+
+    if return_full is True:
+        return total_error, full_output
+    elif return_full == 'All':
+        return total_error, full_output, time_series
+    else:
+        return total_error
+
+def kinetic_objective_function(rate_constants_to_optimize, model, return_full = False):
+    '''
+    Drop-in for pyKES objective_function using solve_kinetic_model.
+    '''
+
+    return prepared_objective_function(rate_constants_to_optimize,
+                                       model,
+                                       prepare_experiments(model),
+                                       linear_network = compile_linear_network(model.parsed_reactions, model.species),
+                                       return_full = return_full)
+
+def population_loss(loss_function, model_data, data, times):
+    '''
+    Loss of every candidate trajectory (rows of model_data) against the data. The square
+    losses of pyKES are evaluated with broadcasting, other loss functions row by row.
+    '''
+
+    if loss_function in (square_loss_time_series, square_loss_time_series_normalized):
+        y = np.asarray(data['y'])
+        raw_square_loss = np.sum((model_data - y) ** 2, axis = -1)
+
+        if loss_function is square_loss_time_series:
+            return raw_square_loss
+
+        return raw_square_loss / (len(y) * (np.mean(np.abs(y)) ** 2 + 1e-12))
+
+    return np.array([loss_function(row, data, times = times)[0] for row in model_data])
+
+def population_objective_function(population,
+                                  model,
+                                  prepared_experiments,
+                                  linear_network = None):
+    '''
+    prepared_objective_function for a whole differential evolution population at once
+    (differential_evolution with vectorized = True): population has shape
+    (n_rate_constants, population size), the errors of all candidates are returned.
+    For linear networks all candidates are solved as one stack of rate matrices,
+    otherwise they are evaluated one by one.
+    '''
+
+    population = np.atleast_2d(population)
+    population_size = population.shape[1]
+
+    rate_constants = dict(zip(model.rate_constants_to_optimize.keys(), population))
+    rate_constants |= model.fixed_rate_constants
+
+    total_error = np.zeros(population_size)
+
+    for prepared in prepared_experiments:
+        rates = None
+
+        if linear_network is not None:
+            rates = reaction_rates(linear_network, rate_constants, prepared['other_multipliers'])
+
+        if rates is None:
+            return np.array([prepared_objective_function(candidate, model, prepared_experiments, linear_network)
+                             for candidate in population.T])
+
+        rates = np.broadcast_to(rates, (len(rates), population_size))
+
+        model_results = solve_linear_system(rate_matrix(linear_network, rates),
+                                            initial_concentrations(model.species, prepared['initial_conditions']),
+                                            prepared['times'],
+                                            output_species = [model.species.index(species) for species in prepared['data_to_be_fitted']])
+
+        for column, (species, data) in enumerate(prepared['data_to_be_fitted'].items()):
+            model_data = model_results[:, :, column]
+            total_error += population_loss(model.loss_function, model_data, data, prepared['times']) * prepared['weight']
+
+    return total_error
+
+def optimize(model,
+             workers = 1,
+             disp = False,
+             print_results = False,
+             vectorized = False):
+    '''
+    Fitting_Model.optimize (differential evolution with the same settings, seeded with
+    model.x0) with the objective evaluated by prepared_objective_function. With
+    vectorized = True, each generation is scored in one population_objective_function
+    call instead (workers is then ignored). Sets model.result.
+    '''
+
+    bounds = list(model.rate_constants_to_optimize.values())
+
+    model.result = differential_evolution(
+        population_objective_function if vectorized else prepared_objective_function,
+        bounds = bounds,
+        args = (model,
+                prepare_experiments(model),
+                compile_linear_network(model.parsed_reactions, model.species)),
+        workers = 1 if vectorized else workers,
+        disp = disp,
+        updating = 'deferred',
+        vectorized = vectorized,
+        x0 = model.x0)
+
+    if print_results:
+        print(model.result)
+        print('----------------------------')
+        print('Optimized rate constants:')
+        pprint(dict(zip(model.rate_constants_to_optimize.keys(), model.result.x)))
+        print('Fixed rate constants:')
+        pprint(model.fixed_rate_constants)
+
+    return model.result
@@ -0,0 +1,229 @@
+import os
+import copy
+import json
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+
+from pyKES.fitting_ODE import square_loss_time_series, square_loss_time_series_normalized
+
+from simultaneous_detection.fitting.kinetic_solver import optimize
+from simultaneous_detection.fitting.fit_cache import fit_cache_key
+from simultaneous_detection.fitting.sensitivity_refinement import refine_fit
+from simultaneous_detection.data_parsing.warm_start import local_polish
+
+def model_at_parameter(model, parameter, value):
+    '''
+    Copy of a Fitting_Model with a multiplier (of the reaction network) or a rate constant
+    fixed at value. A rate constant is removed from model.rate_constants_to_optimize.
+    The experiments are shared with the original model.
+    '''
+
+    point_model = copy.copy(model)
+    multipliers = {multiplier for reaction in model.parsed_reactions for multiplier in reaction['other_multipliers']}
+
+    if parameter in multipliers or parameter in model.other_multipliers:
+        point_model.other_multipliers = {**model.other_multipliers, parameter: value}
+    elif parameter in model.rate_constants_to_optimize or parameter in model.fixed_rate_constants:
+        point_model.rate_constants_to_optimize = {name: bounds for name, bounds in model.rate_constants_to_optimize.items()
+                                                  if name != parameter}
+        point_model.fixed_rate_constants = {**model.fixed_rate_constants, parameter: value}
+    else:
+        raise ValueError(f"'{parameter}' is neither a multiplier nor a rate constant of the model.")
+
+    return point_model
+
+def fit_point(model, parameter, value, x0 = None):
+    '''
+    Fitting the model with parameter fixed at value. Without x0 the global differential
+    evolution runs, with x0 (the optimum of a neighbouring grid point) only a local
+    refinement: sensitivity_refinement.refine_fit for square losses, warm_start.local_polish
+    otherwise. Returns {'value', 'rate_constants', 'error', 'nfev', 'warm_started'}.
+    '''
+
+    point_model = model_at_parameter(model, parameter, value)
+    names = list(point_model.rate_constants_to_optimize)
+
+    if x0 is None:
+        optimize(point_model, vectorized = True)
+        result = point_model.result
+    else:
+        bounds = np.array(list(point_model.rate_constants_to_optimize.values()), dtype = float)
+        x0 = np.clip([x0[name] for name in names], bounds[:, 0], bounds[:, 1])
+
+        if point_model.loss_function in (square_loss_time_series, square_loss_time_series_normalized):
+            refine_fit(point_model, x0 = x0)
+            result = point_model.result
+        else:
+            result = local_polish(point_model, x0)
+
+    return {'value': float(value),
+            'rate_constants': {name: float(x) for name, x in zip(names, result.x)},
+            'error': float(result.fun),
+            'nfev': int(result.nfev),
+            'warm_started': x0 is not None}
+
+def sweep_configuration(model, parameter, grid):
+    '''
+    Hash of everything a sweep depends on: the model configuration and data (see
+    fit_cache.fit_cache_key), the swept parameter and the grid.
+    '''
+
+    return fit_cache_key(model, sweep_parameter = parameter, sweep_grid = np.asarray(grid, dtype = float))
+
+def load_checkpoint(checkpoint_file, parameter, grid, configuration = None):
+    '''
+    Results of grid points stored in checkpoint_file by a previous (interrupted) sweep
+    of the same parameter, as {grid index: point result}. Raises if the checkpoint was
+    written for another configuration (see sweep_configuration).
+    '''
+
+    if checkpoint_file is None or not os.path.exists(checkpoint_file):
+        return {}
+
+    with open(checkpoint_file, 'r') as f:
+        checkpoint = json.load(f)
+
+    if checkpoint['parameter'] != parameter:
+        raise ValueError(f"Checkpoint {checkpoint_file} belongs to a sweep of '{checkpoint['parameter']}', not '{parameter}'.")
+
+    if configuration is not None and checkpoint.get('configuration') != configuration:
+        raise ValueError(f'Checkpoint {checkpoint_file} belongs to a sweep with a different model, experiments, '
+                         f'bounds, fixed parameters or grid.')
+
+    completed = {}
+
+    for point in checkpoint['points']:
+        matches = np.flatnonzero(np.isclose(grid, point['value'], rtol = 1e-12, atol = 0))
+
+        if len(matches):
+            completed[int(matches[0])] = point
+
+    return completed
+
+def write_checkpoint(checkpoint_file, parameter, completed, configuration = None):
+    '''
+    Writing all completed grid points, replacing the file atomically so that an interruption
+    never leaves a truncated checkpoint.
+    '''
+
+    temporary_file = f'{checkpoint_file}.tmp'
+
+    with open(temporary_file, 'w') as f:
+        json.dump({'parameter': parameter,
+                   'configuration': configuration,
+                   'points': [completed[index] for index in sorted(completed)]}, f, indent = 1)
+
+    os.replace(temporary_file, checkpoint_file)
+
+def farthest_index(candidates, occupied):
+    '''
+    Candidate grid index with the largest distance to all occupied indices.
+    '''
+
+    if not occupied:
+        return candidates[len(candidates) // 2]
+
+    return max(candidates, key = lambda index: min(abs(index - other) for other in occupied))
+
+def parameter_sweep(model,
+                    parameter,
+                    grid,
+                    workers = None,
+                    checkpoint_file = None,
+                    print_results = True):
+    '''
+    Profile of the fitting error over a grid of values of one parameter (a multiplier such as
+    'factor1' or a rate constant), with all other rate constants optimized at every point.
+
+    Grid points run in parallel in a process pool. Only a few seed points, spread over the grid,
+    are fitted with the global differential evolution; every other point starts from the optimum
+    of an already fitted neighbour and is refined locally (see fit_point). A point becomes ready as
+    soon as one of its neighbours is done, so the sweep spreads out from the seeds.
+
+    With checkpoint_file (.json) every finished point is stored immediately and a restarted sweep
+    of the same model, experiments and grid continues from the stored points (a checkpoint of
+    another configuration raises).
+
+    Returns {'parameter', 'values', 'errors', 'rate_constants', 'points'}, sorted by grid value.
+
+    Usage:
+        profile = parameter_sweep(model, 'factor1', np.linspace(0.5, 5.0, 20),
+                                  checkpoint_file = 'data/factor1_profile.json')
+        plt.plot(profile['values'], profile['errors'], 'o-')
+    '''
+
+    grid = np.sort(np.asarray(grid, dtype = float))
+    workers = workers or os.cpu_count()
+
+    model_at_parameter(model, parameter, grid[0]) # Fails early for unknown parameters
+
+    configuration = sweep_configuration(model, parameter, grid) if checkpoint_file is not None else None
+    completed = load_checkpoint(checkpoint_file, parameter, grid, configuration)
+    running = {}
+
+    if completed and print_results:
+        print(f'Resuming sweep of {parameter}: {len(completed)} of {len(grid)} points from {checkpoint_file}')
+
+    def next_tasks():
+        '''
+        Pending points next to a completed point, warm-started from it; if workers are still
+        idle, seed points far from all completed and running points.
+        '''
+
+        tasks = []
+        occupied = set(completed) | set(running.values())
+
+        for index in range(len(grid)):
+            if len(running) + len(tasks) >= workers:
+                return tasks
+            if index in occupied:
+                continue
+
+            neighbours = [other for other in (index - 1, index + 1) if other in completed]
+
+            if neighbours:
+                start = min(neighbours, key = lambda other: completed[other]['error'])
+                tasks.append((index, completed[start]['rate_constants']))
+                occupied.add(index)
+
+        pending = [index for index in range(len(grid)) if index not in occupied]
+
+        # Seeds only where no warm start will reach soon
+        while pending and len(running) + len(tasks) < workers and not (completed and running):
+            seed = farthest_index(pending, occupied)
+            tasks.append((seed, None))
+            occupied.add(seed)
+            pending.remove(seed)
+
+        return tasks
+
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+
+        while len(completed) < len(grid):
+
+            for index, x0 in next_tasks():
+                running[executor.submit(fit_point, model, parameter, grid[index], x0)] = index
+
+            done, _ = wait(running, return_when = FIRST_COMPLETED)
+
+            for future in done:
+                index = running.pop(future)
+                completed[index] = future.result()
+
+                if checkpoint_file is not None:
+                    write_checkpoint(checkpoint_file, parameter, completed, configuration)
+
+                if print_results:
+                    point = completed[index]
+                    start = 'warm start' if point['warm_started'] else 'global'
+                    print(f"{parameter} = {point['value']:.6g}: error {point['error']:.6g} "
+                          f"({start}, {point['nfev']} evaluations, {len(completed)}/{len(grid)})")
+
+    points = [completed[index] for index in range(len(grid))]
+
+    return {'parameter': parameter,
+            'values': grid,
+            'errors': np.array([point['error'] for point in points]),
+            'rate_constants': [point['rate_constants'] for point in points],
+            'points': points}
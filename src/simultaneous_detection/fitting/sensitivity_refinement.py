@@ -0,0 +1,311 @@
+import numpy as np
+from scipy.linalg import expm
+from scipy.optimize import least_squares, OptimizeResult
+from pprint import pprint
+
+from pyKES.fitting_ODE import square_loss_time_series, square_loss_time_series_normalized
+
+from simultaneous_detection.fitting.kinetic_solver import (compile_linear_network,
+                                                           prepare_experiments,
+                                                           prepared_objective_function,
+                                                           reaction_rates,
+                                                           rate_matrix,
+                                                           initial_concentrations,
+                                                           solve_kinetic_model)
+
+def propagate_linear_system(B, z0, times):
+    '''
+    Solution of dz/dt = B z, z(times[0]) = z0 at times, shape (len(times), len(z0)).
+    For equally spaced times, one matrix exponential is applied step by step, otherwise
+    expm is evaluated for every time point.
+    '''
+
+    times = np.asarray(times, dtype = np.float64)
+    steps = np.diff(times)
+
+    if len(steps) and np.allclose(steps, steps[0], rtol = 1e-9, atol = 0):
+        propagator = expm(B * steps[0])
+        solution = np.empty((len(times), len(z0)))
+        solution[0] = z0
+
+        for i in range(1, len(times)):
+            solution[i] = propagator @ solution[i - 1]
+
+        return solution
+
+    return expm(B[None, :, :] * (times - times[0])[:, None, None]) @ z0
+
+def rate_derivatives(linear_network, rate_constants, other_multipliers, parameter):
+    '''
+    Derivative of the rate coefficient of each reaction (rate constant times multipliers)
+    with respect to one rate constant or multiplier.
+    '''
+
+    derivatives = np.zeros(len(linear_network['rate_constants']))
+
+    for j, (rate_constant, multipliers) in enumerate(zip(linear_network['rate_constants'],
+                                                         linear_network['other_multipliers'])):
+        factors = [rate_constants[rate_constant]] + [other_multipliers[multiplier] for multiplier in multipliers]
+        names = [rate_constant] + list(multipliers)
+
+        # Product rule over every occurrence of the parameter
+        for position, name in enumerate(names):
+            if name == parameter:
+                derivatives[j] += np.prod(factors[:position] + factors[position + 1:])
+
+    return derivatives
+
+def linear_sensitivities(linear_network,
+                         species,
+                         rate_constants,
+                         initial_conditions,
+                         times,
+                         other_multipliers,
+                         parameters):
+    '''
+    Trajectories y (len(times), n_species) of a linear network and their sensitivities
+    dy/dp (len(parameters), len(times), n_species) with respect to rate constants and
+    multipliers. The forward sensitivity equations dS_p/dt = A S_p + (dA/dp) y are linear
+    as well and are solved together with y as one augmented linear system.
+    '''
+
+    n_species = len(species)
+    n_parameters = len(parameters)
+
+    A = rate_matrix(linear_network, reaction_rates(linear_network, rate_constants, other_multipliers))
+
+    B = np.zeros(((n_parameters + 1) * n_species, (n_parameters + 1) * n_species))
+    B[:n_species, :n_species] = A
+
+    for p, parameter in enumerate(parameters, start = 1):
+        block = slice(p * n_species, (p + 1) * n_species)
+        B[block, block] = A
+        B[block, :n_species] = rate_matrix(linear_network,
+                                           rate_derivatives(linear_network, rate_constants, other_multipliers, parameter))
+
+    z0 = np.zeros(len(B))
+    z0[:n_species] = initial_concentrations(species, initial_conditions)
+
+    solution = propagate_linear_system(B, z0, times)
+
+    y = solution[:, :n_species]
+    sensitivities = solution[:, n_species:].reshape(len(times), n_parameters, n_species).transpose(1, 0, 2)
+
+    return y, sensitivities
+
+def residual_scale(loss_function, data):
+    '''
+    Factor turning model - data into residuals whose sum of squares is the loss.
+    '''
+
+    if loss_function is square_loss_time_series:
+        return 1.0
+    if loss_function is square_loss_time_series_normalized:
+        y = np.asarray(data['y'])
+        return 1 / np.sqrt(len(y) * (np.mean(np.abs(y)) ** 2 + 1e-12))
+
+    raise ValueError('Sensitivity refinement requires square_loss_time_series or '
+                     'square_loss_time_series_normalized as loss function.')
+
+def parameter_values(model, x, multipliers):
+    '''
+    Rate constants and multipliers for a parameter vector x (rate constants to optimize,
+    followed by the refined multipliers).
+    '''
+
+    n_rate_constants = len(model.rate_constants_to_optimize)
+
+    rate_constants = dict(zip(model.rate_constants_to_optimize, x[:n_rate_constants]))
+    rate_constants |= model.fixed_rate_constants
+
+    return rate_constants, dict(zip(multipliers, x[n_rate_constants:]))
+
+def model_residuals(x, model, prepared_experiments, multipliers = ()):
+    '''
+    Weighted residuals as in residuals_and_jacobian for any network, solved with
+    kinetic_solver.solve_kinetic_model.
+    '''
+
+    rate_constants, multiplier_values = parameter_values(model, x, multipliers)
+
+    residuals = []
+
+    for prepared in prepared_experiments:
+        y = solve_kinetic_model(model.parsed_reactions,
+                                model.species,
+                                rate_constants,
+                                prepared['initial_conditions'],
+                                prepared['times'],
+                                prepared['other_multipliers'] | multiplier_values)
+
+        for species, data in prepared['data_to_be_fitted'].items():
+            scale = residual_scale(model.loss_function, data) * np.sqrt(prepared['weight'])
+            residuals.append((y[:, model.species.index(species)] - np.asarray(data['y'])) * scale)
+
+    return np.concatenate(residuals)
+
+def residuals_and_jacobian(x, model, prepared_experiments, linear_network, multipliers = ()):
+    '''
+    Weighted residuals of all fitted species of all experiments (sum of squares equals
+    the objective function) and their Jacobian with respect to x.
+    '''
+
+    rate_constants, multiplier_values = parameter_values(model, x, multipliers)
+    parameters = list(model.rate_constants_to_optimize) + list(multipliers)
+
+    residuals = []
+    jacobian = []
+
+    for prepared in prepared_experiments:
+        other_multipliers = prepared['other_multipliers'] | multiplier_values
+
+        y, sensitivities = linear_sensitivities(linear_network,
+                                                model.species,
+                                                rate_constants,
+                                                prepared['initial_conditions'],
+                                                prepared['times'],
+                                                other_multipliers,
+                                                parameters)
+
+        for species, data in prepared['data_to_be_fitted'].items():
+            index = model.species.index(species)
+            scale = residual_scale(model.loss_function, data) * np.sqrt(prepared['weight'])
+
+            residuals.append((y[:, index] - np.asarray(data['y'])) * scale)
+            jacobian.append(sensitivities[:, :, index].T * scale)
+
+    return np.concatenate(residuals), np.concatenate(jacobian)
+
+def parameter_covariance(residuals, jacobian):
+    '''
+    Covariance s^2 (J^T J)^-1 of the parameters, with s^2 the residual variance, and their
+    standard errors.
+    '''
+
+    degrees_of_freedom = max(len(residuals) - jacobian.shape[1], 1)
+    residual_variance = np.sum(residuals ** 2) / degrees_of_freedom
+
+    covariance = residual_variance * np.linalg.pinv(jacobian.T @ jacobian)
+
+    return covariance, np.sqrt(np.diag(covariance))
+
+def standard_errors_at(model, x, multipliers = ()):
+    '''
+    Covariance and standard errors (as in refine_fit) of the rate constants x and the
+    current values of multipliers, e.g. for a fit whose refinement was rejected.
+    The Jacobian is analytic for linear networks and a forward difference otherwise.
+    Returns a dict with 'covariance' and 'standard_errors'.
+    '''
+
+    linear_network = compile_linear_network(model.parsed_reactions, model.species)
+    prepared_experiments = prepare_experiments(model)
+
+    x = np.concatenate((x, [model.other_multipliers[multiplier] for multiplier in multipliers])).astype(float)
+
+    if linear_network is not None:
+        residuals, jacobian = residuals_and_jacobian(x, model, prepared_experiments, linear_network, multipliers)
+    else:
+        residuals = model_residuals(x, model, prepared_experiments, multipliers)
+        steps = np.sqrt(np.finfo(float).eps) * np.maximum(np.abs(x), 1e-12)
+        jacobian = np.column_stack([(model_residuals(x + step * unit, model, prepared_experiments, multipliers) - residuals) / step
+                                    for step, unit in zip(steps, np.eye(len(x)))])
+
+    covariance, standard_errors = parameter_covariance(residuals, jacobian)
+    names = list(model.rate_constants_to_optimize) + list(multipliers)
+
+    return {'covariance': covariance,
+            'standard_errors': dict(zip(names, standard_errors))}
+
+def refine_fit(model,
+               x0 = None,
+               multipliers = (),
+               print_results = False):
+    '''
+    Local trust-region (scipy least_squares, 'trf') refinement of a fit with analytic
+    Jacobians from the forward sensitivities of a linear network (see linear_sensitivities),
+    or finite-difference Jacobians for other networks, within the bounds of model.rate_constants_to_optimize. Multipliers listed in multipliers
+    (plain numbers in model.other_multipliers, e.g. 'factor1') are refined as well, within
+    a factor of 100 of their current value, and updated in model.other_multipliers.
+
+    Starts from x0, by default model.result.x. Sets model.result to the refined rate constants
+    (with the same error as kinetic_solver.prepared_objective_function) and returns a dict with
+    the refined 'rate_constants', 'multipliers', their 'covariance' and 'standard_errors'
+    (s^2 (J^T J)^-1 with s^2 the residual variance), the 'error' and the least_squares 'result'.
+    '''
+
+    linear_network = compile_linear_network(model.parsed_reactions, model.species)
+
+    for multiplier in multipliers:
+        if not isinstance(model.other_multipliers.get(multiplier), (int, float)):
+            raise ValueError(f"Multiplier '{multiplier}' must be a number in model.other_multipliers.")
+
+    prepared_experiments = prepare_experiments(model)
+
+    bounds = np.array(list(model.rate_constants_to_optimize.values()) +
+                      [(model.other_multipliers[multiplier] / 100, model.other_multipliers[multiplier] * 100)
+                       for multiplier in multipliers], dtype = float)
+
+    if x0 is None:
+        x0 = model.result.x
+
+    x0 = np.concatenate((x0, [model.other_multipliers[multiplier] for multiplier in multipliers]))
+    x0 = np.clip(x0, bounds[:, 0], bounds[:, 1])
+
+    if linear_network is not None:
+        # least_squares evaluates residuals and Jacobian separately at the same x
+        last_evaluation = {}
+
+        def evaluate(x):
+            key = x.tobytes()
+            if key not in last_evaluation:
+                last_evaluation.clear()
+                last_evaluation[key] = residuals_and_jacobian(x, model, prepared_experiments, linear_network, multipliers)
+            return last_evaluation[key]
+
+        residuals = lambda x: evaluate(x)[0]
+        jacobian = lambda x: evaluate(x)[1]
+    else:
+        residuals = lambda x: model_residuals(x, model, prepared_experiments, multipliers)
+        jacobian = '2-point'
+
+    result = least_squares(
+        residuals,
+        x0,
+        jac = jacobian,
+        bounds = (bounds[:, 0], bounds[:, 1]),
+        method = 'trf',
+        x_scale = 'jac')
+
+    covariance, standard_errors = parameter_covariance(result.fun, result.jac)
+
+    n_rate_constants = len(model.rate_constants_to_optimize)
+    names = list(model.rate_constants_to_optimize) + list(multipliers)
+
+    for multiplier, value in zip(multipliers, result.x[n_rate_constants:]):
+        model.other_multipliers[multiplier] = value
+
+    error = prepared_objective_function(result.x[:n_rate_constants], model,
+                                        prepare_experiments(model), linear_network)
+
+    model.result = OptimizeResult(x = result.x[:n_rate_constants],
+                                  fun = error,
+                                  nfev = result.nfev,
+                                  njev = result.njev,
+                                  success = result.success,
+                                  message = result.message)
+
+    refinement = {
+        'rate_constants': dict(zip(names[:n_rate_constants], result.x[:n_rate_constants])),
+        'multipliers': dict(zip(multipliers, result.x[n_rate_constants:])),
+        'covariance': covariance,
+        'standard_errors': dict(zip(names, standard_errors)),
+        'error': error,
+        'result': result,
+    }
+
+    if print_results:
+        print(f'Refinement: error {error:.6g} after {result.nfev} evaluations ({result.message})')
+        print('Refined parameters and standard errors:')
+        pprint({name: (value, standard_error) for name, value, standard_error in zip(names, result.x, standard_errors)})
+
+    return refinement
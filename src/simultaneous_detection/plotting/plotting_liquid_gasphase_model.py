@@ -11,27 +11,28 @@ rcParams['mathtext.rm'] = 'Arial'
 rcParams['mathtext.it'] = 'Arial:italic'
 rcParams['mathtext.bf'] = 'Arial:bold'
 
-from pyKES.database.database_experiments import ExperimentalDataset
+from simultaneous_detection.data_parsing.lazy_dataset import LazyExperimentalDataset
 
 
 def main():
-    dataset = ExperimentalDataset.load_from_hdf5('data/251204_processed_O2_H2_data_with_fits.h5')
 
     fig, ax = plt.subplots(2, 1, figsize=(7, 7))
     fig.tight_layout(pad=2.0)
     fig.subplots_adjust(left = 0.12, right = 0.55, hspace = 0.4)
 
-    O2_gas_experimental = dataset.experiments['NB-312'].processed_data['[O2-g]_experimental']
-    O2_gas_fit = dataset.experiments['NB-312'].processed_data['[O2-g]_fit']
+    # Only four entries of two experiments are needed, so the dataset is opened lazily
+    with LazyExperimentalDataset('data/251204_processed_O2_H2_data_with_fits.h5') as dataset:
+        O2_gas_experimental = dataset.experiments['NB-312'].processed_data['[O2-g]_experimental']
+        O2_gas_fit = dataset.experiments['NB-312'].processed_data['[O2-g]_fit']
 
-    H2_gas_experimental = dataset.experiments['NB-312'].processed_data['[H2-g]_experimental']
-    H2_gas_fit = dataset.experiments['NB-312'].processed_data['[H2-g]_fit']
+        H2_gas_experimental = dataset.experiments['NB-312'].processed_data['[H2-g]_experimental']
+        H2_gas_fit = dataset.experiments['NB-312'].processed_data['[H2-g]_fit']
 
-    O2_aq_experimental = dataset.experiments['NB-353'].processed_data['[O2-detected]_experimental']
-    O2_aq_fit = dataset.experiments['NB-353'].processed_data['[O2-detected]_fit']
+        O2_aq_experimental = dataset.experiments['NB-353'].processed_data['[O2-detected]_experimental']
+        O2_aq_fit = dataset.experiments['NB-353'].processed_data['[O2-detected]_fit']
 
-    H2_aq_experimental = dataset.experiments['NB-353'].processed_data['[H2-detected]_experimental']
-    H2_aq_fit = dataset.experiments['NB-353'].processed_data['[H2-detected]_fit']
+        H2_aq_experimental = dataset.experiments['NB-353'].processed_data['[H2-detected]_experimental']
+        H2_aq_fit = dataset.experiments['NB-353'].processed_data['[H2-detected]_fit']
 
     ax[0].plot(H2_aq_experimental['x'], H2_aq_experimental['y'],
         '.', color = 'gray', label = 'Data H$_2$')
@@ -15,6 +15,7 @@ from pyKES.database.database_experiments import ExperimentalDataset
 from pyKES.utilities.resolve_attributes import resolve_experiment_attributes
 
 from simultaneous_detection.data_parsing.processing_parameters import GROUP_MAPPING, PLOTTING_INSTRUCTIONS
+from simultaneous_detection.data_parsing.lazy_dataset import LazyExperimentalDataset
 
 
 def plot_experiment_group(
@@ -257,150 +258,150 @@ def plot_experiment_group(
 
 
 def main():
-    # Example usage
-    dataset = ExperimentalDataset.load_from_hdf5('data/251204_processed_O2_H2_data.h5')
+    # Example usage; only the experiments of the plotted groups are read
+    with LazyExperimentalDataset('data/251204_processed_O2_H2_data.h5') as dataset:
     
-    # Define which data series to plot
-    plotting_instructions = {
-        'Reaction (H$_2$)': PLOTTING_INSTRUCTIONS['time_series_instructions']['Reaction (H2)'],
-        'Reaction (O$_2$)': PLOTTING_INSTRUCTIONS['time_series_instructions']['Reaction (O2)'],
-    }
+        # Define which data series to plot
+        plotting_instructions = {
+            'Reaction (H$_2$)': PLOTTING_INSTRUCTIONS['time_series_instructions']['Reaction (H2)'],
+            'Reaction (O$_2$)': PLOTTING_INSTRUCTIONS['time_series_instructions']['Reaction (O2)'],
+        }
     
-    # Define custom styles
-    plotting_styles = {
-        'Reaction (H$_2$)': {'linestyle': '--', 'linewidth': 1.5},
-        'Reaction (O$_2$)': {'linestyle': '-', 'linewidth': 1.5},
-    }
+        # Define custom styles
+        plotting_styles = {
+            'Reaction (H$_2$)': {'linestyle': '--', 'linewidth': 1.5},
+            'Reaction (O$_2$)': {'linestyle': '-', 'linewidth': 1.5},
+        }
     
-    # fig, axes = plot_experiment_group(
-    #     dataset=dataset,
-    #     experiment_group='Intensity',
-    #     figure_title='Screening of irradiance',
-    #     plotting_instructions=plotting_instructions,
-    #     plotting_styles=plotting_styles,
-    #     viridis_range=(0.2, 0.8),
-    #     subplot_title_format="{value} mW·cm$^{{-2}}$",
-    #     xlabel="Time / s",
-    #     ylim = (-10, 140),
-    #     figsize_per_row= (8, 3),
-    #     subplots_adjustments={'top': 0.8},
-    #     ylabel=r"Concentration / $\mu$mol$\cdot$L$^{-1}$",
-    #     save_figure=True,
-    #     save_path='figures/Intensity_Screening.png',
-    #     show_figure=True,
-    # )
-
-    # fig, axes = plot_experiment_group(
-    #     dataset=dataset,
-    #     experiment_group='Loading',
-    #     figure_title='Screening of co-catalyst loading',
-    #     plotting_instructions=plotting_instructions,
-    #     plotting_styles=plotting_styles,
-    #     viridis_range=(0.2, 0.8),
-    #     subplot_title_format="{value} wt. fraction Rh/Cr",
-    #     xlabel="Time / s",
-    #     ylabel=r"Concentration / $\mu$mol$\cdot$L$^{-1}$",
-    #     figsize_per_row= (8, 4),
-    #     subplots_adjustments={'top': 0.7},
-    #     legend_location=(0.5, 0.9),
-    #     save_figure=True,
-    #     save_path='figures/Loading_Screening.png',
-    #     show_figure=True,
-    # )
-
-    # fig, axes = plot_experiment_group(
-    #     dataset=dataset,
-    #     experiment_group='Temperature',
-    #     figure_title='Screening of reaction temperature',
-    #     plotting_instructions=plotting_instructions,
-    #     plotting_styles=plotting_styles,
-    #     viridis_range=(0.2, 0.8),
-    #     subplot_title_format="{value} °C",
-    #     ylim= (-5, 60),
-    #     xlabel="Time / s",
-    #     ylabel=r"Concentration / $\mu$mol$\cdot$L$^{-1}$",
-    #     subplots_adjustments={'top': 0.7},
-    #     legend_location=(0.5, 0.9),
-    #     figsize_per_row= (8, 4),
-    #     save_figure=True,
-    #     save_path='figures/Temperature_Screening.png',
-    #     show_figure=True,
-    # )
+        # fig, axes = plot_experiment_group(
+        #     dataset=dataset,
+        #     experiment_group='Intensity',
+        #     figure_title='Screening of irradiance',
+        #     plotting_instructions=plotting_instructions,
+        #     plotting_styles=plotting_styles,
+        #     viridis_range=(0.2, 0.8),
+        #     subplot_title_format="{value} mW·cm$^{{-2}}$",
+        #     xlabel="Time / s",
+        #     ylim = (-10, 140),
+        #     figsize_per_row= (8, 3),
+        #     subplots_adjustments={'top': 0.8},
+        #     ylabel=r"Concentration / $\mu$mol$\cdot$L$^{-1}$",
+        #     save_figure=True,
+        #     save_path='figures/Intensity_Screening.png',
+        #     show_figure=True,
+        # )
+
+        # fig, axes = plot_experiment_group(
+        #     dataset=dataset,
+        #     experiment_group='Loading',
+        #     figure_title='Screening of co-catalyst loading',
+        #     plotting_instructions=plotting_instructions,
+        #     plotting_styles=plotting_styles,
+        #     viridis_range=(0.2, 0.8),
+        #     subplot_title_format="{value} wt. fraction Rh/Cr",
+        #     xlabel="Time / s",
+        #     ylabel=r"Concentration / $\mu$mol$\cdot$L$^{-1}$",
+        #     figsize_per_row= (8, 4),
+        #     subplots_adjustments={'top': 0.7},
+        #     legend_location=(0.5, 0.9),
+        #     save_figure=True,
+        #     save_path='figures/Loading_Screening.png',
+        #     show_figure=True,
+        # )
+
+        # fig, axes = plot_experiment_group(
+        #     dataset=dataset,
+        #     experiment_group='Temperature',
+        #     figure_title='Screening of reaction temperature',
+        #     plotting_instructions=plotting_instructions,
+        #     plotting_styles=plotting_styles,
+        #     viridis_range=(0.2, 0.8),
+        #     subplot_title_format="{value} °C",
+        #     ylim= (-5, 60),
+        #     xlabel="Time / s",
+        #     ylabel=r"Concentration / $\mu$mol$\cdot$L$^{-1}$",
+        #     subplots_adjustments={'top': 0.7},
+        #     legend_location=(0.5, 0.9),
+        #     figsize_per_row= (8, 4),
+        #     save_figure=True,
+        #     save_path='figures/Temperature_Screening.png',
+        #     show_figure=True,
+        # )
     
-    # fig, axes = plot_experiment_group(
-    #     dataset=dataset,
-    #     experiment_group='Reference',
-    #     plotting_instructions=plotting_instructions,
-    #     plotting_styles=plotting_styles,
-    #     viridis_range=(0.2, 0.8),
-    #     subplot_title_format="",
-    #     xlabel="Time / s",
-    #     ylabel=r"Concentration / $\mu$mol$\cdot$L$^{-1}$",
-    #     subplots_adjustments={'top': 0.8},
-    #     legend_location=(0.54, 1.0),
-    #     figsize_per_row= (5, 5),
-    #     save_figure=True,
-    #     save_path='figures/Reference_Conditions.png',
-    #     show_figure=True,
-    # )
-
-    # fig, axes = plot_experiment_group(
-    #     dataset=dataset,
-    #     experiment_group='D2O',
-    #     plotting_instructions=plotting_instructions,
-    #     plotting_styles=plotting_styles,
-    #     viridis_range=(0.2, 0.8),
-    #     subplot_title_format="D$_2$O",
-    #     xlabel="Time / s",
-    #     ylabel=r"Concentration / $\mu$mol$\cdot$L$^{-1}$",
-    #     subplots_adjustments={'top': 0.8},
-    #     legend_location=(0.54, 1.0),
-    #     figsize_per_row= (5, 5),
-    #     save_figure=True,
-    #     save_path='figures/D2O_Conditions.png',
-    #     show_figure=True,
-    # )
-
-    plotting_instructions_gas_phase = {
-        'Reaction (H$_2$)': PLOTTING_INSTRUCTIONS['time_series_instructions']['Reaction (H2, gas phase)'],
-        'Reaction (O$_2$)': PLOTTING_INSTRUCTIONS['time_series_instructions']['Reaction (O2, gas phase)'],
-    }
-
-    fig, axes = plot_experiment_group(
-        dataset=dataset,
-        experiment_group='Gas phase',
-        plotting_instructions=plotting_instructions_gas_phase,
-        plotting_styles=plotting_styles,
-        viridis_range=(0.2, 0.8),
-        subplot_title_format="",
-        xlabel="Time / s",
-        ylabel=r"Concentration / $\mu$mol$\cdot$L$^{-1}$",
-        subplots_adjustments={'top': 0.8},
-        legend_location=(0.54, 1.0),
-        figsize_per_row= (5, 5),
-        ylim = (-30, 720),
-        save_figure=True,
-        save_path='figures/Gas_Phase_Reference_Conditions.png',
-        show_figure=True,
-    )
-
-    # fig, axes = plot_experiment_group(
-    #     dataset=dataset,
-    #     experiment_group='Gas phase D2O',
-    #     plotting_instructions=plotting_instructions_gas_phase,
-    #     plotting_styles=plotting_styles,
-    #     viridis_range=(0.2, 0.8),
-    #     subplot_title_format="",
-    #     xlabel="Time / s",
-    #     ylabel=r"Concentration / $\mu$mol$\cdot$L$^{-1}$",
-    #     subplots_adjustments={'top': 0.8},
-    #     legend_location=(0.54, 1.0),
-    #     figsize_per_row= (5, 5),
-    #     ylim = (-30, 720),
-    #     save_figure=True,
-    #     save_path='figures/Gas_Phase_D2O.png',
-    #     show_figure=True,
-    # )
+        # fig, axes = plot_experiment_group(
+        #     dataset=dataset,
+        #     experiment_group='Reference',
+        #     plotting_instructions=plotting_instructions,
+        #     plotting_styles=plotting_styles,
+        #     viridis_range=(0.2, 0.8),
+        #     subplot_title_format="",
+        #     xlabel="Time / s",
+        #     ylabel=r"Concentration / $\mu$mol$\cdot$L$^{-1}$",
+        #     subplots_adjustments={'top': 0.8},
+        #     legend_location=(0.54, 1.0),
+        #     figsize_per_row= (5, 5),
+        #     save_figure=True,
+        #     save_path='figures/Reference_Conditions.png',
+        #     show_figure=True,
+        # )
+
+        # fig, axes = plot_experiment_group(
+        #     dataset=dataset,
+        #     experiment_group='D2O',
+        #     plotting_instructions=plotting_instructions,
+        #     plotting_styles=plotting_styles,
+        #     viridis_range=(0.2, 0.8),
+        #     subplot_title_format="D$_2$O",
+        #     xlabel="Time / s",
+        #     ylabel=r"Concentration / $\mu$mol$\cdot$L$^{-1}$",
+        #     subplots_adjustments={'top': 0.8},
+        #     legend_location=(0.54, 1.0),
+        #     figsize_per_row= (5, 5),
+        #     save_figure=True,
+        #     save_path='figures/D2O_Conditions.png',
+        #     show_figure=True,
+        # )
+
+        plotting_instructions_gas_phase = {
+            'Reaction (H$_2$)': PLOTTING_INSTRUCTIONS['time_series_instructions']['Reaction (H2, gas phase)'],
+            'Reaction (O$_2$)': PLOTTING_INSTRUCTIONS['time_series_instructions']['Reaction (O2, gas phase)'],
+        }
+
+        fig, axes = plot_experiment_group(
+            dataset=dataset,
+            experiment_group='Gas phase',
+            plotting_instructions=plotting_instructions_gas_phase,
+            plotting_styles=plotting_styles,
+            viridis_range=(0.2, 0.8),
+            subplot_title_format="",
+            xlabel="Time / s",
+            ylabel=r"Concentration / $\mu$mol$\cdot$L$^{-1}$",
+            subplots_adjustments={'top': 0.8},
+            legend_location=(0.54, 1.0),
+            figsize_per_row= (5, 5),
+            ylim = (-30, 720),
+            save_figure=True,
+            save_path='figures/Gas_Phase_Reference_Conditions.png',
+            show_figure=True,
+        )
+
+        # fig, axes = plot_experiment_group(
+        #     dataset=dataset,
+        #     experiment_group='Gas phase D2O',
+        #     plotting_instructions=plotting_instructions_gas_phase,
+        #     plotting_styles=plotting_styles,
+        #     viridis_range=(0.2, 0.8),
+        #     subplot_title_format="",
+        #     xlabel="Time / s",
+        #     ylabel=r"Concentration / $\mu$mol$\cdot$L$^{-1}$",
+        #     subplots_adjustments={'top': 0.8},
+        #     legend_location=(0.54, 1.0),
+        #     figsize_per_row= (5, 5),
+        #     ylim = (-30, 720),
+        #     save_figure=True,
+        #     save_path='figures/Gas_Phase_D2O.png',
+        #     show_figure=True,
+        # )
 
 
 
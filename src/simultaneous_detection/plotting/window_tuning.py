@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from matplotlib.widgets import Slider
+
+from simultaneous_detection.data_parsing.parsing_O2_H2_data import metadata_retrival_function, raw_data_reading_function
+from simultaneous_detection.data_parsing.window_reslicing import windowed_traces
+
+
+def window_tuning_tool(experiment_name, overview_file = 'data/251204_O2_H2_Experiment_Overview.xlsx'):
+    '''
+    Interactive choice of the irradiation windows of an experiment: one panel per sensor with
+    the raw trace, the offset-corrected window with its smoothed data and polynomial fit, and
+    sliders for the irradiation start and end of each sensor. Every slider change reprocesses
+    the window from the precomputed traces (see window_reslicing.WindowedTrace), so the max
+    rate updates instantly. The selected values are printed when the figure is closed and
+    returned as {overview column: value}.
+    '''
+
+    overview_df = pd.read_excel(overview_file)
+    metadata_dict = metadata_retrival_function(experiment_name, overview_df)
+    raw_data_dict = raw_data_reading_function(experiment_name, metadata_dict)
+
+    traces = windowed_traces(raw_data_dict, metadata_dict)
+
+    fig, axes = plt.subplots(len(traces), 1, figsize = (10, 8))
+    fig.subplots_adjust(bottom = 0.1 + 0.05 * 2 * len(traces), hspace = 0.4)
+
+    window = {}
+    sliders = []
+    panels = []
+
+    for ax, (prefix, (trace, sensor)) in zip(axes, traces.items()):
+        start_column = f'{sensor} Irradiation start [s]'
+        end_column = f'{sensor} Irradiation end [s]'
+
+        window[start_column] = metadata_dict[start_column] if not pd.isna(metadata_dict[start_column]) else trace.time[0]
+        window[end_column] = metadata_dict[end_column] if not pd.isna(metadata_dict[end_column]) else trace.time[-1]
+
+        ax.plot(trace.time, trace.data, color = 'lightgrey', label = 'Raw data')
+        data_line, = ax.plot([], [], '.', markersize = 2, label = 'Irradiation window')
+        smoothed_line, = ax.plot([], [], color = 'black', label = 'Smoothed')
+        fit_line, = ax.plot([], [], '--', color = 'red', label = 'Polynomial fit')
+
+        ax.set_xlabel('Time / s')
+        ax.set_ylabel(f'{prefix} / μmol·L$^{{-1}}$')
+        ax.legend(loc = 'upper left', fontsize = 8)
+
+        panels.append((ax, prefix, trace, start_column, end_column, data_line, smoothed_line, fit_line))
+
+    def update(_ = None):
+
+        for ax, prefix, trace, start_column, end_column, data_line, smoothed_line, fit_line in panels:
+            start, end = window[start_column], window[end_column]
+
+            try:
+                processed = trace.processing_data(start, end)
+            except ValueError as error:
+                ax.set_title(f'{prefix}: {error}')
+                continue
+
+            first, _ = trace.window_indices(start, end)
+            time_window = processed[f'{prefix}_time_reaction'] + trace.time[first]
+
+            data_line.set_data(time_window, processed[f'{prefix}_data_reaction'] + trace.data[first])
+            smoothed_line.set_data(time_window, processed[f'{prefix}_data_smoothed'] + trace.data[first])
+            fit_line.set_data(time_window, processed[f'{prefix}_poly_fit'] + trace.data[first])
+
+            ax.set_title(f"{prefix}: max rate {processed[f'{prefix}_max_rate']:.4g} μmol·L$^{{-1}}$·s$^{{-1}}$ "
+                         f'({start:.0f} s to {end:.0f} s)')
+
+        fig.canvas.draw_idle()
+
+    def set_value(column):
+        def on_change(value):
+            window[column] = value
+            update()
+        return on_change
+
+    slider_row = 0
+
+    for ax, prefix, trace, start_column, end_column, *_ in panels:
+        for column in (start_column, end_column):
+            slider_ax = fig.add_axes([0.2, 0.03 + 0.05 * slider_row, 0.6, 0.03])
+            slider = Slider(slider_ax, column, trace.time[0], trace.time[-1],
+                            valinit = window[column], valstep = np.median(np.diff(trace.time)))
+            slider.on_changed(set_value(column))
+            sliders.append(slider)
+            slider_row += 1
+
+    def on_close(_):
+        print(f'Irradiation windows of {experiment_name}:')
+        for column, value in window.items():
+            print(f'    {column}: {value:.0f}')
+
+    fig.canvas.mpl_connect('close_event', on_close)
+
+    update()
+    plt.show()
+
+    return window
+
+def main():
+
+    window_tuning_tool('NB-316')
+
+
+if __name__ == "__main__":
+    main()